@@ -0,0 +1,170 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import asyncio
+
+from cerbero.build.recipe import BuildSteps
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+MiB = 1024 * 1024
+
+
+def get_load():
+    '''
+    Gets the 1 minute load average of the machine
+
+    @return: the load average or None if it's unknown
+    @rtype: float
+    '''
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def _read_meminfo(key, meminfo):
+    try:
+        with open(meminfo, 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_mem_available(meminfo='/proc/meminfo'):
+    '''
+    Gets the memory available for new processes without swapping
+
+    @return: the available memory in bytes or None if it's unknown
+    @rtype: int
+    '''
+    return _read_meminfo('MemAvailable', meminfo)
+
+
+def get_mem_total(meminfo='/proc/meminfo'):
+    '''
+    Gets the physical memory of the machine
+
+    @return: the total memory in bytes or None if it's unknown
+    @rtype: int
+    '''
+    return _read_meminfo('MemTotal', meminfo)
+
+
+class AdmissionController (object):
+    '''
+    Delays the start of the compile and install steps while the machine is
+    saturated: when the load average is above the limit or when the memory
+    the recipe is expected to use is not available.
+
+    The memory used by a recipe is the C{memory_hint} declared in the recipe,
+    in MiB. The memory already used by the running steps is not available
+    anymore, and the memory they are expected to use is reserved until they
+    finish, so that the steps that didn't use it yet can't be overcommitted.
+    A step is always admitted when no other step is running, so that the build
+    can't stall.
+
+    @ivar max_load: load average above which steps are delayed
+    @type max_load: float
+    '''
+
+    STEPS = [BuildSteps.COMPILE[1], BuildSteps.INSTALL[1]]
+    POLL_INTERVAL = 2
+    # Fraction of the number of CPUs the load can reach
+    LOAD_FACTOR = 1.5
+
+    def __init__(self, num_of_cpus, get_load=get_load,
+                 get_mem_available=get_mem_available,
+                 get_mem_total=get_mem_total):
+        self.max_load = num_of_cpus * self.LOAD_FACTOR
+        self._get_load = get_load
+        self._get_mem_available = get_mem_available
+        self._get_mem_total = get_mem_total
+        self._running = {}  # (recipe_name, step) -> reserved memory
+
+    def memory_hint(self, recipe):
+        '''
+        Gets the memory a recipe is expected to use
+
+        @return: memory in bytes or None if it's unknown
+        @rtype: int
+        '''
+        hint = getattr(recipe, 'memory_hint', None)
+        if hint is None:
+            return None
+        return hint * MiB
+
+    def check(self, recipe, step):
+        '''
+        Checks whether a step can be started now
+
+        @return: the reason to delay it or None if it can start
+        @rtype: str
+        '''
+        if step not in self.STEPS or not self._running:
+            return None
+        load = self._get_load()
+        if load is not None and load >= self.max_load:
+            return _("load average %.1f is above %.1f") % (load, self.max_load)
+        hint = self.memory_hint(recipe)
+        if hint is None:
+            return None
+        # the memory used by the running steps is not available anymore
+        available = self._get_mem_available()
+        if available is not None and hint > available:
+            return _("needs %d MiB of memory but only %d MiB are "
+                     "available") % (hint // MiB, available // MiB)
+        # but they might not have used all the memory they reserved yet
+        total = self._get_mem_total()
+        reserved = sum(self._running.values())
+        if total is not None and hint + reserved > total:
+            return _("needs %d MiB of memory but %d MiB of %d MiB are "
+                     "reserved") % (hint // MiB, reserved // MiB, total // MiB)
+        return None
+
+    async def admit(self, recipe, step):
+        '''
+        Waits until a step can be started
+        '''
+        start = None
+        while True:
+            reason = self.check(recipe, step)
+            if reason is None:
+                break
+            if start is None:
+                start = time.monotonic()
+                m.message(_("Delaying %s of %s: %s") % (step, recipe.name,
+                                                        reason))
+            await asyncio.sleep(self.POLL_INTERVAL)
+        if start is not None:
+            m.message(_("Starting %s of %s after waiting %ds") %
+                      (step, recipe.name, time.monotonic() - start))
+        if step in self.STEPS:
+            self._running[(recipe.name, step)] = self.memory_hint(recipe) or 0
+
+    def done(self, recipe, step):
+        '''
+        Releases the resources reserved for a step
+        '''
+        self._running.pop((recipe.name, step), None)
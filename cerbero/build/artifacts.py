@@ -0,0 +1,283 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tarfile
+import hashlib
+import tempfile
+
+from cerbero.build.staging import get_install_manifests
+from cerbero.errors import FatalError
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+# Bump to invalidate all the artifacts when their format changes
+ARTIFACTS_VERSION = 1
+
+
+class ArtifactCacheBackend (object):
+    '''
+    Storage of the artifacts of the recipes, addressed by their key
+    '''
+
+    def get(self, key, path):
+        '''
+        Retrieves an artifact
+
+        @param key: key of the artifact
+        @type key: str
+        @param path: path where the artifact is written
+        @type path: str
+        @return: whether the artifact was found
+        @rtype: bool
+        '''
+        raise NotImplementedError
+
+    def put(self, key, path):
+        '''
+        Stores an artifact
+
+        @param key: key of the artifact
+        @type key: str
+        @param path: path of the artifact
+        @type path: str
+        '''
+        raise NotImplementedError
+
+
+class LocalArtifactCache (ArtifactCacheBackend):
+    '''
+    Stores the artifacts in a local directory, removing the least recently
+    used ones when it grows above its maximum size
+
+    @ivar path: directory of the cache
+    @type path: str
+    @ivar max_size: maximum size of the cache in bytes
+    @type max_size: int
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, key, path):
+        artifact = self._artifact_path(key)
+        if not os.path.isfile(artifact):
+            return False
+        shutil.copyfile(artifact, path)
+        # mark it as recently used
+        os.utime(artifact)
+        return True
+
+    def put(self, key, path):
+        artifact = self._artifact_path(key)
+        os.makedirs(os.path.dirname(artifact), exist_ok=True)
+        tmp = artifact + '.tmp'
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, artifact)
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used artifacts until the cache fits in its
+        maximum size
+        '''
+        artifacts = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                # artifacts being stored
+                if f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # evicted by another store in the meantime
+                    continue
+                artifacts.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for mtime, size, path in sorted(artifacts):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _artifact_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.tar.gz')
+
+
+# URL scheme -> callable(config, url) returning an ArtifactCacheBackend
+_backends = {}
+
+
+def register_backend(scheme, factory):
+    '''
+    Registers a backend for the artifact cache URLs with a given scheme, such
+    as 'http'. URLs without scheme use the local backend.
+
+    @param scheme: scheme of the URL
+    @type scheme: str
+    @param factory: callable receiving the config and the URL and returning
+                    a L{cerbero.build.artifacts.ArtifactCacheBackend}
+    @type factory: callable
+    '''
+    _backends[scheme] = factory
+
+
+def get_backend(config):
+    '''
+    Gets the backend configured with the artifact_cache property
+
+    @return: the backend or None if the artifact cache is disabled
+    @rtype: L{cerbero.build.artifacts.ArtifactCacheBackend}
+    '''
+    url = config.artifact_cache
+    if not url:
+        return None
+    if '://' in url:
+        scheme = url.split('://', 1)[0]
+        if scheme not in _backends:
+            raise FatalError(_("Unsupported artifact cache: %s") % url)
+        return _backends[scheme](config, url)
+    return LocalArtifactCache(url,
+        int(config.artifact_cache_max_size * 1024 * 1024 * 1024))
+
+
+class ArtifactCache (object):
+    '''
+    Cache of the files installed by each recipe, which restores them instead
+    of building the recipe again.
+
+    Artifacts are addressed by a key derived from the recipe checksum, its
+    built version, the configuration and the keys of its dependencies, so that
+    changing a recipe only invalidates the artifacts of the recipes depending
+    on it.
+
+    @ivar cookbook: cookbook with the recipes
+    @type cookbook: L{cerbero.build.cookbook.CookBook}
+    @ivar backend: storage of the artifacts
+    @type backend: L{cerbero.build.artifacts.ArtifactCacheBackend}
+    '''
+
+    def __init__(self, cookbook, backend):
+        self.cookbook = cookbook
+        self.backend = backend
+        self._keys = {}
+
+    def get_key(self, recipe_name):
+        '''
+        Gets the key of the artifact of a recipe
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: the key
+        @rtype: str
+        '''
+        if recipe_name in self._keys:
+            return self._keys[recipe_name]
+        recipe = self.cookbook.get_recipe(recipe_name)
+        config = recipe.config
+        h = hashlib.sha256()
+        h.update(str(ARTIFACTS_VERSION).encode())
+        h.update(recipe.name.encode())
+        h.update(recipe.get_checksum())
+        h.update(recipe.built_version().encode())
+        for value in (config.target_platform, config.target_arch,
+                      config.target_distro, config.target_distro_version,
+                      config.prefix, config.libdir,
+                      sorted(config.variants.__dict__.items())):
+            h.update(repr(value).encode())
+        for dep in sorted(set(
+                self.cookbook.list_recipe_direct_deps(recipe_name))):
+            h.update(self.get_key(dep).encode())
+        self._keys[recipe_name] = h.hexdigest()
+        return self._keys[recipe_name]
+
+    def restore(self, recipe):
+        '''
+        Installs the artifact of a recipe in the prefix
+
+        @param recipe: the recipe
+        @type recipe: L{cerbero.build.recipe.Recipe}
+        @return: whether the artifact was found and installed
+        @rtype: bool
+        '''
+        key = self.get_key(recipe.name)
+        prefix = recipe.config.prefix
+        with tempfile.TemporaryDirectory() as tmpdir:
+            artifact = os.path.join(tmpdir, 'artifact.tar.gz')
+            try:
+                if not self.backend.get(key, artifact):
+                    return False
+                with tarfile.open(artifact, 'r:gz') as tar:
+                    members = tar.getmembers()
+                    for member in members:
+                        if os.path.isabs(member.name) or \
+                                '..' in member.name.split('/'):
+                            raise FatalError(_("Invalid path in artifact: %s")
+                                             % member.name)
+                    tar.extractall(prefix, members)
+            except (OSError, tarfile.TarError) as ex:
+                m.warning(_("Could not restore the artifact of %s: %s") %
+                          (recipe.name, ex))
+                return False
+        files = [t.name for t in members if not t.isdir()]
+        get_install_manifests(prefix).save(recipe.name, files)
+        return True
+
+    def store(self, recipe):
+        '''
+        Stores the files installed by a recipe as its artifact
+
+        Recipes without a complete install manifest are not stored: their
+        files_list() is not a complete list of the installed files and
+        the artifact would be restored as if it were.
+
+        @param recipe: the recipe
+        @type recipe: L{cerbero.build.recipe.Recipe}
+        @return: whether the artifact was stored
+        @rtype: bool
+        '''
+        key = self.get_key(recipe.name)
+        prefix = recipe.config.prefix
+        manifests = get_install_manifests(prefix)
+        files = manifests.get_files(recipe.name)
+        if not files or not manifests.is_complete(recipe.name):
+            m.message(_("Not storing the artifact of %s, it has no complete "
+                        "install manifest") % recipe.name)
+            return False
+        files = [f for f in files if not os.path.isabs(f) and
+                 os.path.lexists(os.path.join(prefix, f))]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            artifact = os.path.join(tmpdir, 'artifact.tar.gz')
+            try:
+                with tarfile.open(artifact, 'w:gz', compresslevel=1) as tar:
+                    for f in sorted(files):
+                        tar.add(os.path.join(prefix, f), f)
+                self.backend.put(key, artifact)
+            except (OSError, tarfile.TarError) as ex:
+                m.warning(_("Could not store the artifact of %s: %s") %
+                          (recipe.name, ex))
+                return False
+        return True
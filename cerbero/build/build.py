@@ -28,6 +28,7 @@ from itertools import chain
 
 from cerbero.enums import Platform, Architecture, Distro, LibraryType
 from cerbero.errors import FatalError
+from cerbero.build.staging import StagedInstall
 from cerbero.utils import shell, to_unixpath, add_system_libs
 from cerbero.utils import EnvValue, EnvValueSingle, EnvValueArg, EnvValueCmd, EnvValuePath
 from cerbero.utils import messages as m
@@ -317,6 +318,9 @@ class Build(object):
     library_type = LibraryType.BOTH
     # Whether this recipe's build system can be built with MSVC
     can_msvc = False
+    # Whether this recipe's build system can install in a DESTDIR, recipes
+    # whose install step ignores it must set it to False
+    can_stage_install = False
 
     def __init__(self):
         self._properties_keys = []
@@ -345,6 +349,74 @@ class Build(object):
             raise RuntimeError("visualstudio variant wasn't set when uwp variant was set")
         return True
 
+    def using_staged_install(self):
+        '''
+        Whether the install step is done in a staging directory that is merged
+        into the prefix afterwards, which allows installing several recipes
+        at the same time
+        '''
+        if not self.config.staged_install or not self.can_stage_install:
+            return False
+        if self.config.platform == Platform.WINDOWS:
+            return False
+        # Recipes overriding the install step might write to the prefix
+        # directly, so they can't be staged
+        for cls in type(self).__mro__:
+            if 'install' in cls.__dict__:
+                return cls.__module__ == __name__
+        return False
+
+    def _jobserver_env(self, jobserver, cmd, env):
+        # Gets the environment that makes the build tool run by cmd take its
+        # jobs from the jobserver, or None if it can't
+        if jobserver is None or not cmd or isinstance(cmd, str):
+            return None
+        # Share the jobs of the oven with the build tool, unless it can only
+        # run one job
+        if not self.config.allow_parallel_build or \
+                not getattr(self, 'allow_parallel_build', True):
+            return None
+        return jobserver.client_env(cmd, env)
+
+    def using_jobserver(self, jobserver):
+        '''
+        Whether the build tool run in the compile step takes its jobs from the
+        jobserver, instead of running its own number of jobs
+        '''
+        # Recipes overriding the compile step might run anything
+        for cls in type(self).__mro__:
+            if 'compile' in cls.__dict__:
+                if cls.__module__ != __name__:
+                    return False
+                break
+        return self._jobserver_env(jobserver, getattr(self, 'make', None),
+                                   self.env) is not None
+
+    async def _compile(self, cmd, cmd_dir):
+        env = self.env
+        pass_fds = ()
+        jobserver = shell.JOBSERVER
+        if jobserver is not None:
+            client_env = self._jobserver_env(jobserver, cmd, env)
+            if client_env is not None:
+                cmd = jobserver.strip_jobs_args(cmd)
+                env = env.copy()
+                env.update(client_env)
+                pass_fds = jobserver.fds
+        await shell.async_call(cmd, cmd_dir, logfile=self.logfile, env=env,
+                               pass_fds=pass_fds)
+
+    async def _install(self, cmd, cmd_dir):
+        if not self.using_staged_install():
+            await shell.async_call(cmd, cmd_dir, logfile=self.logfile, env=self.env)
+            return
+        staging = StagedInstall(self.config, self.name)
+        staging.prepare()
+        env = self.env.copy()
+        env['DESTDIR'] = staging.destdir
+        await shell.async_call(cmd, cmd_dir, logfile=self.logfile, env=env)
+        staging.commit()
+
     async def configure(self):
         '''
         Configures the module
@@ -399,6 +471,7 @@ class MakefilesBase (Build, ModifyEnvBase):
     make_check = None
     make_clean = None
     allow_parallel_build = True
+    can_stage_install = True
     srcdir = '.'
     requires_non_src_build = False
     # recipes often use shell constructs
@@ -492,12 +565,12 @@ class MakefilesBase (Build, ModifyEnvBase):
     @modify_environment
     async def compile(self):
         self.maybe_add_system_libs(step='compile')
-        await shell.async_call(self.make, self.make_dir, logfile=self.logfile, env=self.env)
+        await self._compile(self.make, self.make_dir)
 
     @modify_environment
     async def install(self):
         self.maybe_add_system_libs(step='install')
-        await shell.async_call(self.make_install, self.make_dir, logfile=self.logfile, env=self.env)
+        await self._install(self.make_install, self.make_dir)
 
     @modify_environment
     def clean(self):
@@ -743,6 +816,7 @@ class Meson (Build, ModifyEnvBase) :
     meson_backend = 'ninja'
     # All meson recipes are MSVC-compatible, except if the code itself isn't
     can_msvc = True
+    can_stage_install = True
     # Build files require a build machine compiler when cross-compiling
     meson_needs_build_machine_compiler = False
     meson_builddir = "_builddir"
@@ -1115,12 +1189,12 @@ class Meson (Build, ModifyEnvBase) :
     @modify_environment
     async def compile(self):
         self.maybe_add_system_libs(step='compile')
-        await shell.async_call(self.make, self.meson_dir, logfile=self.logfile, env=self.env)
+        await self._compile(self.make, self.meson_dir)
 
     @modify_environment
     async def install(self):
         self.maybe_add_system_libs(step='install')
-        await shell.async_call(self.make_install, self.meson_dir, logfile=self.logfile, env=self.env)
+        await self._install(self.make_install, self.meson_dir)
 
     @modify_environment
     def clean(self):
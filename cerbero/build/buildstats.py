@@ -0,0 +1,202 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import pickle
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, only the wall time is recorded there
+    resource = None
+
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+class StepStats (object):
+    '''
+    Resources used by a step of a recipe, averaged over the last builds
+
+    @ivar wall: wall time in seconds
+    @type wall: float
+    @ivar cpu: user + system CPU time of the child processes in seconds
+    @type cpu: float
+    @ivar samples: number of builds recorded
+    @type samples: int
+    '''
+
+    # Weight of the last build in the averages
+    SMOOTHING = 0.5
+
+    def __init__(self, wall=0, cpu=None, samples=0):
+        self.wall = wall
+        self.cpu = cpu
+        self.samples = samples
+
+    def update(self, wall, cpu=None):
+        '''
+        Adds the resources used by a new build of the step
+        '''
+        self.wall = self._average(self.wall, wall)
+        if cpu is not None:
+            self.cpu = self._average(self.cpu, cpu)
+        self.samples += 1
+
+    def _average(self, old, new):
+        if old is None or self.samples == 0:
+            return new
+        return old + (new - old) * self.SMOOTHING
+
+    def __repr__(self):
+        return "wall: %r, cpu: %r, samples: %r" % \
+            (self.wall, self.cpu, self.samples)
+
+
+class StepTimer (object):
+    '''
+    Measures the resources used while running a build step.
+
+    CPU time is taken from the resource usage of the child processes, which
+    is shared by all the steps running concurrently, so the CPU time of
+    overlapping steps is an upper bound. The peak RSS is not recorded: the
+    high-water mark of the child processes is kept for the whole life of the
+    process and can't be attributed to a step.
+    '''
+
+    def __init__(self):
+        self.wall = None
+        self.cpu = None
+
+    def start(self):
+        self._start = time.monotonic()
+        self._start_usage = self._usage()
+
+    def stop(self):
+        self.wall = time.monotonic() - self._start
+        usage = self._usage()
+        if usage is None or self._start_usage is None:
+            return
+        self.cpu = usage - self._start_usage
+
+    def _usage(self):
+        if resource is None:
+            return None
+        ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return ru.ru_utime + ru.ru_stime
+
+
+class BuildStats (object):
+    '''
+    Persistent database with the resources used by each step of the recipes,
+    stored next to the cookbook cache of the configuration
+
+    @ivar filename: path of the database
+    @type filename: str
+    @ivar stats: (recipe_name, step) -> L{cerbero.build.buildstats.StepStats}
+    @type stats: dict
+    '''
+
+    EXT = '.stats'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stats = {}
+        self._changed = False
+        self._load()
+
+    def record(self, recipe_name, step, wall, cpu=None):
+        '''
+        Records the resources used by a step of a recipe
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @param step: name of the step
+        @type step: str
+        @param wall: wall time in seconds
+        @type wall: float
+        @param cpu: CPU time in seconds
+        @type cpu: float
+        '''
+        key = (recipe_name, step)
+        if key not in self.stats:
+            self.stats[key] = StepStats()
+        self.stats[key].update(wall, cpu)
+        self._changed = True
+
+    def get(self, recipe_name, step):
+        '''
+        Gets the stats of a step of a recipe
+
+        @return: the stats or None if the step was never recorded
+        @rtype: L{cerbero.build.buildstats.StepStats}
+        '''
+        return self.stats.get((recipe_name, step), None)
+
+    def step_duration(self, recipe_name, step):
+        '''
+        Gets the expected wall time of a step of a recipe
+
+        @return: the duration in seconds or None if it's unknown
+        @rtype: float
+        '''
+        stats = self.get(recipe_name, step)
+        if stats is None:
+            return None
+        return stats.wall
+
+    def recipe_duration(self, recipe_name, steps):
+        '''
+        Gets the expected wall time of a list of steps of a recipe
+
+        @return: the duration in seconds or None if no step was recorded
+        @rtype: float
+        '''
+        durations = [self.step_duration(recipe_name, s) for s in steps]
+        durations = [d for d in durations if d is not None]
+        if not durations:
+            return None
+        return sum(durations)
+
+    def save(self):
+        '''
+        Saves the stats recorded since they were loaded or saved
+        '''
+        if not self._changed:
+            return
+        try:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(self.stats, f)
+            os.replace(tmp, self.filename)
+            self._changed = False
+        except IOError as ex:
+            m.warning(_("Could not save the build stats: %s") % ex)
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                self.stats = pickle.load(f)
+        except Exception:
+            m.warning(_("Could not recover the build stats"))
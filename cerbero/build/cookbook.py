@@ -17,8 +17,10 @@
 # Boston, MA 02111-1307, USA.
 
 from collections import defaultdict
+import copy
 import os
 import pickle
+import sqlite3
 import time
 import imp
 import traceback
@@ -26,10 +28,15 @@ import traceback
 from cerbero.config import USER_CONFIG_DIR, Platform, Architecture, Distro,\
     DistroVersion, License, LibraryType
 from cerbero.build.build import BuildType
+from cerbero.build.buildstats import BuildStats
+from cerbero.build.recipecache import RecipesCache, LazyRecipe, file_hash, \
+    invalid_recipe_error
 from cerbero.build.source import SourceType
+from cerbero.build.statusdb import StatusDB
 from cerbero.errors import FatalError, RecipeNotFoundError, InvalidRecipeError
-from cerbero.utils import _, shell, parse_file
+from cerbero.utils import _, shell, parse_file, remove_list_duplicates
 from cerbero.utils import messages as m
+from cerbero.utils import git
 from cerbero.utils.manifest import Manifest
 from cerbero.build import recipe as crecipe
 
@@ -38,6 +45,30 @@ COOKBOOK_NAME = 'cookbook'
 USER_COOKBOOK_FILE = os.path.join(USER_CONFIG_DIR, COOKBOOK_NAME)
 
 
+def _copy_recipe_class(recipe_cls):
+    '''
+    Creates a subclass of a recipe class with its own deep copies of the
+    class variables with mutable types defined in the recipe file, which can
+    be modified without affecting the instances of the original class
+    '''
+    dct = {'__module__': recipe_cls.__module__}
+    for cls in recipe_cls.__mro__:
+        # Only the classes defined in the recipe file, see _is_recipe_class()
+        if cls.__module__ != 'builtins':
+            continue
+        for name, value in cls.__dict__.items():
+            if name in dct or name.startswith('__'):
+                continue
+            if isinstance(value, (list, dict, set)):
+                dct[name] = copy.deepcopy(value)
+    # MetaRecipe adds the source and build classes to the bases of classes
+    # called 'Recipe', which recipe_cls already has
+    cls = type(recipe_cls)('_' + recipe_cls.__name__, (recipe_cls,), dct)
+    cls.__name__ = recipe_cls.__name__
+    cls.__qualname__ = recipe_cls.__qualname__
+    return cls
+
+
 class RecipeStatus (object):
     '''
     Stores the current build status of a L{cerbero.recipe.Recipe}
@@ -76,6 +107,126 @@ class RecipeStatus (object):
             (self.steps, self.needs_build, self.mtime, self.filepath, self.built_version, self.file_hash.hex())
 
 
+class DepsGraph (object):
+    '''
+    Index of the dependencies between the recipes of a L{CookBook}, with the
+    transitive dependencies and reverse dependencies of each recipe memoized
+    as bitsets of the recipes indices
+
+    @ivar names: recipe names by index
+    @type names: list
+    @ivar index: recipe name -> index
+    @type index: dict
+    @ivar deps: direct dependencies by index
+    @type deps: list
+    @ivar rdeps: direct reverse dependencies by index
+    @type rdeps: list
+    @ivar position: position of each recipe in a topological order by index
+    @type position: list
+    '''
+
+    def __init__(self, cookbook):
+        self.names = sorted(cookbook.recipes.keys())
+        self.index = dict(((name, i) for i, name in enumerate(self.names)))
+        self.deps = [[] for name in self.names]
+        self.rdeps = [[] for name in self.names]
+        self._unknown_deps = {}
+        for i, name in enumerate(self.names):
+            for dep in remove_list_duplicates(
+                    cookbook.list_recipe_direct_deps(name)):
+                if dep not in self.index:
+                    self._unknown_deps.setdefault(i, dep)
+                    continue
+                self.deps[i].append(self.index[dep])
+                self.rdeps[self.index[dep]].append(i)
+        self.position = self._sort()
+        self._deps_bits = {}
+        self._rdeps_bits = {}
+
+    def list_deps(self, name):
+        '''
+        Lists the recipes a recipe depends on, directly or indirectly, in
+        build order
+
+        @param name: name of the recipe
+        @type name: str
+        @return: list of recipe names
+        @rtype: list
+        '''
+        return self._sorted(self._closure(self.index[name], self.deps,
+                                          self._deps_bits, []))
+
+    def list_rdeps(self, name, transitive=False):
+        '''
+        Lists the recipes depending on a recipe in build order
+
+        @param name: name of the recipe
+        @type name: str
+        @param transitive: include the recipes depending on it indirectly
+        @type transitive: bool
+        @return: list of recipe names
+        @rtype: list
+        '''
+        i = self.index[name]
+        if not transitive:
+            return self._sorted(sum((1 << r for r in set(self.rdeps[i]))))
+        return self._sorted(self._closure(i, self.rdeps, self._rdeps_bits, []))
+
+    def _closure(self, i, edges, memo, path):
+        if i in memo:
+            return memo[i]
+        if i in path:
+            raise FatalError(_("Dependency Cycle: {0}".format(self.names[i])))
+        if edges is self.deps and i in self._unknown_deps:
+            raise FatalError(_("Recipe %s has a unknown dependency %s"
+                               % (self.names[i], self._unknown_deps[i])))
+        path.append(i)
+        bits = 0
+        for e in edges[i]:
+            try:
+                bits |= self._closure(e, edges, memo, path) | (1 << e)
+            except FatalError:
+                m.error('Error finding deps of "{0}"'.format(self.names[i]))
+                raise
+        path.pop()
+        memo[i] = bits
+        return bits
+
+    def _sorted(self, bits):
+        indices = []
+        while bits:
+            low = bits & -bits
+            indices.append(low.bit_length() - 1)
+            bits ^= low
+        indices.sort(key=lambda i: self.position[i])
+        return [self.names[i] for i in indices]
+
+    def _sort(self):
+        # Depth-first post-order, ignoring the edges that would close a cycle,
+        # which are reported when the dependencies of the recipe are listed
+        position = [None] * len(self.names)
+        visiting = set()
+        count = 0
+        for root in range(len(self.names)):
+            if position[root] is not None:
+                continue
+            stack = [(root, iter(self.deps[root]))]
+            visiting.add(root)
+            while stack:
+                i, it = stack[-1]
+                for dep in it:
+                    if position[dep] is None and dep not in visiting:
+                        visiting.add(dep)
+                        stack.append((dep, iter(self.deps[dep])))
+                        break
+                else:
+                    stack.pop()
+                    visiting.discard(i)
+                    position[i] = count
+                    count += 1
+        return position
+
+
 class CookBook (object):
     '''
     Stores a list of recipes and their build status saving it's state to a
@@ -95,6 +246,14 @@ class CookBook (object):
         self.recipes = {}  # recipe_name -> recipe
         self._invalid_recipes = {} # recipe -> error
         self._mtimes = {}
+        self._runtime_deps_list = None
+        self._graph = None
+        self._recipes_cache = None
+        self._unchecked_status = set()
+        self._status_db = None
+        # recipe name -> row of the status as stored in the status db
+        self._status_db_rows = {}
+        self._configs_env = set()
 
         if not load:
             return
@@ -114,6 +273,7 @@ class CookBook (object):
         @type config: L{cerbero.config.Config}
         '''
         self._config = config
+        self._build_stats = None
         config.cookbook = self
         for c in config.arch_config.keys():
             config.arch_config[c].cookbook = self
@@ -163,6 +323,8 @@ class CookBook (object):
         @type  recipe: L{cerbero.build.cookbook.Recipe}
         '''
         self.recipes[recipe.name] = recipe
+        self._runtime_deps_list = None
+        self._graph = None
 
     def get_recipe(self, name):
         '''
@@ -190,7 +352,7 @@ class CookBook (object):
         status.steps.append(step)
         status.touch()
         self.status[recipe_name] = status
-        self.save()
+        self._save_status(recipe_name)
 
     def update_build_status(self, recipe_name, built_version):
         '''
@@ -206,7 +368,7 @@ class CookBook (object):
         status.built_version = built_version
         status.touch()
         self.status[recipe_name] = status
-        self.save()
+        self._save_status(recipe_name)
 
     def recipe_built_version (self, recipe_name):
         '''
@@ -240,7 +402,27 @@ class CookBook (object):
         '''
         if recipe_name in self.status:
             del self.status[recipe_name]
-            self.save()
+            if self._status_db is not None:
+                try:
+                    self._status_db.delete(recipe_name)
+                    self._status_db_rows.pop(recipe_name, None)
+                except sqlite3.Error as ex:
+                    m.warning(_("Could not cache the CookBook: %s") % ex)
+            else:
+                self.save()
+
+    def resolve_git_hashes(self, recipes):
+        '''
+        Resolves at once the commits of the recipes using git sources, which
+        are needed by their built_version(), instead of running git for each
+        recipe
+
+        @param recipes: list of recipes
+        @type recipes: list
+        '''
+        git.resolve_hashes([(r.repo_dir, r.commit) for r in recipes
+                            if r.stype in (SourceType.GIT,
+                                           SourceType.GIT_TARBALL)])
 
     def recipe_needs_build(self, recipe_name):
         '''
@@ -264,19 +446,39 @@ class CookBook (object):
         @rtype: list
         '''
         recipe = self.get_recipe(recipe_name)
-        return self._find_deps(recipe, {}, [])
+        deps = self._deps_graph().list_deps(recipe.name)
+        return [self.recipes[name] for name in deps] + [recipe]
+
+    def list_recipe_direct_deps(self, recipe_name):
+        '''
+        List the direct dependencies of a recipe, including the runtime
+        dependencies that are common to all recipes
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: list of recipe names
+        @rtype: list
+        '''
+        recipe = self.get_recipe(recipe_name)
+        deps = recipe.list_deps()
+        if not recipe.runtime_dep:
+            deps = self._runtime_deps() + deps
+        return deps
 
-    def list_recipe_reverse_deps(self, recipe_name):
+    def list_recipe_reverse_deps(self, recipe_name, transitive=False):
         '''
         List the dependencies that depends on this recipe
 
         @param recipe_name: name of the recipe
         @type recipe_name: str
+        @param transitive: include the recipes that depend on it indirectly
+        @type transitive: bool
         @return: list of reverse dependencies L{cerbero.recipe.Recipe}
         @rtype: list
         '''
         recipe = self.get_recipe(recipe_name)
-        return [r for r in list(self.recipes.values()) if recipe.name in r.deps]
+        rdeps = self._deps_graph().list_rdeps(recipe.name, transitive)
+        return [self.recipes[name] for name in rdeps]
 
     def get_closest_recipe (self, name):
         '''
@@ -306,8 +508,30 @@ class CookBook (object):
 
         return recipe_name
 
+    def _deps_graph(self):
+        if self._graph is None:
+            self._graph = DepsGraph(self)
+        return self._graph
+
     def _runtime_deps (self):
-        return [x.name for x in list(self.recipes.values()) if x.runtime_dep]
+        if self._runtime_deps_list is None:
+            self._runtime_deps_list = [x.name for x in
+                    list(self.recipes.values()) if x.runtime_dep]
+        return self._runtime_deps_list[:]
+
+    def get_build_stats(self):
+        '''
+        Gets the database with the resources used by the steps of the recipes
+        in previous builds
+
+        @return: the build stats
+        @rtype: L{cerbero.build.buildstats.BuildStats}
+        '''
+        if self._build_stats is None:
+            cache_file = self._cache_file(self.get_config())
+            self._build_stats = BuildStats(
+                os.path.splitext(cache_file)[0] + BuildStats.EXT)
+        return self._build_stats
 
     def _cache_file(self, config):
         if config.cache_file is not None:
@@ -318,6 +542,9 @@ class CookBook (object):
     def _restore_cache(self):
         self.status = {}
         cachefile = self._cache_file(self.get_config())
+        if self._config.status_db:
+            self._restore_status_db(cachefile)
+            return
         if not os.path.isfile(cachefile):
             # From-scratch build
             return
@@ -327,7 +554,56 @@ class CookBook (object):
         except Exception:
             m.warning(_("Could not recover status"))
 
+    def _restore_status_db(self, cachefile):
+        if self._status_db is not None:
+            self._status_db.close()
+        try:
+            self._status_db = StatusDB(
+                os.path.splitext(cachefile)[0] + StatusDB.EXT)
+            try:
+                if self._status_db.import_pickle(cachefile):
+                    m.message(_("Imported the build status from %s") %
+                              cachefile)
+            except (pickle.UnpicklingError, EOFError, AttributeError,
+                    ImportError) as ex:
+                m.warning(_("Could not import the build status from %s: %s")
+                          % (cachefile, ex))
+            for name, fields in self._status_db.load().items():
+                self.status[name] = RecipeStatus(**fields)
+            self._status_db_rows = dict(((name, StatusDB.row(st)) for
+                name, st in self.status.items()))
+        except sqlite3.Error as ex:
+            m.warning(_("Could not recover status: %s") % ex)
+            self._status_db = None
+
+    def _save_status(self, recipe_name):
+        if self._status_db is None:
+            self.save()
+            return
+        try:
+            self._status_db.put(recipe_name, self.status[recipe_name])
+            self._status_db_rows[recipe_name] = \
+                StatusDB.row(self.status[recipe_name])
+        except sqlite3.Error as ex:
+            m.warning(_("Could not cache the CookBook: %s") % ex)
+
     def save(self):
+        if self._status_db is not None:
+            # only write the records changed by this process, the others
+            # might have been updated by other processes in the meantime
+            rows = dict(((name, StatusDB.row(st)) for name, st in
+                         self.status.items()))
+            changed = dict(((name, self.status[name]) for name, row in
+                            rows.items()
+                            if self._status_db_rows.get(name) != row))
+            removed = [name for name in self._status_db_rows
+                       if name not in rows]
+            try:
+                self._status_db.put_all(changed, removed)
+                self._status_db_rows = rows
+            except sqlite3.Error as ex:
+                m.warning(_("Could not cache the CookBook: %s") % ex)
+            return
         try:
             cache_file = self._cache_file(self.get_config())
             if not os.path.exists(os.path.dirname(cache_file)):
@@ -337,32 +613,12 @@ class CookBook (object):
         except IOError as ex:
             m.warning(_("Could not cache the CookBook: %s") % ex)
 
-    def _find_deps(self, recipe, state={}, ordered=[]):
-        if state.get(recipe, 'clean') == 'processed':
-            return
-        if state.get(recipe, 'clean') == 'in-progress':
-            raise FatalError(_("Dependency Cycle: {0}".format(recipe.name)))
-        state[recipe] = 'in-progress'
-        recipe_deps = recipe.list_deps()
-        if not recipe.runtime_dep:
-            recipe_deps = self._runtime_deps () + recipe_deps
-        for recipe_name in recipe_deps:
-            try:
-                recipedep = self.get_recipe(recipe_name)
-            except RecipeNotFoundError as e:
-                raise FatalError(_("Recipe %s has a unknown dependency %s"
-                                 % (recipe.name, recipe_name)))
-            try:
-                self._find_deps(recipedep, state, ordered)
-            except FatalError:
-                m.error('Error finding deps of "{0}"'.format(recipe.name))
-                raise
-        state[recipe] = 'processed'
-        ordered.append(recipe)
-        return ordered
-
     def _recipe_status(self, recipe_name):
         recipe = self.get_recipe(recipe_name)
+        if recipe_name in self._unchecked_status:
+            self._unchecked_status.discard(recipe_name)
+            if recipe_name in self.status:
+                self._check_recipe_status(recipe)
         if recipe_name not in self.status:
             filepath = None
             if hasattr(recipe, '__file__'):
@@ -373,6 +629,15 @@ class CookBook (object):
 
     def _load_recipes(self, skip_errors):
         self.recipes = {}
+        self._runtime_deps_list = None
+        self._graph = None
+        self._unchecked_status = set()
+        self._configs_env = set()
+        if self._config.recipes_cache:
+            cache_file = self._cache_file(self.get_config())
+            self._recipes_cache = RecipesCache(
+                os.path.splitext(cache_file)[0] + RecipesCache.EXT,
+                self._config)
         recipes = defaultdict(dict)
         recipes_repos = self._config.get_recipes_repos()
         for reponame, (repodir, priority) in recipes_repos.items():
@@ -381,38 +646,53 @@ class CookBook (object):
         for key in sorted(recipes.keys()):
             self.recipes.update(recipes[key])
 
+        if self._recipes_cache is not None:
+            self._recipes_cache.save()
+
         # Check for updates in the recipe file to reset the status
+        check_recipes = []
         for recipe in list(self.recipes.values()):
             # Set the offline property, used by the recipe while performing the
             # fetch build step
             recipe.offline = self.offline
             if recipe.name not in self.status:
                 continue
-            st = self.status[recipe.name]
-            # filepath attribute was added afterwards
-            if not hasattr(st, 'filepath') or not getattr(st, 'filepath'):
-                st.filepath = recipe.__file__
-            # if filepath has changed, force using file_hash(), this will
-            # allow safe relocation of the recipes.
-            if recipe.__file__ != st.filepath:
-                st.filepath = recipe.__file__
-                st.mtime = 0;
-            # Need to check the version too, because the version can be
-            # inherited from a different file, f.ex. recipes/custom.py
-            if recipe.built_version() != st.built_version:
-                self.reset_recipe_status(recipe.name)
-            else:
-                rmtime = recipe.get_mtime()
-                if rmtime > st.mtime:
-                    # The mtime is different, check the file hash now
-                    # Use getattr as file_hash we added later
-                    saved_hash = getattr(st, 'file_hash', 0)
-                    current_hash = recipe.get_checksum()
-                    if saved_hash == current_hash:
-                        # Update the status with the mtime
-                        st.touch()
-                    else:
-                        self.reset_recipe_status(recipe.name)
+            if isinstance(recipe, LazyRecipe) and not recipe.is_loaded():
+                # Checking the status needs the recipe, do it only if the
+                # status is used
+                self._unchecked_status.add(recipe.name)
+                continue
+            check_recipes.append(recipe)
+        self.resolve_git_hashes(check_recipes)
+        for recipe in check_recipes:
+            self._check_recipe_status(recipe)
+
+    def _check_recipe_status(self, recipe):
+        st = self.status[recipe.name]
+        # filepath attribute was added afterwards
+        if not hasattr(st, 'filepath') or not getattr(st, 'filepath'):
+            st.filepath = recipe.__file__
+        # if filepath has changed, force using file_hash(), this will
+        # allow safe relocation of the recipes.
+        if recipe.__file__ != st.filepath:
+            st.filepath = recipe.__file__
+            st.mtime = 0;
+        # Need to check the version too, because the version can be
+        # inherited from a different file, f.ex. recipes/custom.py
+        if recipe.built_version() != st.built_version:
+            self.reset_recipe_status(recipe.name)
+        else:
+            rmtime = recipe.get_mtime()
+            if rmtime > st.mtime:
+                # The mtime is different, check the file hash now
+                # Use getattr as file_hash we added later
+                saved_hash = getattr(st, 'file_hash', 0)
+                current_hash = recipe.get_checksum()
+                if saved_hash == current_hash:
+                    # Update the status with the mtime
+                    st.touch()
+                else:
+                    self.reset_recipe_status(recipe.name)
 
     def _load_recipes_from_dir(self, repo, skip_errors):
         recipes = {}
@@ -428,7 +708,14 @@ class CookBook (object):
         m_path = os.path.join(repo, 'custom.py')
         if os.path.exists(m_path):
             custom = imp.load_source('custom', m_path)
+        custom_hash = file_hash(m_path)
         for f in recipes_files:
+            if self._recipes_cache is not None:
+                cached = self._recipes_cache.get(f, custom_hash)
+                if cached is not None:
+                    recipes.update(self._lazy_recipes(f, custom, *cached))
+                    continue
+                invalid = set(self._invalid_recipes.keys())
             # Try to load recipes with the custom.py module located in the
             # recipes dir which can contain private classes and methods with
             # common code for gstreamer recipes.
@@ -440,8 +727,35 @@ class CookBook (object):
                 continue
             for recipe in recipes_from_file:
                 recipes[recipe.name] = recipe
+            if self._recipes_cache is not None:
+                invalid = dict(((name, e) for name, e in
+                    self._invalid_recipes.items() if name not in invalid))
+                self._recipes_cache.set(f, custom_hash, recipes_from_file,
+                                        invalid)
+        return recipes
+
+    def _lazy_recipes(self, filepath, custom, metadata, invalid):
+        recipes = {}
+        for name, msg in invalid.items():
+            self._invalid_recipes[name] = invalid_recipe_error(name, msg)
+        for meta in metadata:
+            name = meta['attrs']['name']
+            recipes[name] = LazyRecipe(meta, lambda name=name:
+                self._load_recipe_by_name(filepath, custom, name))
+            # Side effect of the recipe initialization that is needed without
+            # loading it
+            bash_completions = meta['attrs'].get('bash_completions', None)
+            if bash_completions and \
+                    self._config.target_platform == Platform.LINUX:
+                self._config.bash_completions.update(bash_completions)
         return recipes
 
+    def _load_recipe_by_name(self, filepath, custom, name):
+        for recipe in self._load_recipes_from_file(filepath, False, custom):
+            if recipe.name == name:
+                return recipe
+        raise RecipeNotFoundError(name)
+
     def _load_recipes_from_file(self, filepath, skip_errors, custom):
         recipes = []
         d = {'Platform': Platform, 'Architecture': Architecture,
@@ -465,8 +779,8 @@ class CookBook (object):
                     recipe = self._load_recipe_from_class(
                         new_d[recipe_cls_key], self._config, filepath)
                 else:
-                    recipe = self._load_universal_recipe(d, new_d[recipe_cls_key],
-                        recipe_cls_key, filepath)
+                    recipe = self._load_universal_recipe(
+                        new_d[recipe_cls_key], filepath)
 
                 if recipe is not None:
                     recipes.append(recipe)
@@ -484,36 +798,41 @@ class CookBook (object):
             issubclass (cls, crecipe.Recipe) and \
             cls.__module__ == 'builtins'
 
+    def _setup_env(self, config):
+        # The environment only depends on the configuration, so it only needs
+        # to be set up once for each configuration while loading the recipes
+        if config not in self._configs_env:
+            config.do_setup_env()
+            self._configs_env.add(config)
+
     def _load_recipe_from_class(self, recipe_cls, config, filepath):
         try:
-            config.do_setup_env()
-            r = recipe_cls(config, config.env.copy())
+            self._setup_env(config)
+            # The recipe makes its own copy of the environment
+            r = recipe_cls(config, config.env)
             r.__file__ = os.path.abspath(filepath)
             r.prepare()
             return r
         except InvalidRecipeError as e:
             self._invalid_recipes[recipe_cls.name] = e
 
-    def _load_universal_recipe(self, globals_dict, recipe_cls,
-            recipe_cls_key, filepath, custom=None):
+    def _load_universal_recipe(self, recipe_cls, filepath):
         if self._config.target_platform in [Platform.IOS, Platform.DARWIN]:
             recipe = crecipe.UniversalFlatRecipe(self._config)
         else:
             recipe = crecipe.UniversalRecipe(self._config)
-        for c in list(self._config.arch_config.keys()):
+        archs = list(self._config.arch_config.keys())
+        # The other arches get their own copy of the class. Otherwise, class
+        # variables with mutable types like the "deps" dictionary are reused
+        # in new instances. Copies are made before any instance modifies them.
+        classes = [recipe_cls] + [_copy_recipe_class(recipe_cls)
+                                  for c in archs[1:]]
+        for c, cls in zip(archs, classes):
             conf = self._config.arch_config[c]
             conf.prefix = os.path.join(self._config.prefix, c)
-            # For univeral recipes, we need to parse again the recipe file.
-            # Otherwise, class variables with mutable types like the "deps"
-            # dictionary are reused in new instances
-            if recipe_cls is None:
-                parsed_dict = dict(globals_dict)
-                parse_file(filepath, parsed_dict)
-                recipe_cls = parsed_dict[recipe_cls_key]
-            r = self._load_recipe_from_class(recipe_cls, conf, filepath)
+            r = self._load_recipe_from_class(cls, conf, filepath)
             if r is not None:
                 recipe.add_recipe(r)
-            recipe_cls = None
         if recipe.is_empty():
             return None
         return recipe
@@ -19,19 +19,38 @@
 import os
 import re
 import glob
+import stat
+import fnmatch
 import shutil
 import inspect
-from functools import partial
+from functools import partial, wraps
 import shlex
 from pathlib import Path
 import sysconfig
 
+from cerbero.build.staging import get_install_manifests
 from cerbero.config import Platform, LibraryType
+from cerbero.tools import implib
 from cerbero.utils import shell
 from cerbero.utils import messages as m
 from cerbero.errors import FatalError
 
-def find_shlib_regex(config, libname, prefix, libdir, ext, regex):
+def is_installed(index, prefix, path):
+    if index is not None and path in index:
+        return True
+    return os.path.exists(os.path.join(prefix, path))
+
+def find_shlib_regex(config, libname, prefix, libdir, ext, regex, index=None):
+    if index is not None:
+        # Look up the files recorded in the install manifest instead
+        matches = []
+        for each in index:
+            if os.path.dirname(each) != libdir:
+                continue
+            if re.match(regex.format(re.escape(libname)), os.path.basename(each)):
+                matches.append(each)
+        if matches:
+            return matches
     # Use globbing to find all files that look like they might match
     # this library to narrow down our exact search
     fpath = os.path.join(libdir, '*{0}*{1}*'.format(libname, ext))
@@ -46,6 +65,13 @@ def find_shlib_regex(config, libname, prefix, libdir, ext, regex):
     return matches
 
 def get_implib_dllname(config, path):
+    try:
+        dllname = implib.get_dllname(path)
+    except OSError:
+        dllname = None
+    if dllname:
+        return dllname
+    # Fall back to the tools for the import libraries we can't read
     if config.msvc_env_for_toolchain and path.endswith('.lib'):
         lib_exe = shutil.which('lib', path=config.msvc_env_for_toolchain['PATH'].get())
         if not lib_exe:
@@ -64,13 +90,13 @@ def get_implib_dllname(config, path):
     except FatalError:
         return 0
 
-def find_dll_implib(config, libname, prefix, libdir, ext, regex):
+def find_dll_implib(config, libname, prefix, libdir, ext, regex, index=None):
     implibdir = 'lib'
     implibs = ['lib{}.dll.a'.format(libname), libname + '.lib', 'lib{}.lib'.format(libname)]
     implib_notfound = []
     for implib in implibs:
         path = os.path.join(prefix, implibdir, implib)
-        if not os.path.exists(path):
+        if not is_installed(index, prefix, os.path.join(implibdir, implib)):
             implib_notfound.append(implib)
             continue
         dllname = get_implib_dllname(config, path)
@@ -84,8 +110,7 @@ def find_dll_implib(config, libname, prefix, libdir, ext, regex):
     # name. This is to cover cases like libgcc_s_sjlj-1.dll which don't have an
     # import library since they're only used at runtime.
     dllname = 'lib{}.dll'.format(libname)
-    path = os.path.join(prefix, libdir, dllname)
-    if os.path.exists(path):
+    if is_installed(index, prefix, os.path.join(libdir, dllname)):
         return [os.path.join(libdir, dllname)]
     if len(implib_notfound) == len(implibs):
         m.warning("No import libraries found for {!r}".format(libname))
@@ -104,10 +129,67 @@ def find_pdb_implib(config, libname, prefix):
             pdbs.append(pdb)
     return pdbs
 
+def glob_index(index, pattern):
+    '''
+    Matches a glob pattern with the semantics of L{pathlib.Path.glob} against
+    a set of paths instead of the filesystem
+
+    @param index: relative paths of the files and of their directories
+    @type index: frozenset
+    @param pattern: glob pattern, relative too
+    @type pattern: str
+    @return: list of matches
+    @rtype: list
+    '''
+    parts = [p for p in pattern.split('/') if p and p != '.']
+    if not any(glob.has_magic(p) for p in parts):
+        path = '/'.join(parts)
+        return [path] if path in index else []
+    matches = []
+    for path in index:
+        pparts = path.split('/')
+        if len(pparts) != len(parts):
+            continue
+        for pp, p in zip(pparts, parts):
+            if not fnmatch.fnmatchcase(pp, p):
+                break
+        else:
+            matches.append(path)
+    return matches
+
+
+def cached_files(func):
+    '''
+    Caches the files found by a method of L{FilesProvider} for each set of
+    arguments until L{FilesProvider.invalidate_files_cache} is called. Copies
+    of the cached results are returned so that callers can modify them.
+    '''
+    @wraps(func)
+    def wrapper(self, *args):
+        # Use the instance dict directly, universal recipes proxy and
+        # propagate their attributes to the recipe of each arch
+        cache = self.__dict__.get('_files_cache', None)
+        if cache is None:
+            cache = self.__dict__['_files_cache'] = {}
+        key = (func.__name__,) + args
+        if key not in cache:
+            cache[key] = func(self, *args)
+        ret = cache[key]
+        if isinstance(ret, dict):
+            return dict(((k, list(v)) for k, v in ret.items()))
+        return list(ret)
+    return wrapper
+
+
 class FilesProvider(object):
     '''
     List files by categories using class attributes named files_$category and
     platform_files_$category
+
+    The files are looked up in the install manifest of the recipe when it
+    was installed recording all its files, and in the prefix otherwise, or
+    when they aren't found in the manifest. The files found are cached until
+    L{invalidate_files_cache} is called, once the recipe installed them.
     '''
 
     LIBS_CAT = 'libs'
@@ -273,9 +355,80 @@ class FilesProvider(object):
         '''
         return self._list_files_by_category(self.LIBS_CAT)
 
+    def invalidate_files_cache(self):
+        '''
+        Forget the files found in the prefix, after the recipe installed or
+        modified them
+        '''
+        self.__dict__.pop('_files_cache', None)
+
     def use_gobject_introspection(self):
         return self.TYPELIB_CAT in self._files_categories()
 
+    def _install_entries(self):
+        '''
+        Get the files installed by the recipe from its install manifest, or
+        None if it doesn't have a complete one to look them up instead of
+        searching the prefix
+        '''
+        manifests = get_install_manifests(self.config.prefix)
+        if not manifests.is_complete(self.name):
+            return None
+        return manifests.get_entries(self.name)
+
+    def _install_index(self):
+        '''
+        Get the files installed by the recipe and their directories from its
+        install manifest, or None if it doesn't have a complete one
+        '''
+        manifests = get_install_manifests(self.config.prefix)
+        if not manifests.is_complete(self.name):
+            return None
+        return manifests.get_index(self.name)
+
+    def _ls_files(self, files):
+        '''
+        Like L{cerbero.utils.shell.ls_files}, looking up the patterns in the
+        install manifest first
+        '''
+        index = self._install_index()
+        if index is None:
+            return shell.ls_files(files, self.config.prefix)
+        sfiles = set()
+        notfound = []
+        for f in ' '.join(files).split():
+            # ** can't be matched against the index
+            matches = [] if '**' in f else glob_index(index, f)
+            if matches:
+                sfiles.update(matches)
+            else:
+                notfound.append(f)
+        sfiles.update(shell.ls_files(notfound, self.config.prefix))
+        return list(sfiles)
+
+    def _is_dir(self, path):
+        entries = self._install_entries()
+        if entries is not None:
+            entry = entries.get(path, None)
+            if path in self._install_index() and path not in entries:
+                return True
+            if entry is not None and not stat.S_ISLNK(entry['mode']):
+                return False
+        return os.path.isdir(os.path.join(self.config.prefix, path))
+
+    def _ls_installed_dir(self, path):
+        '''
+        List the files in a directory of the prefix, looking them up in the
+        install manifest first
+        '''
+        entries = self._install_entries()
+        if entries is not None:
+            files = [f for f in entries if f.startswith(path.rstrip('/') + '/')]
+            if files:
+                return files
+        return self._ls_dir(os.path.join(self.config.prefix, path))
+
+    @cached_files
     def _files_categories(self):
         ''' Get the list of categories available '''
         categories = []
@@ -288,6 +441,7 @@ class FilesProvider(object):
                 categories.append(name.split('platform_files_')[1])
         return sorted(list(set(categories)))
 
+    @cached_files
     def _get_category_files_list(self, category):
         '''
         Get the raw list of files in a category, without pattern match nor
@@ -302,6 +456,7 @@ class FilesProvider(object):
                 files.extend(getattr(self, attr).get(self.platform, []))
         return files
 
+    @cached_files
     def _list_files_by_category(self, category):
         search_category = category
         if category.startswith(self.LIBS_CAT + '_'):
@@ -361,18 +516,16 @@ class FilesProvider(object):
             if f.startswith('lib/gstreamer-1.0/') and f.endswith('.la'):
                 fs.append(self._get_plugin_pc(f))
         # fill directories
-        dirs = [x for x in fs if
-                os.path.isdir(os.path.join(self.config.prefix, x))]
+        dirs = [x for x in fs if self._is_dir(x)]
         for directory in dirs:
             fs.remove(directory)
-            fs.extend(self._ls_dir(os.path.join(self.config.prefix,
-                                                directory)))
+            fs.extend(self._ls_installed_dir(directory))
         # fill paths with pattern expansion *
         paths = [x for x in fs if '*' in x]
         if len(paths) != 0:
             for path in paths:
                 fs.remove(path)
-            fs.extend(shell.ls_files(paths, self.config.prefix))
+            fs.extend(self._ls_files(paths))
         return fs
 
     def _search_binaries(self, files):
@@ -383,8 +536,9 @@ class FilesProvider(object):
         '''
         binaries = []
         for f in files:
-            self.extensions['file'] = f
-            binaries.append('bin/%(file)s%(bext)s' % self.extensions)
+            # don't modify self.extensions, the files of a recipe can be
+            # listed from several threads
+            binaries.append('bin/%s%s' % (f, self.extensions['bext']))
         return binaries
 
     def _search_libraries(self, files):
@@ -414,9 +568,10 @@ class FilesProvider(object):
 
         libsmatch = {}
         notfound = []
+        index = self._install_index()
         for f in files:
             libsmatch[f] = find_func(self.config, f[3:], self.config.prefix,
-                                     libdir, libext, libregex)
+                                     libdir, libext, libregex, index)
             if not libsmatch[f]:
                 notfound.append(f)
 
@@ -431,7 +586,7 @@ class FilesProvider(object):
         return libsmatch
 
     def _pyfile_get_name(self, f):
-        if os.path.exists(os.path.join(self.config.prefix, f)):
+        if is_installed(self._install_index(), self.config.prefix, f):
             return f
         else:
             pydir = os.path.basename(os.path.normpath(self.py_prefix))
@@ -441,7 +596,7 @@ class FilesProvider(object):
             splitedext = os.path.splitext(f)
             for ex in ['', 'm']:
                 f = splitedext[0] + '.' + cpythonname + ex + splitedext[1]
-                if os.path.exists(os.path.join(self.config.prefix, f)):
+                if is_installed(self._install_index(), self.config.prefix, f):
                     return f
         return None
 
@@ -487,8 +642,7 @@ class FilesProvider(object):
         Search for translations in share/locale/*/LC_MESSAGES/ '
         '''
         pattern = 'share/locale/*/LC_MESSAGES/%s.mo'
-        return shell.ls_files([pattern % x for x in files],
-                              self.config.prefix)
+        return self._ls_files([pattern % x for x in files])
 
     def _search_typelibfiles(self, files):
         '''
@@ -498,16 +652,15 @@ class FilesProvider(object):
             return []
 
         pattern = 'lib/girepository-1.0/%s.typelib'
-        typelibs = shell.ls_files([pattern % x for x in files],
-                                  self.config.prefix)
+        typelibs = self._ls_files([pattern % x for x in files])
         if not typelibs:
             # Add the architecture for universal builds
             pattern = 'lib/%s/girepository-1.0/%%s.typelib' % \
                 self.config.target_arch
-            typelibs = shell.ls_files([pattern % x for x in files],
-                                      self.config.prefix)
+            typelibs = self._ls_files([pattern % x for x in files])
         return typelibs
 
+    @cached_files
     def _search_girfiles(self):
         '''
         Search for typelibs in lib/girepository-1.0/
@@ -524,16 +677,15 @@ class FilesProvider(object):
 
         # Use a * for the arch in universal builds
         pattern = 'share/gir-1.0/%s.gir'
-        files = shell.ls_files([pattern % x for x in girs],
-                              self.config.prefix)
+        files = self._ls_files([pattern % x for x in girs])
         if not girs:
             # Add the architecture for universal builds
             pattern = 'share/gir-1.0/%s/%%s.gir' % \
                 self.config.target_arch
-            files = shell.ls_files([pattern % x for x in girs],
-                                      self.config.prefix)
+            files = self._ls_files([pattern % x for x in girs])
         return files
 
+    @cached_files
     def _search_devel_libraries(self):
         if self.runtime_dep:
             return []
@@ -573,7 +725,7 @@ class FilesProvider(object):
                 if self.library_type in (LibraryType.STATIC, LibraryType.NONE):
                     continue
                 devel_libs += find_pdb_implib(self.config, x[3:], self.config.prefix)
-            devel_libs.extend(shell.ls_files(libsmatch, self.config.prefix))
+            devel_libs.extend(self._ls_files(libsmatch))
         return devel_libs
 
     def _ls_dir(self, dirpath):
@@ -595,6 +747,11 @@ class UniversalFilesProvider(FilesProvider):
                 continue
             setattr(self, name, partial(self._aggregate_files_search_func, name))
 
+    def invalidate_files_cache(self):
+        super().invalidate_files_cache()
+        for r in self._recipes.values():
+            r.invalidate_files_cache()
+
     def get_arch_file(self, arch, f):
         '''
         Layout is split into separate arch-specific prefixes (android-universal)
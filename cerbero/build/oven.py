@@ -27,8 +27,12 @@ from subprocess import CalledProcessError
 from cerbero.enums import Architecture, Platform, LibraryType
 from cerbero.errors import BuildStepError, FatalError, AbortedError
 from cerbero.build.recipe import Recipe, BuildSteps
+from cerbero.build.buildstats import StepTimer
+from cerbero.build.admission import AdmissionController
+from cerbero.build.artifacts import ArtifactCache, get_backend as get_artifact_backend
+from cerbero.build.staging import PrefixSnapshot, get_install_manifests
 from cerbero.utils import _, N_, shell, run_until_complete, run_tasks, determine_num_of_cpus
-from cerbero.utils import add_system_libs, messages as m
+from cerbero.utils import add_system_libs, remove_list_duplicates, messages as m
 from cerbero.utils.shell import BuildStatusPrinter
 from cerbero.build.recipe import BuildSteps
 
@@ -56,6 +60,79 @@ class RetryRecipeError(Exception):
 class SkipRecipeError(Exception):
     pass
 
+class BuildGraph(object):
+    '''
+    Index of the dependency graph of the recipes built by the Oven. It's
+    computed once per build so that the scheduler can look up the priority
+    of a recipe in constant time.
+
+    @ivar deps: direct dependencies of each recipe in the graph
+    @type deps: dict
+    @ivar rdeps: direct reverse dependencies of each recipe in the graph
+    @type rdeps: dict
+    @ivar order: recipe names in topological order
+    @type order: list
+    @ivar levels: topological level of each recipe, 0 for recipes without
+                  dependencies
+    @type levels: dict
+    @ivar rdeps_count: number of recipes depending directly or indirectly on
+                       each recipe
+    @type rdeps_count: dict
+    @ivar remaining_path: length of the longest path from each recipe to a
+                          final target, including the recipe itself, weighted
+                          by the cost of each recipe
+    @type remaining_path: dict
+    '''
+
+    def __init__(self, deps, weights=None):
+        self.deps = dict(((name, remove_list_duplicates(d)) for name, d in
+                          deps.items()))
+        self.rdeps = dict(((name, []) for name in self.deps))
+        for name, d in self.deps.items():
+            for dep in d:
+                self.rdeps[dep].append(name)
+        self.order = self._sort()
+
+        self.levels = {}
+        for name in self.order:
+            self.levels[name] = max([self.levels[d] + 1 for d in
+                                     self.deps[name]] or [0])
+
+        # Walk the graph backwards, keeping the set of transitive reverse
+        # dependencies of each recipe as a bitset of their topological index
+        index = dict(((name, i) for i, name in enumerate(self.order)))
+        rdeps_bits = {}
+        self.rdeps_count = {}
+        self.remaining_path = {}
+        for name in reversed(self.order):
+            bits = 0
+            path = 0
+            for rdep in self.rdeps[name]:
+                bits |= rdeps_bits[rdep] | (1 << index[rdep])
+                path = max(path, self.remaining_path[rdep])
+            rdeps_bits[name] = bits
+            self.rdeps_count[name] = bin(bits).count('1')
+            self.remaining_path[name] = path + \
+                (weights[name] if weights else 1)
+
+    def _sort(self):
+        pending = dict(((name, len(d)) for name, d in self.deps.items()))
+        ready = collections.deque(sorted(name for name, count in
+                                         pending.items() if count == 0))
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for rdep in self.rdeps[name]:
+                pending[rdep] -= 1
+                if pending[rdep] == 0:
+                    ready.append(rdep)
+        if len(order) != len(self.deps):
+            cycle = sorted(set(self.deps) - set(order))
+            raise FatalError(_("Dependency Cycle: {0}".format(', '.join(cycle))))
+        return order
+
+
 class Oven (object):
     '''
     This oven cooks recipes with all their ingredients
@@ -101,10 +178,17 @@ class Oven (object):
         else:
             self._build_lock = asyncio.Semaphore(2)
         # Can't install in parallel because of the risk of two recipes writing
-        # to the same file at the same time. TODO: Need to use DESTDIR + prefix
-        # merging + file list tracking for collision detection before we can
-        # enable this.
+        # to the same file at the same time, unless the recipe installs in a
+        # staging directory that is checked for collisions before being merged
+        # into the prefix, see Build.using_staged_install()
         self._install_lock = asyncio.Lock()
+        self._artifact_cache = None
+        backend = get_artifact_backend(self.config)
+        if backend is not None:
+            self._artifact_cache = ArtifactCache(self.cookbook, backend)
+        self._admission = None
+        if self.config.admission_control:
+            self._admission = AdmissionController(self.config.num_of_cpus)
 
     def start_cooking(self):
         '''
@@ -137,7 +221,11 @@ class Oven (object):
         self._build_status_printer = BuildStatusPrinter(steps, self.interactive)
         self._static_libraries_built = []
 
-        run_until_complete(self._cook_recipes(ordered_recipes))
+        try:
+            run_until_complete(self._cook_recipes(ordered_recipes))
+        finally:
+            # the stats of the steps are saved once, at the end of the build
+            self.cookbook.get_build_stats().save()
 
     async def _cook_recipes(self, recipes):
         recipes = set(recipes)
@@ -162,63 +250,21 @@ class Oven (object):
         # final targets.  The set of recipes with no reverse dependencies
         recipe_targets = set((r.name for r in recipes)) - all_deps
 
-        # precompute the deps for each recipe
-        recipe_deps = {}
-        for r in set(set((r.name for r in recipes)) | all_deps):
-            deps = all_deps_without_recipe(r)
-            recipe_deps[r] = deps
-
-        # precompute the reverse deps for each recipe
-        def rdeps(recipe):
-            ret = []
-            for r, deps in recipe_deps.items():
-                if recipe in deps:
-                    ret.append(r)
-            return ret
-
-        recipe_rdeps = {}
-        for r in recipe_deps.keys():
-            recipe_rdeps[r] = rdeps(r)
-
-        def find_recipe_dep_path(from_name, to_name):
-            # returns a list of recipe names in reverse order that describes
-            # the path for building @from_name
-            # None if there is no path
-            if from_name == to_name:
-                return [to_name]
-            for dep in recipe_deps[from_name]:
-                val = find_recipe_dep_path(dep, to_name)
-                if val:
-                    return [from_name] + val
-
-        def find_longest_path(to_recipes):
-            # return the longest path from the targets to one of @to_recipes
-            def yield_path_lengths():
-                for f in recipe_targets:
-                    for t in to_recipes:
-                        path = find_recipe_dep_path(f, t)
-                        if path:
-                            yield len(path)
-            return max((l for l in yield_path_lengths()))
-
-        def find_buildable_recipes():
-            # This is a dumb algorithm that only looks for all available
-            # recipes that can be built.  We use a priority queue for
-            # the smarts.
-            for recipe in recipes:
-                if recipe.name in built_recipes:
-                    continue
-                if recipe.name in building_recipes:
-                    continue
-
-                if len(recipe_deps[recipe.name]) == 0:
-                    yield recipe
-                    continue
-
-                built_deps = set((dep for dep in recipe_deps[recipe.name] if dep in built_recipes))
-                if len(built_deps) > 0 and built_deps == set(recipe_deps[recipe.name]):
-                    # we have a new dep buildable
-                    yield recipe
+        # index the dependency graph of the recipes we are going to build once,
+        # so that scheduling a recipe doesn't need to walk the graph again
+        recipes_by_name = dict(((r.name, r) for r in recipes))
+        all_steps_names = [s[1] for s in next(iter(recipes)).steps]
+        durations = self._estimate_durations(recipes_by_name, all_steps_names)
+        weights = None
+        if durations:
+            weights = dict(((name, sum(d.values())) for name, d in
+                durations.items()))
+        graph = BuildGraph(dict(((r.name, [d for d in
+            self.cookbook.list_recipe_direct_deps(r.name)
+            if d in recipes_by_name]) for r in recipes)), weights)
+        # number of dependencies not built yet for each recipe
+        pending_deps = dict(((name, len(deps)) for name, deps in
+            graph.deps.items()))
 
         class MutableInt:
             def __init__(self):
@@ -231,8 +277,9 @@ class Oven (object):
             def __init__(self, recipe, count, step):
                 self.recipe = recipe
                 self.step = step
-                self.inverse_priority = find_longest_path((recipe.name,))
-                self.inverse_priority *= len(recipe_rdeps[recipe.name]) + 1
+                self.inverse_priority = graph.remaining_path[recipe.name]
+                self.inverse_priority *= graph.rdeps_count[recipe.name] + 1
+                self.level = graph.levels[recipe.name]
                 self.count = count
 
                 if step is not None:
@@ -246,7 +293,10 @@ class Oven (object):
                     self.inverse_priority *= 2
 
             def __lt__(self, other):
-                # return lower for larger path lengths
+                # return lower for larger path lengths, and for recipes
+                # closer to the bottom of the graph on ties
+                if self.inverse_priority == other.inverse_priority:
+                    return self.level < other.level
                 return self.inverse_priority > other.inverse_priority
 
         def recipe_next_step (recipe, step):
@@ -260,12 +310,35 @@ class Oven (object):
                 elif s == step:
                     found_current = True
 
+        def queue_buildable_recipe(name):
+            building_recipes.add(name)
+            default_queue.put_nowait(RecipeStepPriority(
+                recipes_by_name[name], 0, "init"))
+
+        def remaining_time():
+            # The build can't finish before the longest chain of recipes left
+            # is built, nor before all the work left is split in the jobs
+            left = [n for n in graph.order if n not in built_recipes]
+            if not left:
+                return 0
+            work = 0
+            for name in left:
+                work += sum((t for step, t in durations[name].items() if
+                    not self.cookbook.step_done(name, step)))
+            return max(work / self.jobs,
+                max((graph.remaining_path[n] for n in left)))
+
+        if durations:
+            self._build_status_printer.remaining_time = remaining_time
+
         def add_buildable_recipes(recipe):
             built_recipes.add(recipe.name)
             building_recipes.remove(recipe.name)
-            for buildable in find_buildable_recipes ():
-                building_recipes.add(buildable.name)
-                default_queue.put_nowait(RecipeStepPriority(buildable, 0, "init"))
+            for rdep in graph.rdeps[recipe.name]:
+                pending_deps[rdep] -= 1
+                if pending_deps[rdep] == 0 and rdep not in built_recipes \
+                        and rdep not in building_recipes:
+                    queue_buildable_recipe(rdep)
 
         async def cook_recipe_worker(q, steps):
             while True:
@@ -277,7 +350,7 @@ class Oven (object):
                 if step == "init":
                     counter.i += 1
                     count = counter.i
-                    if self._cook_start_recipe (recipe, count):
+                    if await self._cook_start_recipe (recipe, count):
                         add_buildable_recipes(recipe)
                         q.task_done()
                         continue
@@ -285,33 +358,67 @@ class Oven (object):
 
                 lock = locks[step]
                 if step == BuildSteps.COMPILE[1]:
-                    if not hasattr(recipe, "allow_parallel_build") \
-                       or not recipe.allow_parallel_build:
-                        # only allow a limited number of recipes that can fill all
-                        # CPU cores to execute concurrently.  Any recipe that does
-                        # not support parallel builds will always be executed
-                        lock = None
-
-                async def build_recipe_steps(step):
+                    lock = self._compile_lock(recipe, lock, jobserver)
+                unlocked_step = None
+                if step == BuildSteps.INSTALL[1] and \
+                        hasattr(recipe, "using_staged_install") \
+                        and recipe.using_staged_install():
+                    # staged installs are merged into the prefix checking
+                    # for collisions, so they can run concurrently, but the
+                    # steps after them write to the prefix directly
+                    unlocked_step = step
+
+                def needs_admission(step):
+                    return self._admission is not None and \
+                        step in AdmissionController.STEPS and \
+                        self._step_needed(recipe, step)
+
+                async def cook_recipe_step(step, admitted=False):
+                    # wait until the machine can take the step
+                    if not admitted and needs_admission(step):
+                        await self._admission.admit(recipe, step)
+                        admitted = True
+                    try:
+                        await self._cook_recipe_step_with_prompt (recipe, step, count)
+                    finally:
+                        if admitted:
+                            self._admission.done(recipe, step)
+                    return recipe_next_step (recipe, step)
+
+                async def build_recipe_steps(step, admitted=False):
                     # run the steps
                     while step in steps:
-                        await self._cook_recipe_step_with_prompt (recipe, step, count)
-                        step = recipe_next_step (recipe, step)
+                        step = await cook_recipe_step(step, admitted)
+                        admitted = False
                     return step
 
+                # wait until the machine can take the first step before
+                # taking the lock, so that a delayed step doesn't block the
+                # other recipes
+                first_step = step
+                admitted = step in steps and needs_admission(step)
+                if admitted:
+                    await self._admission.admit(recipe, step)
+
                 try:
-                    if lock:
+                    if unlocked_step is not None:
+                        step = await cook_recipe_step(step, admitted)
+                        admitted = False
+                    if lock and step in steps:
                         async with lock:
-                            step = await build_recipe_steps(step)
+                            step = await build_recipe_steps(step, admitted)
                     else:
-                        step = await build_recipe_steps(step)
+                        step = await build_recipe_steps(step, admitted)
                 except RetryRecipeError:
                     step = "init"
                 except SkipRecipeError:
                     step = None
+                finally:
+                    if admitted:
+                        self._admission.done(recipe, first_step)
 
                 if step is None:
-                    self._cook_finish_recipe (recipe, counter.i)
+                    await self._cook_finish_recipe (recipe, counter.i)
                     add_buildable_recipes(recipe)
                     next_queue = None
                 else:
@@ -321,6 +428,14 @@ class Oven (object):
                 if next_queue:
                     next_queue.put_nowait(RecipeStepPriority(recipe, count, step))
 
+        # share the jobs between all the recipes being compiled
+        jobserver = None
+        if self.config.platform != Platform.WINDOWS and \
+                self.config.allow_parallel_build and not shell.DRY_RUN:
+            from cerbero.utils.jobserver import JobServer
+            jobserver = JobServer(self.jobs)
+            shell.JOBSERVER = jobserver
+
         # all the steps we are performing
         all_steps = ["init"] + [s[1] for s in next(iter(recipes)).steps]
 
@@ -347,7 +462,11 @@ class Oven (object):
                 # nmake, both of which are run with -j1, so we need to increase
                 # the job allocation since we can run more of them in parallel
                 job_allocation[BuildSteps.COMPILE[1]] = self.jobs // 2
-        if self.jobs > 7:
+        # staged installs can run in parallel, the install queue is only
+        # needed when installs are not staged
+        staging = self.config.staged_install and \
+            self.config.platform != Platform.WINDOWS
+        if self.jobs > 7 and not staging:
             install_queue = asyncio.PriorityQueue()
             for step in install_steps:
                 queues[step] = install_queue
@@ -413,15 +532,49 @@ class Oven (object):
 
         # push the initial set of recipes that have no dependencies to start
         # building
-        for recipe in find_buildable_recipes ():
-            building_recipes.add(recipe.name)
-            default_queue.put_nowait(RecipeStepPriority(recipe, 0, "init"))
+        for name in graph.order:
+            if pending_deps[name] == 0:
+                queue_buildable_recipe(name)
 
         try:
             await run_tasks(tasks, recipes_done())
             m.output(_("All done!"), sys.stdout)
         except Exception as e:
             raise e
+        finally:
+            if jobserver is not None:
+                shell.JOBSERVER = None
+                jobserver.close()
+
+    def _estimate_durations(self, recipes_by_name, steps):
+        '''
+        Estimates the wall time of each step of the recipes from the previous
+        builds. Steps never recorded get the average time of that step in the
+        other recipes.
+
+        @return: recipe_name -> step -> seconds, or None without any record
+        @rtype: dict
+        '''
+        stats = self.cookbook.get_build_stats()
+        known = collections.defaultdict(list)
+        for name in recipes_by_name:
+            for step in steps:
+                duration = stats.step_duration(name, step)
+                if duration is not None:
+                    known[step].append(duration)
+        if not known:
+            return None
+        defaults = dict(((step, sum(known[step]) / len(known[step])
+            if known[step] else 0) for step in steps))
+        durations = {}
+        for name in recipes_by_name:
+            durations[name] = {}
+            for step in steps:
+                duration = stats.step_duration(name, step)
+                if duration is None:
+                    duration = defaults[step]
+                durations[name][step] = duration
+        return durations
 
     async def _cook_recipe_step_with_prompt (self, recipe, step, count):
         try:
@@ -453,6 +606,38 @@ class Oven (object):
             elif action == RecoveryActions.ABORT:
                 raise AbortedError()
 
+    def _compile_lock(self, recipe, lock, jobserver):
+        '''
+        Gets the lock held while compiling a recipe
+
+        @param lock: lock of the compile step, if any
+        @param jobserver: jobserver of the build, if any
+        @type jobserver: L{cerbero.utils.jobserver.JobServer}
+        '''
+        serial = not hasattr(recipe, "allow_parallel_build") or \
+            not recipe.allow_parallel_build
+        if jobserver is not None:
+            if hasattr(recipe, "using_jobserver") and \
+                    recipe.using_jobserver(jobserver):
+                # every recipe being compiled holds a token of the
+                # jobserver, the build tool gets the rest from it
+                return jobserver
+            if serial:
+                # recipes that can only run one job hold a token too, even
+                # if their build tool doesn't take any
+                return jobserver
+        elif serial:
+            # only allow a limited number of recipes that can fill all
+            # CPU cores to execute concurrently.  Any recipe that does
+            # not support parallel builds will always be executed
+            return None
+        return lock
+
+    def _step_needed (self, recipe, step):
+        if self.steps_filter is not None and step not in self.steps_filter:
+            return False
+        return self.force or not self.cookbook.step_done(recipe.name, step)
+
     async def _cook_recipe_step (self, recipe, step, count):
         # check if the current step needs to be done
         if self.steps_filter is not None and step not in self.steps_filter:
@@ -468,9 +653,32 @@ class Oven (object):
                 raise FatalError(_('Step %s not found') % step)
 
             self._build_status_printer.update_recipe_step(count, recipe.name, step)
-            ret = stepfunc()
-            if asyncio.iscoroutine(ret):
-                await ret
+            snapshot = None
+            if step == BuildSteps.INSTALL[1] and not shell.DRY_RUN and \
+                    hasattr(recipe, "using_staged_install") and \
+                    not recipe.using_staged_install():
+                # the manifest of a previous install is outdated
+                get_install_manifests(recipe.config.prefix).remove(recipe.name)
+                if self.config.snapshot_installs:
+                    # the files installed directly in the prefix are found
+                    # comparing it before and after the install
+                    snapshot = PrefixSnapshot(recipe.config.prefix)
+            timer = StepTimer()
+            timer.start()
+            try:
+                ret = stepfunc()
+                if asyncio.iscoroutine(ret):
+                    await ret
+            finally:
+                # the step might have installed or modified files of the
+                # recipe, which are searched again the next time
+                recipe.invalidate_files_cache()
+            if snapshot is not None:
+                snapshot.save_manifest(recipe.name)
+            timer.stop()
+            if not shell.DRY_RUN:
+                stats = self.cookbook.get_build_stats()
+                stats.record(recipe.name, step, timer.wall, timer.cpu)
             self._build_status_printer.remove_recipe(recipe.name)
             # update status successfully
             self.cookbook.update_step_status(recipe.name, step)
@@ -493,7 +701,7 @@ class Oven (object):
         except Exception:
             raise BuildStepError(recipe, step, traceback.format_exc())
 
-    def _cook_start_recipe(self, recipe, count):
+    async def _cook_start_recipe(self, recipe, count):
         # A Recipe depending on a static library that has been rebuilt
         # also needs to be rebuilt to pick up the latest build.
         if recipe.library_type != LibraryType.STATIC:
@@ -505,6 +713,19 @@ class Oven (object):
             self._build_status_printer.already_built(count, recipe.name)
             return True
 
+        if self._artifact_cache is not None and not self.force and \
+                not shell.DRY_RUN and isinstance(recipe, Recipe) and \
+                await self._restore_artifact(recipe):
+            recipe.invalidate_files_cache()
+            for unused, step in recipe.steps:
+                self.cookbook.update_step_status(recipe.name, step)
+            self.cookbook.update_build_status(recipe.name,
+                                              recipe.built_version())
+            if recipe.library_type == LibraryType.STATIC:
+                self._static_libraries_built.append(recipe.name)
+            self._build_status_printer.restored(count, recipe.name)
+            return True
+
         if self.missing_files:
             # create a temp file that will be used to find newer files
             recipe._oven_missing_files_tmp_file = tempfile.NamedTemporaryFile()
@@ -512,16 +733,35 @@ class Oven (object):
         recipe.force = self.force
         return False
 
-    def _cook_finish_recipe(self, recipe, count):
+    async def _cook_finish_recipe(self, recipe, count):
         self._build_status_printer.built(count, recipe.name)
         self.cookbook.update_build_status(recipe.name, recipe.built_version())
         if recipe.library_type == LibraryType.STATIC:
             self._static_libraries_built.append(recipe.name)
+        if self._artifact_cache is not None and isinstance(recipe, Recipe) \
+                and not shell.DRY_RUN:
+            await self._store_artifact(recipe)
 
         if self.missing_files:
             self._print_missing_files(recipe, recipe._oven_missing_files_tmp_file)
             recipe._oven_missing_files_tmp_file.close()
 
+    async def _restore_artifact(self, recipe):
+        # the key is computed here as it needs the cookbook, and the artifact
+        # is downloaded and extracted in a thread not to block the other
+        # recipes. It writes to the prefix like an install.
+        self._artifact_cache.get_key(recipe.name)
+        loop = asyncio.get_event_loop()
+        async with self._install_lock:
+            return await loop.run_in_executor(None,
+                self._artifact_cache.restore, recipe)
+
+    async def _store_artifact(self, recipe):
+        self._artifact_cache.get_key(recipe.name)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._artifact_cache.store,
+                                          recipe)
+
     def _handle_build_step_error(self, recipe, step, trace, arch):
         if step in [BuildSteps.FETCH, BuildSteps.EXTRACT]:
             # if any of the source steps failed, wipe the directory and reset
@@ -29,6 +29,7 @@ from pathlib import Path
 from cerbero.enums import License, LicenseDescription, LibraryType
 from cerbero.build import build, source
 from cerbero.build.filesprovider import FilesProvider, UniversalFilesProvider, UniversalFlatFilesProvider
+from cerbero.build.staging import get_install_manifests
 from cerbero.config import Platform
 from cerbero.errors import FatalError
 from cerbero.ide.pkgconfig import PkgConfig
@@ -38,6 +39,7 @@ from cerbero.tools.osxrelocator import OSXRelocator
 from cerbero.utils import N_, _
 from cerbero.utils import shell, add_system_libs, run_tasks
 from cerbero.utils import messages as m
+from cerbero.utils.digests import get_digest_cache
 from cerbero.tools.libtool import LibtoolLibrary
 
 LICENSE_INFO_FILENAME = 'README-LICENSE-INFO.txt'
@@ -194,6 +196,9 @@ class Recipe(FilesProvider, metaclass=MetaRecipe):
     @type runtime_dep: bool
     @cvar bash_completions: list of bash completion scripts for shell
     @type bash_completions: list
+    @cvar memory_hint: memory in MiB used while building, used to delay the
+                       build until that memory is available
+    @type memory_hint: int
     '''
 
     # Licenses are declared as an array of License.enums or dicts of the type:
@@ -239,6 +244,7 @@ class Recipe(FilesProvider, metaclass=MetaRecipe):
     runtime_dep = False
     bash_completions = None
     skip_steps = None
+    memory_hint = None
 
     # Internal properties
     force = False
@@ -310,9 +316,9 @@ SOFTWARE LICENSE COMPLIANCE.\n\n'''
         Decorate build step functions with a function that sets self.logfile
         for each build step for this recipe
         '''
-        steps = BuildSteps.all_names()
-        for name, func in inspect.getmembers(self, inspect.ismethod):
-            if name not in steps:
+        for name in BuildSteps.all_names():
+            func = getattr(self, name, None)
+            if not inspect.ismethod(func):
                 continue
             setattr(self, name, log_step_output(self, func))
 
@@ -656,6 +662,24 @@ SOFTWARE LICENSE COMPLIANCE.\n\n'''
         if self.btype == build.BuildType.MESON and self.name.startswith('gst'):
             self.generate_gst_la_files()
         self.install_licenses()
+        self._update_install_manifest()
+
+    def _update_install_manifest(self):
+        '''
+        Records in the install manifest the files modified and added by the
+        post installation steps
+        '''
+        manifests = get_install_manifests(self.config.prefix)
+        if manifests.get_entries(self.name) is None:
+            return
+        # generate_gst_la_files() listed the files before generating them
+        self.invalidate_files_cache()
+        licenses_dir = os.path.join(self.config.prefix, 'share', 'licenses',
+                                    self.name)
+        files = shell.ls_dir(licenses_dir, self.config.prefix)
+        files += [f for f in self.devel_files_list() if f.endswith('.la')]
+        manifests.update(self.name, files)
+        self.invalidate_files_cache()
 
     def built_version(self):
         '''
@@ -781,7 +805,8 @@ SOFTWARE LICENSE COMPLIANCE.\n\n'''
         @return: a checksum of the recipe file and its dependencies
         @rtype: str
         '''
-        return shell.files_checksum(self._get_files_dependencies())
+        return get_digest_cache(self.config).files_checksum(
+            self._get_files_dependencies())
 
     def get_mtime(self):
         '''
@@ -0,0 +1,311 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import pickle
+import hashlib
+import importlib
+
+from cerbero.build import build, source, filesprovider, recipe as crecipe
+from cerbero.errors import InvalidRecipeError
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+# Attributes of the recipes stored in the cache
+METADATA_ATTRS = ['name', 'version', 'package_name', 'deps', 'platform_deps',
+                  'runtime_dep', 'bash_completions', 'library_type',
+                  '__file__']
+# Config properties that change while loading the recipes or that don't
+# change the recipes
+IGNORED_PROPERTIES = ['bash_completions', 'interactive', 'num_of_cpus']
+# Bump to invalidate the caches when the format changes
+CACHE_VERSION = 2
+
+
+def file_hash(path):
+    if not os.path.exists(path):
+        return b''
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).digest()
+
+
+def config_fingerprint(config):
+    '''
+    Gets a fingerprint of the configuration and of the cerbero modules used to
+    load the recipes, which invalidates the cache when any of them change
+    '''
+    h = hashlib.md5()
+    h.update(str(CACHE_VERSION).encode())
+    for module in (build, source, filesprovider, crecipe):
+        h.update(file_hash(module.__file__))
+    for p in sorted(config._properties):
+        if p in IGNORED_PROPERTIES:
+            continue
+        value = getattr(config, p, None)
+        if isinstance(value, set):
+            value = sorted(value)
+        h.update(('%s=%r\n' % (p, value)).encode())
+    return h.hexdigest()
+
+
+def _enum_name(enum, value):
+    for name, v in vars(enum).items():
+        if v is value and not name.startswith('_'):
+            return name
+    return None
+
+
+def recipe_metadata(recipe):
+    '''
+    Gets the metadata of a loaded recipe that is stored in the cache
+
+    @param recipe: the recipe
+    @type recipe: L{cerbero.build.recipe.Recipe}
+    @return: the metadata
+    @rtype: dict
+    '''
+    # universal recipes proxy the attributes of their first recipe
+    r = getattr(recipe, '_proxy_recipe', None) or recipe
+    attrs = {}
+    for attr in METADATA_ATTRS:
+        if hasattr(r, attr):
+            attrs[attr] = getattr(r, attr)
+    for attr in dir(r):
+        if attr.startswith('files_') or attr.startswith('platform_files_'):
+            value = getattr(r, attr)
+            if isinstance(value, (list, dict)):
+                attrs[attr] = value
+    types = {}
+    for attr, enum in (('stype', source.SourceType),
+                       ('btype', build.BuildType)):
+        name = _enum_name(enum, getattr(r, attr, None))
+        if name is not None:
+            types[attr] = name
+    # classes of cerbero the recipe derives from, to answer isinstance()
+    # checks without loading it. The classes defined in the recipe files and
+    # in custom.py can't be imported.
+    classes = [(c.__module__, c.__qualname__) for c in type(recipe).__mro__
+               if c.__module__.startswith('cerbero.') and
+               '<' not in c.__qualname__]
+    return {'attrs': attrs, 'types': types, 'list_deps': recipe.list_deps(),
+            'classes': classes}
+
+
+_cached_classes = {}
+
+
+def cached_class(classes):
+    '''
+    Gets a class deriving from the classes of a recipe stored in the cache
+
+    @param classes: list of (module, qualified name) of the classes
+    @type classes: list
+    @return: the class or None if it can't be created
+    @rtype: type
+    '''
+    key = tuple(classes)
+    if key not in _cached_classes:
+        cls = None
+        try:
+            bases = []
+            for module, qualname in classes:
+                c = importlib.import_module(module)
+                for name in qualname.split('.'):
+                    c = getattr(c, name)
+                bases.append(c)
+            # only the most derived classes are needed as bases
+            bases = [c for c in bases if not
+                     any(b is not c and issubclass(b, c) for b in bases)]
+            if bases:
+                # the metaclasses of the recipes, like MetaRecipe, expect the
+                # namespace of a class statement
+                cls = type('LazyRecipeClass', tuple(bases),
+                           {'__module__': __name__})
+        except Exception:
+            # the recipe is loaded to answer instead
+            cls = None
+        _cached_classes[key] = cls
+    return _cached_classes[key]
+
+
+class LazyRecipe (object):
+    '''
+    Recipe restored from the metadata cache. The recipe file is only parsed
+    and the recipe instantiated the first time an attribute that is not in the
+    cache is used, after which the proxy forwards everything to the recipe.
+    isinstance() checks against the classes of cerbero are answered from the
+    classes stored in the cache.
+    '''
+
+    def __init__(self, metadata, loader):
+        object.__setattr__(self, '_metadata', metadata)
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_recipe', None)
+        object.__setattr__(self, '_pending_attrs', {})
+
+    def is_loaded(self):
+        return self._recipe is not None
+
+    def load(self):
+        '''
+        Loads the recipe
+
+        @return: the recipe
+        @rtype: L{cerbero.build.recipe.Recipe}
+        '''
+        if self._recipe is None:
+            recipe = self._loader()
+            for name, value in self._pending_attrs.items():
+                setattr(recipe, name, value)
+            object.__setattr__(self, '_recipe', recipe)
+        return self._recipe
+
+    def list_deps(self):
+        if self._recipe is None:
+            return self._metadata['list_deps'][:]
+        return self._recipe.list_deps()
+
+    @property
+    def __class__(self):
+        # Makes isinstance() checks work on the recipe, without loading it
+        # for the classes stored in the cache
+        if self._recipe is None:
+            cls = cached_class(self._metadata.get('classes', []))
+            if cls is not None:
+                return cls
+        return type(self.load())
+
+    def __getattr__(self, name):
+        if self._recipe is None:
+            if name in self._pending_attrs:
+                return self._pending_attrs[name]
+            if name in self._metadata['attrs']:
+                return self._metadata['attrs'][name]
+            if name in self._metadata['types']:
+                enum = source.SourceType if name == 'stype' else \
+                    build.BuildType
+                return getattr(enum, self._metadata['types'][name])
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        if self._recipe is None:
+            self._pending_attrs[name] = value
+        else:
+            setattr(self._recipe, name, value)
+
+    def __str__(self):
+        return str(self.load())
+
+
+class RecipesCache (object):
+    '''
+    Persistent cache of the metadata of the recipes, keyed by the hashes of
+    the recipe file and of the custom.py module of its repository. The whole
+    cache is invalidated when the configuration changes.
+
+    @ivar filename: path of the cache
+    @type filename: str
+    @ivar fingerprint: fingerprint of the configuration
+    @type fingerprint: str
+    '''
+
+    EXT = '.recipes'
+
+    def __init__(self, filename, config):
+        self.filename = filename
+        self.fingerprint = config_fingerprint(config)
+        self._files = {}
+        self._changed = False
+        self._load()
+
+    def get(self, filepath, custom_hash):
+        '''
+        Gets the metadata of the recipes in a file
+
+        @param filepath: path of the recipe file
+        @type filepath: str
+        @param custom_hash: hash of the custom.py module
+        @type custom_hash: bytes
+        @return: (list of metadata, dict of invalid recipes -> message), or
+                 None if the file is not in the cache or changed
+        @rtype: tuple
+        '''
+        entry = self._files.get(filepath, None)
+        if entry is None or entry['hash'] != self._key(filepath, custom_hash):
+            return None
+        return entry['recipes'], entry['invalid']
+
+    def set(self, filepath, custom_hash, recipes, invalid):
+        '''
+        Stores the recipes loaded from a file
+
+        @param filepath: path of the recipe file
+        @type filepath: str
+        @param custom_hash: hash of the custom.py module
+        @type custom_hash: bytes
+        @param recipes: recipes loaded from the file
+        @type recipes: list
+        @param invalid: invalid recipe name -> L{InvalidRecipeError}
+        @type invalid: dict
+        '''
+        self._files[filepath] = {
+            'hash': self._key(filepath, custom_hash),
+            'recipes': [recipe_metadata(r) for r in recipes],
+            'invalid': dict(((name, e.msg) for name, e in invalid.items()))}
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump({'fingerprint': self.fingerprint,
+                             'files': self._files}, f)
+            os.replace(tmp, self.filename)
+            self._changed = False
+        except (IOError, pickle.PicklingError, TypeError,
+                AttributeError) as ex:
+            m.warning(_("Could not save the recipes cache: %s") % ex)
+
+    def _key(self, filepath, custom_hash):
+        return file_hash(filepath) + custom_hash
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            m.warning(_("Could not recover the recipes cache"))
+            return
+        if data.get('fingerprint') == self.fingerprint:
+            self._files = data['files']
+
+
+def invalid_recipe_error(recipe_name, msg):
+    '''
+    Recreates the L{InvalidRecipeError} raised while loading a recipe
+    '''
+    e = InvalidRecipeError(recipe_name)
+    e.msg = msg
+    e.args = (msg,)
+    return e
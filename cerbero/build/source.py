@@ -23,12 +23,15 @@ import tarfile
 import urllib.request, urllib.parse, urllib.error
 import collections
 import asyncio
-from hashlib import sha256
 
 from cerbero.config import Distro, DistroVersion, Platform, DEFAULT_MIRRORS
 from cerbero.utils import git, svn, shell, _, run_until_complete
 from cerbero.errors import FatalError, CommandError, InvalidRecipeError
 import cerbero.utils.messages as m
+from cerbero.utils.digests import get_digest_cache
+from cerbero.utils.mirrors import get_mirror_selector
+from cerbero.build.sourcestore import get_source_store
+from cerbero.build.treecache import get_source_tree_cache
 
 URL_TEMPLATES = {
     'gnome': ('https://download.gnome.org/sources/', '%(name)s/%(maj_ver)s/%(name)s-%(version)s', '.tar.xz'),
@@ -193,27 +196,32 @@ class BaseTarball(object):
             return
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
+        await shell.download(self.url, fname, check_cert=self._check_cert(),
+            overwrite=redownload, logfile=get_logfile(self),
+            mirrors=(self.config.extra_mirrors + DEFAULT_MIRRORS),
+            native=self.config.native_downloads,
+            digests=get_digest_cache(self.config),
+            selector=self._mirror_selector())
+        self.verify(fname)
+
+    def _check_cert(self):
         # Enable certificate checking only on Linux for now
         # FIXME: Add more platforms here after testing
-        cc = False
         if self.config.platform == Platform.LINUX:
             if self.config.distro != Distro.REDHAT or \
                self.config.distro_version > DistroVersion.REDHAT_7:
-                cc = True
-        await shell.download(self.url, fname, check_cert=cc,
-            overwrite=redownload, logfile=get_logfile(self),
-            mirrors=(self.config.extra_mirrors + DEFAULT_MIRRORS))
-        self.verify(fname)
+                return True
+        return False
 
-    @staticmethod
-    def _checksum(fname):
-        h = sha256()
-        with open(fname, 'rb') as f:
-            # Read in chunks of 512k till f.read() returns b'' instead of reading
-            # the whole file at once which will fail on systems with low memory
-            for block in iter(lambda: f.read(512 * 1024), b''):
-                h.update(block)
-        return h.hexdigest()
+    def _mirror_selector(self):
+        if self.config.mirror_ranking:
+            return get_mirror_selector(self.config)
+        return None
+
+    def _checksum(self, fname):
+        # The digest is only computed again if the file changed since the
+        # last time it was verified
+        return get_digest_cache(self.config).get(fname, 'sha256').hex()
 
     def verify(self, fname, fatal=True):
         checksum = self._checksum(fname)
@@ -271,38 +279,121 @@ class Tarball(BaseTarball, Source):
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
 
+        store = None
+        if self.tarball_checksum is not None:
+            store = get_source_store(self.config)
+        if store is not None and not redownload and \
+                store.link(self.tarball_checksum, fname):
+            m.action(_('Linked tarball from the source store to %s instead of '
+                       'downloading %s') % (fname, self.url),
+                     logfile=get_logfile(self))
+            return
+
         cached_file = os.path.join(self.config.cached_sources,
                                    self.package_name, self.tarball_name)
         if not redownload and os.path.isfile(cached_file) and self.verify(cached_file, fatal=False):
+            if store is not None:
+                m.action(_('Adding cached tarball %s to the source store '
+                           'instead of downloading %s') % (cached_file, self.url),
+                         logfile=get_logfile(self))
+                store.add(cached_file, self.tarball_checksum)
+                store.link(self.tarball_checksum, fname)
+                return
             m.action(_('Copying cached tarball from %s to %s instead of %s') %
                      (cached_file, fname, self.url), logfile=get_logfile(self))
             shutil.copy(cached_file, fname)
             return
-        await super().fetch(redownload=redownload)
+        if store is not None and redownload and os.path.exists(fname):
+            # Downloaders write to the existing file, which can be a hardlink
+            # to a blob of the store
+            os.remove(fname)
+        if self._can_stream(fname, redownload):
+            await self._fetch_and_extract(fname)
+        else:
+            await super().fetch(redownload=redownload)
+        if store is not None:
+            store.add(fname, self.tarball_checksum)
+
+    def _streamed_dir(self):
+        # Tree extracted while the tarball was downloaded, which is used by
+        # the extract step instead of extracting the tarball again
+        return os.path.join(self.config.sources, '.streamed',
+                            self.tarball_checksum)
+
+    def _can_stream(self, fname, redownload):
+        # tarballs are only extracted while they are downloaded by the native
+        # downloader
+        if not self.config.stream_extract or \
+                not self.config.native_downloads or \
+                self.tarball_checksum is None or self.offline:
+            return False
+        if os.path.exists(fname) and not redownload:
+            return False
+        return shell.can_stream_unpack(fname, self.force_tarfile) and \
+            shell.can_download_natively(self.url,
+                self.config.extra_mirrors + DEFAULT_MIRRORS)
+
+    async def _fetch_and_extract(self, fname):
+        streamed = self._streamed_dir()
+        await shell.download_and_unpack(self.url, fname, streamed,
+            self.tarball_checksum, check_cert=self._check_cert(),
+            logfile=get_logfile(self),
+            mirrors=(self.config.extra_mirrors + DEFAULT_MIRRORS),
+            digests=get_digest_cache(self.config),
+            selector=self._mirror_selector())
 
     async def extract(self):
         m.action(_('Extracting tarball to %s') % self.config_src_dir, logfile=get_logfile(self))
         if os.path.exists(self.config_src_dir):
             shutil.rmtree(self.config_src_dir)
 
-        unpack_dir = self.config.sources
-        if self.tarball_is_bomb:
-            unpack_dir = self.config_src_dir
-        await self.extract_tarball(unpack_dir)
+        streamed = None
+        if self.tarball_checksum is not None:
+            streamed = self._streamed_dir()
+        patches = [p if os.path.isabs(p) else self.relative_path(p)
+                   for p in self.patches]
+        tree_cache = None
+        if self.tarball_checksum is not None:
+            tree_cache = get_source_tree_cache(self.config)
+        if tree_cache is not None:
+            key = tree_cache.key(self.tarball_checksum, patches, self.strip)
+            if tree_cache.get(key, self.config_src_dir):
+                m.action(_('Restored the patched source tree from the cache'),
+                         logfile=get_logfile(self))
+                if streamed is not None:
+                    shutil.rmtree(streamed, ignore_errors=True)
+                return
 
-        if self.tarball_dirname is not None:
-            extracted = os.path.join(unpack_dir, self.tarball_dirname)
-            # Since we just extracted this, a Windows anti-virus might still
-            # have a lock on files inside it.
+        if streamed is not None and os.path.isdir(streamed):
+            m.log('Using the tree extracted while downloading {}'.format(
+                self.url), get_logfile(self))
+            if self.tarball_is_bomb:
+                extracted = streamed
+            else:
+                extracted = os.path.join(streamed, self.tarball_dirname or
+                                         os.path.basename(self.config_src_dir))
             shell.windows_proof_rename(extracted, self.config_src_dir)
+        else:
+            unpack_dir = self.config.sources
+            if self.tarball_is_bomb:
+                unpack_dir = self.config_src_dir
+            await self.extract_tarball(unpack_dir)
+
+            if self.tarball_dirname is not None:
+                extracted = os.path.join(unpack_dir, self.tarball_dirname)
+                # Since we just extracted this, a Windows anti-virus might still
+                # have a lock on files inside it.
+                shell.windows_proof_rename(extracted, self.config_src_dir)
+        if streamed is not None:
+            shutil.rmtree(streamed, ignore_errors=True)
         git.init_directory(self.config_src_dir, logfile=get_logfile(self))
-        for patch in self.patches:
-            if not os.path.isabs(patch):
-                patch = self.relative_path(patch)
+        for patch in patches:
             if self.strip == 1:
                 git.apply_patch(patch, self.config_src_dir, logfile=get_logfile(self))
             else:
                 shell.apply_patch(patch, self.config_src_dir, self.strip, logfile=get_logfile(self))
+        if tree_cache is not None:
+            tree_cache.put(key, self.config_src_dir)
 
 
 class GitCache (Source):
@@ -358,6 +449,8 @@ class GitCache (Source):
                 msg = 'Offline mode: git repo for {!r} not found in cached sources ({}) or local sources ({})'
                 raise FatalError(msg.format(self.name, self.config.cached_sources, self.repo_dir))
             git.init(self.repo_dir, logfile=get_logfile(self))
+        size = git.objects_size(self.repo_dir)
+        fetch_mode = None
 
         if os.path.isdir(os.path.join(cached_dir, ".git")):
             for remote, url in self.remotes.items():
@@ -370,16 +463,40 @@ class GitCache (Source):
             for remote, url in self.remotes.items():
                 git.add_remote(self.repo_dir, remote, url, logfile=get_logfile(self))
             # fetch remote branches
-            if not self.offline:
+            if not self.offline and self.config.git_object_store:
+                await self._fetch_object_stores()
+            elif not self.offline and self.config.git_fetch_mode and self.commit and \
+                    await git.fetch_commit(self.repo_dir, self.commit, list(self.remotes),
+                                           self.config.git_fetch_mode, logfile=get_logfile(self)):
+                fetch_mode = self.config.git_fetch_mode
+            elif not self.offline:
                 await git.fetch(self.repo_dir, fail=False, logfile=get_logfile(self))
         if checkout:
             await git.checkout(self.repo_dir, self.commit, logfile=get_logfile(self))
             if self.use_submodules:
-                await git.submodules_update(self.repo_dir, cached_dir, fail=False, offline=self.offline, logfile=get_logfile(self))
-
+                await git.submodules_update(self.repo_dir, cached_dir, fail=False, offline=self.offline,
+                                            logfile=get_logfile(self), fetch_mode=fetch_mode)
+        if not self.offline:
+            m.action(_('Fetched %d KiB of git objects') %
+                     ((git.objects_size(self.repo_dir) - size) // 1024),
+                     logfile=get_logfile(self))
+
+
+    async def _fetch_object_stores(self):
+        # The remotes are fetched in the bare repositories of the object store
+        # shared by all the recipes and configurations, and the recipe
+        # repository borrows their objects
+        remotes = list(self.remotes.items())
+        stores = await asyncio.gather(*[git.fetch_object_store(
+            self.config.git_object_store, url, logfile=get_logfile(self))
+            for remote, url in remotes])
+        git.use_object_stores(self.repo_dir, stores)
+        for (remote, url), store in zip(remotes, stores):
+            await git.fetch_from_object_store(self.repo_dir, remote, store,
+                                              logfile=get_logfile(self))
 
     def built_version(self):
-        return '%s+git~%s' % (self.version, git.get_hash(self.repo_dir, self.commit, logfile=get_logfile(self)))
+        return '%s+git~%s' % (self.version, git.get_cached_hash(self.repo_dir, self.commit, logfile=get_logfile(self)))
 
 
 class Git (GitCache):
@@ -0,0 +1,245 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from cerbero.utils.digests import get_digest_cache, file_digest
+
+
+BLOBS_DIR = 'blobs'
+REFS_DIR = 'refs'
+LOCK_FILE = 'lock'
+# ioctl to share the extents of a file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    '''
+    Creates a copy-on-write copy of a file
+
+    @raise OSError: if the filesystem doesn't support it
+    '''
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        raise OSError('reflinks are not supported')
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dest)
+            raise
+
+
+def link_or_copy(src, dest):
+    '''
+    Makes dest have the contents of src with a hardlink, a reflink or, when
+    the filesystem supports neither of them, a copy
+    '''
+    tmp = '%s.tmp%d' % (dest, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            reflink(src, tmp)
+        except OSError:
+            shutil.copy(src, tmp)
+    os.replace(tmp, dest)
+
+
+class SourceStore (object):
+    '''
+    Content-addressed store of the source tarballs, keyed by their SHA-256
+    and shared by all the configurations of the host.
+
+    The download paths of the recipes are hardlinks (or reflinks, or copies
+    when the store is in another filesystem) to the blobs of the store, so
+    that each tarball is stored once. The paths linked to each blob are
+    recorded in refs/<checksum>, which L{gc} uses to remove the blobs that no
+    recipe download path references anymore.
+
+    @ivar path: directory of the store
+    @type path: str
+    @ivar digests: cache used to check the copies of the blobs
+    @type digests: L{cerbero.utils.digests.DigestCache}
+    '''
+
+    def __init__(self, path, digests=None):
+        self.path = path
+        self.digests = digests
+
+    def blob_path(self, checksum):
+        return os.path.join(self.path, BLOBS_DIR, checksum[:2], checksum)
+
+    def refs_path(self, checksum):
+        return os.path.join(self.path, REFS_DIR, checksum[:2], checksum)
+
+    def has(self, checksum):
+        return os.path.isfile(self.blob_path(checksum))
+
+    def add(self, path, checksum):
+        '''
+        Adds a verified file to the store, if it's not already in it, and
+        links the file to the blob
+
+        @param path: path of the file
+        @type path: str
+        @param checksum: SHA-256 of the file
+        @type checksum: str
+        '''
+        with self._lock():
+            blob = self.blob_path(checksum)
+            if not os.path.isfile(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                link_or_copy(path, blob)
+            elif not os.path.samefile(path, blob):
+                link_or_copy(blob, path)
+            self._add_ref(checksum, path)
+
+    def link(self, checksum, dest):
+        '''
+        Links a path to the blob with a given checksum
+
+        @param checksum: SHA-256 of the file
+        @type checksum: str
+        @param dest: path of the link
+        @type dest: str
+        @return: whether the blob is in the store
+        @rtype: bool
+        '''
+        with self._lock():
+            blob = self.blob_path(checksum)
+            if not os.path.isfile(blob):
+                return False
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if not (os.path.exists(dest) and os.path.samefile(blob, dest)):
+                link_or_copy(blob, dest)
+            self._add_ref(checksum, dest)
+        return True
+
+    def refs(self, checksum):
+        '''
+        Gets the paths recorded as references to a blob
+
+        @return: list of paths
+        @rtype: list
+        '''
+        refs_path = self.refs_path(checksum)
+        if not os.path.isfile(refs_path):
+            return []
+        with open(refs_path, 'r') as f:
+            return list(dict.fromkeys(l.rstrip('\n') for l in f if l.strip()))
+
+    def gc(self, dry_run=False):
+        '''
+        Removes the blobs that are no longer referenced. A reference is alive
+        while its path still has the contents of the blob.
+
+        @param dry_run: only report the blobs that would be removed
+        @type dry_run: bool
+        @return: list of (checksum, size) of the removed blobs
+        @rtype: list
+        '''
+        removed = []
+        blobs_dir = os.path.join(self.path, BLOBS_DIR)
+        if not os.path.isdir(blobs_dir):
+            return removed
+        with self._lock(exclusive=True):
+            for subdir in sorted(os.listdir(blobs_dir)):
+                for checksum in sorted(os.listdir(os.path.join(blobs_dir,
+                                                               subdir))):
+                    live = [p for p in self.refs(checksum)
+                            if self._is_alive(checksum, p)]
+                    if live:
+                        if not dry_run:
+                            self._write_refs(checksum, live)
+                        continue
+                    blob = self.blob_path(checksum)
+                    removed.append((checksum, os.path.getsize(blob)))
+                    if dry_run:
+                        continue
+                    os.remove(blob)
+                    if os.path.exists(self.refs_path(checksum)):
+                        os.remove(self.refs_path(checksum))
+        return removed
+
+    def _is_alive(self, checksum, path):
+        if not os.path.isfile(path):
+            return False
+        blob = self.blob_path(checksum)
+        if os.path.samefile(path, blob):
+            return True
+        # A reflink or a copy
+        if os.path.getsize(path) != os.path.getsize(blob):
+            return False
+        if self.digests is not None:
+            digest = self.digests.get(path, 'sha256')
+        else:
+            digest = file_digest(path, 'sha256')
+        return digest.hex() == checksum
+
+    def _add_ref(self, checksum, path):
+        path = os.path.abspath(path)
+        if path in self.refs(checksum):
+            return
+        refs_path = self.refs_path(checksum)
+        os.makedirs(os.path.dirname(refs_path), exist_ok=True)
+        with open(refs_path, 'a') as f:
+            f.write(path + '\n')
+
+    def _write_refs(self, checksum, refs):
+        refs_path = self.refs_path(checksum)
+        tmp = refs_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join(p + '\n' for p in refs))
+        os.replace(tmp, refs_path)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive=False):
+        # Serializes the changes of the processes of all the configurations
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive
+                        else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_source_store(config):
+    '''
+    Gets the source store configured with the source_store property
+
+    @return: the store or None if it's disabled
+    @rtype: L{cerbero.build.sourcestore.SourceStore}
+    '''
+    if not config.source_store:
+        return None
+    return SourceStore(config.source_store, get_digest_cache(config))
@@ -0,0 +1,457 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import stat
+import shutil
+import hashlib
+import threading
+
+from cerbero.errors import FatalError
+from cerbero.utils import _
+from cerbero.utils import messages as m
+from cerbero.utils.digests import file_digest
+
+
+CERBERO_DIR = '.cerbero'
+MANIFESTS_DIR = os.path.join(CERBERO_DIR, 'manifests')
+STAGING_DIR = os.path.join(CERBERO_DIR, 'staging')
+
+
+class InstallManifests (object):
+    '''
+    Index of the files installed in a prefix by each recipe, stored in
+    <prefix>/.cerbero/manifests/<recipe>.json
+
+    The manifests are loaded lazily and cached, the caches can be used
+    from several threads.
+
+    Paths inside the prefix are stored relative to it, paths outside of it are
+    stored as absolute paths. Each file is recorded with its size, mode,
+    modification time and hash as they were when it was installed. Manifests
+    written by older versions only have the list of files.
+
+    Manifests are complete when they list all the files installed by the
+    recipe, as the ones of staged installs. The manifests of installs done
+    directly in the prefix only have the files that changed, and the ones
+    written by older versions are not known to be complete.
+
+    @ivar prefix: prefix of the installation
+    @type prefix: str
+    '''
+
+    VERSION = 2
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._manifests = {}  # recipe_name -> dict of file -> entry
+        self._indexes = {}  # recipe_name -> frozenset of files and dirs
+        self._complete = {}  # recipe_name -> bool
+        self._owners = None  # file -> recipe_name
+        self._lock = threading.RLock()
+
+    def manifest_path(self, recipe_name):
+        return os.path.join(self.prefix, MANIFESTS_DIR, recipe_name + '.json')
+
+    def get_entries(self, recipe_name):
+        '''
+        Gets the files installed by a recipe with their size, mode,
+        modification time and hash
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: file -> entry, where entries are dicts with the 'size',
+                 'mode', 'mtime' and 'hash' keys, or None for manifests
+                 without them. None if the recipe has no manifest.
+        @rtype: dict
+        '''
+        with self._lock:
+            if recipe_name not in self._manifests:
+                self._manifests[recipe_name] = self._load(recipe_name)
+            return self._manifests[recipe_name]
+
+    def is_complete(self, recipe_name):
+        '''
+        Whether the manifest of a recipe lists all the files it installed, so
+        that files missing from it can be assumed not to be installed
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: True if the recipe has a complete manifest
+        @rtype: bool
+        '''
+        with self._lock:
+            if self.get_entries(recipe_name) is None:
+                return False
+            return self._complete.get(recipe_name, False)
+
+    def get_files(self, recipe_name):
+        '''
+        Gets the files installed by a recipe
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: list of files or None if the recipe has no manifest
+        @rtype: list
+        '''
+        entries = self.get_entries(recipe_name)
+        if entries is None:
+            return None
+        return sorted(entries)
+
+    def get_index(self, recipe_name):
+        '''
+        Gets the files installed by a recipe and the directories containing
+        them, to look them up without listing the prefix
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @return: set of paths or None if the recipe has no manifest
+        @rtype: frozenset
+        '''
+        with self._lock:
+            if recipe_name not in self._indexes:
+                entries = self.get_entries(recipe_name)
+                index = None
+                if entries is not None:
+                    index = set()
+                    for f in entries:
+                        while f and f not in index:
+                            index.add(f)
+                            f = os.path.dirname(f)
+                    index = frozenset(index)
+                self._indexes[recipe_name] = index
+            return self._indexes[recipe_name]
+
+    def get_owner(self, path):
+        '''
+        Gets the recipe that installed a file
+
+        @param path: path relative to the prefix
+        @type path: str
+        @return: the name of the recipe or None if no recipe owns the file
+        @rtype: str
+        '''
+        with self._lock:
+            return self._get_owners().get(path, None)
+
+    def save(self, recipe_name, files, complete=True):
+        '''
+        Saves the files installed by a recipe, replacing the previous manifest
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @param files: list of files installed
+        @type files: list
+        @param complete: whether the files are all the files installed by
+                         the recipe
+        @type complete: bool
+        '''
+        entries = {}
+        for f in files:
+            entry = self._stat_entry(f)
+            if entry is not None:
+                entries[f] = entry
+        self._write(recipe_name, entries, complete)
+
+    def update(self, recipe_name, files=None):
+        '''
+        Updates the manifest of a recipe after its files were modified, adding
+        new files to it and removing the files that no longer exist. Only the
+        files whose size or modification time changed are hashed again.
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @param files: list of files to add to the manifest
+        @type files: list
+        '''
+        old = self.get_entries(recipe_name)
+        if old is None:
+            return
+        entries = {}
+        for f in set(old).union(files or []):
+            entry = self._stat_entry(f, old.get(f, None))
+            if entry is not None:
+                entries[f] = entry
+        self._write(recipe_name, entries, self.is_complete(recipe_name))
+
+    def remove(self, recipe_name):
+        '''
+        Removes the manifest of a recipe, for instance when it's installed
+        without recording the files it installs
+        '''
+        path = self.manifest_path(recipe_name)
+        if os.path.exists(path):
+            os.remove(path)
+        self._set_entries(recipe_name, None)
+
+    def _write(self, recipe_name, entries, complete):
+        path = self.manifest_path(recipe_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.VERSION, 'complete': complete,
+                       'files': entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+        self._set_entries(recipe_name, entries, complete)
+
+    def _set_entries(self, recipe_name, entries, complete=False):
+        with self._lock:
+            if self._owners is not None:
+                for p in self.get_entries(recipe_name) or {}:
+                    if self._owners.get(p) == recipe_name:
+                        del self._owners[p]
+                for p in entries or {}:
+                    self._owners[p] = recipe_name
+            self._manifests[recipe_name] = entries
+            self._complete[recipe_name] = complete
+            self._indexes.pop(recipe_name, None)
+
+    def _stat_entry(self, f, old=None):
+        # Returns the entry of a file or None if it doesn't exist
+        path = os.path.join(self.prefix, f)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return None
+        entry = {'size': st.st_size, 'mode': st.st_mode,
+                 'mtime': st.st_mtime_ns}
+        if old is not None and old.get('size') == entry['size'] and \
+                old.get('mtime') == entry['mtime'] and 'hash' in old:
+            entry['hash'] = old['hash']
+        elif stat.S_ISLNK(st.st_mode):
+            entry['hash'] = hashlib.blake2b(os.readlink(path).encode(),
+                                            digest_size=16).hexdigest()
+        elif stat.S_ISREG(st.st_mode):
+            entry['hash'] = file_digest(path).hex()
+        return entry
+
+    def _get_owners(self):
+        with self._lock:
+            if self._owners is None:
+                owners = {}
+                manifests_dir = os.path.join(self.prefix, MANIFESTS_DIR)
+                if os.path.isdir(manifests_dir):
+                    for f in sorted(os.listdir(manifests_dir)):
+                        if not f.endswith('.json'):
+                            continue
+                        recipe_name = f[:-len('.json')]
+                        for p in self.get_entries(recipe_name) or {}:
+                            owners[p] = recipe_name
+                self._owners = owners
+            return self._owners
+
+    def _load(self, recipe_name):
+        path = self.manifest_path(recipe_name)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            files = manifest['files']
+        except Exception:
+            m.warning(_("Could not read the install manifest %s") % path)
+            return None
+        self._complete[recipe_name] = manifest.get('complete', False)
+        if isinstance(files, list):
+            # manifests without the entries of the files
+            return dict(((p, None) for p in files))
+        return files
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_install_manifests(prefix):
+    '''
+    Gets the shared L{cerbero.build.staging.InstallManifests} of a prefix
+    '''
+    prefix = os.path.abspath(prefix)
+    with _manifests_lock:
+        if prefix not in _manifests:
+            _manifests[prefix] = InstallManifests(prefix)
+        return _manifests[prefix]
+
+
+class StagedInstall (object):
+    '''
+    Installs a recipe in a staging directory through DESTDIR and merges it
+    into the prefix after checking that it doesn't overwrite files installed
+    by other recipes.
+
+    The staging directory lives inside the prefix so that files can be moved
+    into it with renames.
+
+    @ivar config: configuration of the recipe
+    @type config: L{cerbero.config.Config}
+    @ivar recipe_name: name of the recipe
+    @type recipe_name: str
+    @ivar destdir: staging directory
+    @type destdir: str
+    '''
+
+    def __init__(self, config, recipe_name):
+        self.config = config
+        self.recipe_name = recipe_name
+        self.prefix = os.path.abspath(config.prefix)
+        self.destdir = os.path.join(self.prefix, STAGING_DIR, recipe_name)
+
+    def prepare(self):
+        '''
+        Creates an empty staging directory
+        '''
+        if os.path.exists(self.destdir):
+            shutil.rmtree(self.destdir)
+        os.makedirs(self.destdir)
+
+    def commit(self):
+        '''
+        Merges the staging directory into the prefix and records the files
+        installed in the manifest of the recipe. Fails if nothing was staged,
+        as the install probably ignored DESTDIR and wrote to the prefix.
+
+        @return: list of installed files
+        @rtype: list
+        '''
+        dirs, files = self._list_staged()
+        manifests = get_install_manifests(self.prefix)
+        if not files:
+            # the previous manifest of the recipe is outdated too
+            manifests.remove(self.recipe_name)
+            shutil.rmtree(self.destdir)
+            raise FatalError(_("Recipe '%s' didn't install any file in the "
+                               "staging directory, its install step might "
+                               "ignore DESTDIR. Set can_stage_install = False "
+                               "in the recipe to install it in the prefix "
+                               "directly.") % self.recipe_name)
+        entries = dict(((f, self._manifest_entry(f)) for f in files))
+
+        collisions = []
+        for f, entry in entries.items():
+            owner = manifests.get_owner(entry)
+            if owner is not None and owner != self.recipe_name:
+                collisions.append('%s (%s)' % (entry, owner))
+            elif os.path.isdir(f) and not os.path.islink(f):
+                collisions.append('%s (directory)' % entry)
+        if collisions:
+            raise FatalError(_("Recipe '%s' installs files already installed "
+                               "in the prefix by other recipes:\n%s") %
+                             (self.recipe_name, '\n'.join(sorted(collisions))))
+
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+        for f in files:
+            os.replace(self._staged_path(f), f)
+        manifests.save(self.recipe_name, list(entries.values()))
+        shutil.rmtree(self.destdir)
+        return files
+
+    def _list_staged(self):
+        # Returns the directories and files to install as destination paths
+        dirs = []
+        files = []
+        for root, dirnames, filenames in os.walk(self.destdir):
+            dest_root = self._dest_path(root)
+            dirs.append(dest_root)
+            for d in dirnames:
+                # symlinks to directories are listed as directories
+                if os.path.islink(os.path.join(root, d)):
+                    files.append(os.path.join(dest_root, d))
+            for f in filenames:
+                files.append(os.path.join(dest_root, f))
+        return dirs, files
+
+    def _dest_path(self, staged):
+        rel = os.path.relpath(staged, self.destdir)
+        if rel == '.':
+            return os.sep
+        return os.path.join(os.sep, rel)
+
+    def _staged_path(self, dest):
+        return os.path.join(self.destdir, os.path.relpath(dest, os.sep))
+
+    def _manifest_entry(self, dest):
+        if dest.startswith(self.prefix + os.sep):
+            return os.path.relpath(dest, self.prefix)
+        return dest
+
+
+class PrefixSnapshot (object):
+    '''
+    Snapshot of the files of a prefix, to find the files installed by a recipe
+    that is installed directly in the prefix instead of being staged.
+
+    Files are compared by their size, mode, modification and change times and
+    inode, so the files rewritten by the install are found even if their
+    contents and modification times did not change. Installs writing outside of the prefix are not tracked.
+
+    @ivar prefix: prefix of the installation
+    @type prefix: str
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = os.path.abspath(prefix)
+        self._files = self._scan()
+
+    def changed_files(self):
+        '''
+        Gets the files added or modified since the snapshot was taken
+
+        @return: sorted list of files relative to the prefix
+        @rtype: list
+        '''
+        return sorted([f for f, st in self._scan().items()
+                       if self._files.get(f, None) != st])
+
+    def save_manifest(self, recipe_name):
+        '''
+        Records the files added or modified since the snapshot was taken as
+        the files installed by a recipe. Files of other recipes staged in the
+        meantime are skipped.
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        '''
+        manifests = get_install_manifests(self.prefix)
+        files = [f for f in self.changed_files()
+                 if manifests.get_owner(f) in (None, recipe_name)]
+        # the files of the recipe that didn't change are missing
+        manifests.save(recipe_name, files, complete=False)
+
+    def _scan(self):
+        files = {}
+        for root, dirnames, filenames in os.walk(self.prefix):
+            if root == self.prefix and CERBERO_DIR in dirnames:
+                dirnames.remove(CERBERO_DIR)
+            rel_root = os.path.relpath(root, self.prefix)
+            if rel_root == '.':
+                rel_root = ''
+            # symlinks to directories are listed as directories
+            names = [d for d in dirnames
+                     if os.path.islink(os.path.join(root, d))]
+            for name in names + filenames:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files[os.path.join(rel_root, name)] = \
+                    (st.st_size, st.st_mode, st.st_mtime_ns, st.st_ctime_ns,
+                     st.st_ino)
+        return files
@@ -0,0 +1,192 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import pickle
+import sqlite3
+from contextlib import contextmanager
+
+
+class StatusDB (object):
+    '''
+    Build status of the recipes stored in an SQLite database, with one record
+    per recipe.
+
+    Each update is committed in its own transaction, which only writes the
+    record of the recipe instead of the whole status. The database uses
+    write-ahead logging so that several cerbero processes can read it while
+    another one is writing.
+
+    @ivar filename: path of the database
+    @type filename: str
+    '''
+
+    EXT = '.sqlite'
+    FIELDS = ['steps', 'needs_build', 'mtime', 'filepath', 'built_version',
+              'file_hash']
+    # Seconds to wait for the lock held by another process
+    TIMEOUT = 60
+
+    def __init__(self, filename):
+        self.filename = filename
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        # Transactions are handled explicitly in _transaction()
+        self._conn = sqlite3.connect(filename, timeout=self.TIMEOUT,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # WAL is safe against corruption with NORMAL, and only the last
+        # commits can be lost on a power failure
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            self._conn.execute('CREATE TABLE IF NOT EXISTS status ('
+                               'recipe TEXT PRIMARY KEY, steps TEXT, '
+                               'needs_build INTEGER, mtime REAL, '
+                               'filepath TEXT, built_version TEXT, '
+                               'file_hash BLOB)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                               'key TEXT PRIMARY KEY, value TEXT)')
+
+    def load(self):
+        '''
+        Loads the status of all the recipes
+
+        @return: recipe name -> dict with the fields of the status
+        @rtype: dict
+        '''
+        status = {}
+        cur = self._conn.execute('SELECT recipe, %s FROM status' %
+                                 ', '.join(self.FIELDS))
+        for row in cur:
+            steps, needs_build, mtime, filepath, built_version, file_hash = \
+                row[1:]
+            status[row[0]] = {
+                'steps': json.loads(steps),
+                'needs_build': bool(needs_build),
+                'mtime': mtime,
+                'filepath': filepath,
+                'built_version': built_version,
+                'file_hash': file_hash if file_hash is not None else 0}
+        return status
+
+    def put(self, recipe_name, status):
+        '''
+        Stores the status of a recipe
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        @param status: the status
+        @type status: L{cerbero.build.cookbook.RecipeStatus}
+        '''
+        with self._transaction():
+            self._put(recipe_name, status)
+
+    def put_all(self, status, removed=()):
+        '''
+        Stores and removes the status of several recipes in a single
+        transaction
+
+        @param status: recipe name -> L{cerbero.build.cookbook.RecipeStatus}
+        @type status: dict
+        @param removed: names of the recipes to remove
+        @type removed: list
+        '''
+        with self._transaction():
+            for recipe_name, st in status.items():
+                self._put(recipe_name, st)
+            for recipe_name in removed:
+                self._conn.execute('DELETE FROM status WHERE recipe = ?',
+                                   (recipe_name,))
+
+    def delete(self, recipe_name):
+        '''
+        Removes the status of a recipe
+
+        @param recipe_name: name of the recipe
+        @type recipe_name: str
+        '''
+        with self._transaction():
+            self._conn.execute('DELETE FROM status WHERE recipe = ?',
+                               (recipe_name,))
+
+    def import_pickle(self, filename):
+        '''
+        Imports the status from the pickle file used by older versions, only
+        the first time the database is used
+
+        @param filename: path of the pickle file
+        @type filename: str
+        @return: whether the status was imported
+        @rtype: bool
+        '''
+        with self._transaction():
+            if self._get_meta('imported') is not None:
+                return False
+            self._set_meta('imported', filename)
+            if not os.path.isfile(filename):
+                return False
+            with open(filename, 'rb') as f:
+                status = pickle.load(f)
+            for recipe_name, st in status.items():
+                self._put(recipe_name, st)
+        return True
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def row(status):
+        '''
+        Gets the values stored for the status of a recipe
+
+        @param status: the status
+        @type status: L{cerbero.build.cookbook.RecipeStatus}
+        @return: the values of the L{FIELDS}
+        @rtype: tuple
+        '''
+        return (json.dumps(list(status.steps)), int(bool(status.needs_build)),
+                status.mtime, getattr(status, 'filepath', None),
+                getattr(status, 'built_version', None),
+                getattr(status, 'file_hash', 0) or None)
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at the start of the transaction
+        # so that concurrent writers wait instead of failing on commit
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def _put(self, recipe_name, status):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO status (recipe, %s) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)' % ', '.join(self.FIELDS),
+            (recipe_name,) + self.row(status))
+
+    def _get_meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?',
+                                 (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) '
+                           'VALUES (?, ?)', (key, value))
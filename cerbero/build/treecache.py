@@ -0,0 +1,187 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from cerbero.build.sourcestore import reflink
+from cerbero.utils import _
+from cerbero.utils import messages as m
+from cerbero.utils.digests import file_digest
+
+
+# Bump to invalidate the cached trees when the way they are created changes
+TREE_CACHE_VERSION = 1
+# Git objects are never modified once written, so they can be shared
+GIT_OBJECTS_DIR = os.path.join('.git', 'objects')
+
+
+def copy_tree(src, dest):
+    '''
+    Copies a source tree, keeping the modification times of the files so
+    that the build systems don't regenerate them.
+
+    Files are reflinked when the filesystem supports it and copied
+    otherwise. Work tree files are never hardlinked, as builds in the source
+    dir modify them in place, but the git objects are, since they are
+    immutable.
+
+    @param src: tree to copy
+    @type src: str
+    @param dest: destination, which must not exist
+    @type dest: str
+    '''
+    use_reflink = True
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dest_root = os.path.normpath(os.path.join(dest, rel))
+        os.makedirs(dest_root)
+        in_objects = rel == GIT_OBJECTS_DIR or \
+            rel.startswith(GIT_OBJECTS_DIR + os.sep)
+        for name in [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            # os.walk doesn't follow symlinks to directories, copy them as
+            # links
+            dirs.remove(name)
+            files.append(name)
+        for name in files:
+            s = os.path.join(root, name)
+            d = os.path.join(dest_root, name)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), d)
+                continue
+            if in_objects:
+                try:
+                    os.link(s, d)
+                    continue
+                except OSError:
+                    pass
+            if use_reflink:
+                try:
+                    reflink(s, d)
+                    shutil.copystat(s, d)
+                    continue
+                except OSError:
+                    # Don't try again for every file
+                    use_reflink = False
+            shutil.copy2(s, d)
+        shutil.copystat(root, dest_root)
+
+
+class SourceTreeCache (object):
+    '''
+    Cache of the source trees of the tarball recipes as left by the extract
+    step: extracted, committed to git and with the patches applied.
+
+    Trees are keyed by the checksum of the tarball, the contents of the
+    patches in the order they are applied and the strip level, so that the
+    cache can be shared by all the configurations of the host.
+
+    @ivar path: directory of the cache
+    @type path: str
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(tarball_checksum, patches, strip):
+        '''
+        Gets the key of a source tree
+
+        @param tarball_checksum: SHA-256 of the tarball
+        @type tarball_checksum: str
+        @param patches: paths of the patches, in the order they are applied
+        @type patches: list
+        @param strip: strip level of the patches
+        @type strip: int
+        @return: the key
+        @rtype: str
+        '''
+        h = hashlib.sha256()
+        h.update(('%d\n%s\n%d\n' % (TREE_CACHE_VERSION, tarball_checksum,
+                                    strip)).encode())
+        for patch in patches:
+            h.update(file_digest(patch, 'sha256'))
+        return h.hexdigest()
+
+    def tree_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, dest):
+        '''
+        Materializes a cached source tree
+
+        @param key: key of the tree
+        @type key: str
+        @param dest: path of the source tree, which must not exist
+        @type dest: str
+        @return: whether the tree was in the cache
+        @rtype: bool
+        '''
+        tree = self.tree_path(key)
+        if not os.path.isdir(tree):
+            return False
+        try:
+            copy_tree(tree, dest)
+        except OSError as ex:
+            m.warning(_("Could not restore the source tree %s: %s") %
+                      (dest, ex))
+            shutil.rmtree(dest, ignore_errors=True)
+            return False
+        # Mark it as recently used
+        os.utime(tree)
+        return True
+
+    def put(self, key, src):
+        '''
+        Stores a source tree
+
+        @param key: key of the tree
+        @type key: str
+        @param src: path of the source tree
+        @type src: str
+        '''
+        tree = self.tree_path(key)
+        if os.path.isdir(tree):
+            return
+        os.makedirs(os.path.dirname(tree), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(tree))
+        try:
+            copy_tree(src, os.path.join(tmpdir, 'tree'))
+            os.replace(os.path.join(tmpdir, 'tree'), tree)
+        except OSError as ex:
+            # Another process stored it first or the disk is full
+            if not os.path.isdir(tree):
+                m.warning(_("Could not store the source tree %s: %s") %
+                          (src, ex))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_source_tree_cache(config):
+    '''
+    Gets the cache configured with the source_tree_cache property
+
+    @return: the cache or None if it's disabled
+    @rtype: L{cerbero.build.treecache.SourceTreeCache}
+    '''
+    if not config.source_tree_cache:
+        return None
+    return SourceTreeCache(config.source_tree_cache)
@@ -90,6 +90,7 @@ class Fetch(Command):
 
         # Checking the current built version against the fetched one
         # needs to be done *after* actually fetching
+        cookbook.resolve_git_hashes(fetch_recipes)
         for recipe in fetch_recipes:
             bv = cookbook.recipe_built_version(recipe.name)
             cv = recipe.built_version()
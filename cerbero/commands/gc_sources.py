@@ -0,0 +1,57 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+from cerbero.commands import Command, register_command
+from cerbero.build.sourcestore import get_source_store
+from cerbero.errors import FatalError
+from cerbero.utils import _, N_, ArgparseArgument
+import cerbero.utils.messages as m
+
+
+class GCSources(Command):
+    doc = N_('Removes the tarballs of the source store that are no longer '
+             'used by any recipe')
+    name = 'gc-sources'
+
+    def __init__(self):
+        Command.__init__(self, [
+                ArgparseArgument('--dry-run', action='store_true',
+                    default=False,
+                    help=_('only list the tarballs that would be removed')),
+                ])
+
+    def run(self, config, args):
+        store = get_source_store(config)
+        if store is None:
+            raise FatalError(_("The source store is not enabled, set the "
+                               "source_store property in the configuration"))
+        removed = store.gc(args.dry_run)
+        msg = _("Would remove %s (%d KiB)") if args.dry_run else \
+            _("Removed %s (%d KiB)")
+        for checksum, size in removed:
+            m.action(msg % (checksum, size // 1024))
+        total = sum(size for checksum, size in removed) // (1024 * 1024)
+        if args.dry_run:
+            m.message(_("%d tarballs would be removed, freeing %d MiB") %
+                      (len(removed), total))
+        else:
+            m.message(_("Removed %d tarballs, freeing %d MiB") %
+                      (len(removed), total))
+
+
+register_command(GCSources)
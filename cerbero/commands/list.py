@@ -36,6 +36,7 @@ class List(Command):
         recipes = cookbook.get_recipes_list()
         if len(recipes) == 0:
             m.message(_("No recipes found"))
+        cookbook.resolve_git_hashes(recipes)
         for recipe in recipes:
             try:
                 current = recipe.built_version().split("\n")[0]
@@ -31,13 +31,17 @@ class RDeps(Command):
         Command.__init__(self,
             [ArgparseArgument('recipe', nargs=1,
                              help=_('name of the recipe')),
+            ArgparseArgument('--transitive', action='store_true',
+                default=False,
+                help=_('list also the recipes depending on it indirectly')),
             ])
 
     def run(self, config, args):
         cookbook = CookBook(config)
         recipe_name = args.recipe[0]
 
-        recipes = cookbook.list_recipe_reverse_deps(recipe_name)
+        recipes = cookbook.list_recipe_reverse_deps(recipe_name,
+                                                    args.transitive)
         if len(recipes) == 0:
             m.error(_('%s has 0 reverse dependencies') % recipe_name)
             return
@@ -176,9 +176,18 @@ class Config (object):
                    'extra_properties', 'qt5_qmake_path', 'qt5_pkgconfigdir',
                    'for_shell', 'package_tarball_compression', 'extra_mirrors',
                    'extra_bootstrap_packages', 'moltenvk_prefix',
-                   'vs_install_path', 'vs_install_version']
+                   'vs_install_path', 'vs_install_version', 'staged_install',
+                   'snapshot_installs', 'admission_control', 'artifact_cache',
+                   'artifact_cache_max_size', 'recipes_cache',
+                   'status_db', 'native_downloads', 'mirror_ranking',
+                   'source_store', 'stream_extract', 'source_tree_cache',
+                   'git_object_store', 'git_fetch_mode']
 
     cookbook = None
+    # Attributes referencing other configs, which are not copied in _copy()
+    _COPY_REFERENCES = ('arch_config', 'build_tools_config', 'cookbook')
+    # Containers that are never modified once the config is created
+    _COPY_SHARED = ('_pre_environ',)
 
     def __init__(self, is_build_tools_config=False):
         self._check_uninstalled()
@@ -195,8 +204,19 @@ class Config (object):
         self.config_env = os.environ.copy()
 
     def _copy(self, arch):
-        c = copy.deepcopy(self)
+        # Values that can't be modified in place are shared with the copy,
+        # only containers get their own copy since config files modify them
+        # in place, like 'env' (config_env). The references to other configs
+        # are set for each copy and the containers that are never modified
+        # are shared.
+        c = copy.copy(self)
+        for name, value in self.__dict__.items():
+            if name in self._COPY_REFERENCES or name in self._COPY_SHARED:
+                continue
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                c.__dict__[name] = copy.deepcopy(value)
         c.target_arch = arch
+        c.arch_config = {arch: c}
         return c
 
     def can_use_msvc(self):
@@ -287,6 +307,9 @@ class Config (object):
             m.warning(_("gobject introspection requires an executable "
                         "prefix, 'gi' variant will be removed"))
             self.variants.gi = False
+        if self.stream_extract and not self.native_downloads:
+            m.warning(_("stream_extract requires native_downloads, tarballs "
+                        "will be extracted after they are downloaded"))
 
         for c in list(self.arch_config.values()):
             c.variants = self.variants
@@ -548,6 +571,20 @@ class Config (object):
         self.set_property('packages_dir', self._relative_path('packages'))
         self.set_property('allow_system_libs', True)
         self.set_property('use_configure_cache', False)
+        self.set_property('staged_install', False)
+        self.set_property('snapshot_installs', False)
+        self.set_property('admission_control', False)
+        self.set_property('artifact_cache', None)
+        self.set_property('artifact_cache_max_size', 20)
+        self.set_property('recipes_cache', False)
+        self.set_property('status_db', False)
+        self.set_property('native_downloads', False)
+        self.set_property('mirror_ranking', False)
+        self.set_property('source_store', None)
+        self.set_property('stream_extract', False)
+        self.set_property('source_tree_cache', None)
+        self.set_property('git_object_store', None)
+        self.set_property('git_fetch_mode', None)
         self.set_property('external_recipes', {})
         self.set_property('external_packages', {})
         self.set_property('universal_archs', None)
@@ -678,6 +715,13 @@ class Config (object):
         self.build_tools_config.build_tools_cache = self.build_tools_cache
         self.build_tools_config.external_recipes = self.external_recipes
         self.build_tools_config.extra_mirrors = self.extra_mirrors
+        self.build_tools_config.native_downloads = self.native_downloads
+        self.build_tools_config.mirror_ranking = self.mirror_ranking
+        self.build_tools_config.source_store = self.source_store
+        self.build_tools_config.stream_extract = self.stream_extract
+        self.build_tools_config.source_tree_cache = self.source_tree_cache
+        self.build_tools_config.git_object_store = self.git_object_store
+        self.build_tools_config.git_fetch_mode = self.git_fetch_mode
         self.build_tools_config.cached_sources = self.cached_sources
         self.build_tools_config.vs_install_path = self.vs_install_path
         self.build_tools_config.vs_install_version = self.vs_install_version
@@ -705,6 +749,9 @@ class Config (object):
         if not validate_packager(self.packager):
             raise FatalError(_('packager "%s" must be in the format '
                                '"Name <email>"') % self.packager)
+        if self.git_fetch_mode not in (None, 'shallow', 'partial'):
+            raise FatalError(_('git_fetch_mode must be "shallow" or '
+                               '"partial", not "%s"') % self.git_fetch_mode)
 
     def _check_windows_is_x86_64(self):
          if self.target_platform == Platform.WINDOWS and \
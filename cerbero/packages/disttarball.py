@@ -27,6 +27,7 @@ from cerbero.enums import Platform, Distro
 from cerbero.errors import FatalError, UsageError, EmptyPackageError
 from cerbero.packages import PackagerBase, PackageType
 from cerbero.tools import strip
+from cerbero.build.sourcestore import link_or_copy
 
 
 class DistTarball(PackagerBase):
@@ -116,14 +117,25 @@ class DistTarball(PackagerBase):
         else:
             s = strip.Strip(self.config)
 
+        # Strip the objects into the staging tree and link the rest of the
+        # files, which are not modified
+        to_strip = []
         for f in files:
             orig_file = os.path.join(self.prefix, f)
             tmp_file = os.path.join(tmpdir, f)
             tmp_file_dir = os.path.dirname(tmp_file)
             if not os.path.exists(tmp_file_dir):
                 os.makedirs(tmp_file_dir)
-            shutil.copy(orig_file, tmp_file, follow_symlinks=False)
-            s.strip_file(tmp_file)
+            if strip.is_strippable(orig_file) and not s.is_excluded(orig_file):
+                to_strip.append((orig_file, tmp_file))
+            elif os.path.islink(orig_file):
+                os.symlink(os.readlink(orig_file), tmp_file)
+            else:
+                link_or_copy(orig_file, tmp_file)
+        stripped = s.strip_files(to_strip)
+        for (orig_file, tmp_file), ok in zip(to_strip, stripped):
+            if not ok:
+                link_or_copy(orig_file, tmp_file)
 
         prefix_restore = self.prefix
         self.prefix = tmpdir
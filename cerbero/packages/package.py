@@ -18,11 +18,101 @@
 
 import os
 import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from cerbero.build.filesprovider import FilesProvider
 from cerbero.enums import License, Platform
 from cerbero.packages import PackageType
-from cerbero.utils import remove_list_duplicates, messages as m
+from cerbero.utils import remove_list_duplicates, determine_num_of_cpus
+from cerbero.utils import messages as m
+
+
+def resolve_files_queries(cookbook, queries, jobs=None):
+    '''
+    Lists the files of several recipes at the same time. Listing them is
+    mostly spent globbing the prefix and, on Windows, running the tools
+    that read the DLL names from the import libraries, so the recipes are
+    resolved in a pool of threads. The queries of the same recipe run in the
+    same thread, in order, reusing the files cached by the recipe.
+
+    @param cookbook: cookbook with the recipes
+    @type cookbook: L{cerbero.build.cookbook.CookBook}
+    @param queries: list of (recipe_name, method_name, args) where method_name
+                    is a method of L{cerbero.build.filesprovider.FilesProvider}
+                    returning a list of files
+    @type queries: list
+    @param jobs: number of threads
+    @type jobs: int
+    @return: sorted list of the files, without duplicates
+    @rtype: list
+    '''
+    by_recipe = OrderedDict()
+    for recipe_name, method, args in queries:
+        recipe_queries = by_recipe.setdefault(recipe_name, [])
+        if (method, args) not in recipe_queries:
+            recipe_queries.append((method, args))
+    # Look up the methods here, loading the recipes restored from the recipes
+    # cache in this thread
+    calls = []
+    for recipe_name, recipe_queries in by_recipe.items():
+        recipe = cookbook.get_recipe(recipe_name)
+        calls.append([(getattr(recipe, method), args)
+                      for method, args in recipe_queries])
+
+    def run(recipe_calls):
+        files = []
+        for func, args in recipe_calls:
+            files.extend(func(*args))
+        return files
+
+    files = set()
+    if len(calls) <= 1:
+        for recipe_calls in calls:
+            files.update(run(recipe_calls))
+        return sorted(files)
+    jobs = min(jobs or determine_num_of_cpus(), len(calls))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # results are collected in the order of the queries, which raises
+        # the same error a sequential listing would raise first
+        for result in list(executor.map(run, calls)):
+            files.update(result)
+    return sorted(files)
+
+
+# methods listing the files of a package and the methods getting the queries
+# they resolve
+_FILES_QUERIES = {'files_list': 'files_queries',
+                  'devel_files_list': 'devel_files_queries'}
+
+
+def list_files_or_queries(packages, methods):
+    '''
+    Lists the files of several packages, getting the queries of the packages
+    that list their files from their recipes so that they can be resolved at
+    once with L{resolve_files_queries}. Packages overriding the methods
+    listing their files are listed with their own methods.
+
+    @param packages: list of packages
+    @type packages: list
+    @param methods: list of methods listing the files, 'files_list' or
+                    'devel_files_list'
+    @type methods: list
+    @return: tuple with the list of files and the list of queries
+    @rtype: tuple
+    '''
+    files = []
+    queries = []
+    for p in packages:
+        for method in methods:
+            queries_method = _FILES_QUERIES.get(method, None)
+            if queries_method is None or \
+                    getattr(type(p), method, None) is not \
+                    getattr(Package, method):
+                files.extend(getattr(p, method)())
+            else:
+                queries.extend(getattr(p, queries_method)())
+    return files, queries
 
 
 class PackageBase(object):
@@ -302,32 +392,49 @@ class Package(PackageBase):
         return licenses
 
     def files_list(self):
-        files = []
+        return resolve_files_queries(self.cookbook, self.files_queries())
+
+    def devel_files_list(self):
+        return resolve_files_queries(self.cookbook,
+                                     self.devel_files_queries())
+
+    def files_queries(self):
+        '''
+        Gets the queries listing the files of the package in its recipes
+
+        @return: list of (recipe_name, method_name, args)
+        @rtype: list
+        '''
+        queries = []
         for recipe_name, categories in self._recipes_files.items():
-            recipe = self.cookbook.get_recipe(recipe_name)
             if len(categories) == 0:
-                rfiles = recipe.dist_files_list()
+                queries.append((recipe_name, 'dist_files_list', ()))
             else:
-                rfiles = recipe.files_list_by_categories(categories)
-            files.extend(rfiles)
-        return sorted(list(set(files)))
+                queries.append((recipe_name, 'files_list_by_categories',
+                                (tuple(categories),)))
+        return queries
 
-    def devel_files_list(self):
-        files = []
-        for recipe, categories in self._recipes_files.items():
+    def devel_files_queries(self):
+        '''
+        Gets the queries listing the development files of the package in its
+        recipes
+
+        @return: list of (recipe_name, method_name, args)
+        @rtype: list
+        '''
+        queries = []
+        for recipe_name, categories in self._recipes_files.items():
             # only add development files for recipe from which used the 'libs'
             # category
             if len(categories) == 0 or FilesProvider.LIBS_CAT in categories:
-                rfiles = self.cookbook.get_recipe(recipe).devel_files_list()
-                files.extend(rfiles)
-        for recipe, categories in self._recipes_files_devel.items():
-            recipe = self.cookbook.get_recipe(recipe)
+                queries.append((recipe_name, 'devel_files_list', ()))
+        for recipe_name, categories in self._recipes_files_devel.items():
             if not categories:
-                rfiles = recipe.devel_files_list()
+                queries.append((recipe_name, 'devel_files_list', ()))
             else:
-                rfiles = recipe.files_list_by_categories(categories)
-            files.extend(rfiles)
-        return sorted(list(set(files)))
+                queries.append((recipe_name, 'files_list_by_categories',
+                                (tuple(categories),)))
+        return queries
 
     def all_files_list(self):
         files = self.files_list()
@@ -417,25 +524,26 @@ class MetaPackage(PackageBase):
         return remove_list_duplicates(deps)
 
     def files_list(self):
-        return self._list_files(Package.files_list)
+        return self._list_files('files_list')
 
     def devel_files_list(self):
-        return self._list_files(Package.devel_files_list)
+        return self._list_files('devel_files_list')
 
     def all_files_list(self):
-        return self._list_files(Package.all_files_list)
+        return self._list_files('files_list', 'devel_files_list')
 
     def get_wix_upgrade_code(self):
         m = self.package_mode
         p = self.config.target_arch
         return self.wix_upgrade_code[m][p]
 
-    def _list_files(self, func):
-        # for each package, call the function that list files
-        files = []
-        for package in self.store.get_package_deps(self.name):
-            files.extend(func(package))
-        return sorted(list(set(files)))
+    def _list_files(self, *methods):
+        # for each package, get the queries listing its files and resolve
+        # the queries of all the packages at once
+        files, queries = list_files_or_queries(
+            self.store.get_package_deps(self.name), methods)
+        files.extend(resolve_files_queries(self.store.cookbook, queries))
+        return sorted(set(files))
 
     def __getattribute__(self, name):
         if name == 'packages':
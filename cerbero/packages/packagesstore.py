@@ -140,9 +140,9 @@ class PackagesStore (object):
         return remove_list_duplicates(deps)
 
     def _list_metapackage_files(self, metapackage):
-        l = []
-        for p in self._list_metapackage_deps(metapackage):
-            l.extend(p.files_list())
+        l, queries = package.list_files_or_queries(
+            self._list_metapackage_deps(metapackage), ['files_list'])
+        l.extend(package.resolve_files_queries(self.cookbook, queries))
         # remove duplicates and sort
         return sorted(list(set(l)))
 
@@ -0,0 +1,166 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import os
+import struct
+
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+# Header of the short import objects of MSVC and LLVM import libraries:
+# Sig1 = 0, Sig2 = 0xffff, Version = 0
+SHORT_IMPORT_MAGIC = b'\x00\x00\xff\xff\x00\x00'
+SHORT_IMPORT_HEADER_SIZE = 20
+COFF_HEADER_SIZE = 20
+COFF_SECTION_SIZE = 40
+# Section of the objects of GNU import libraries holding the DLL name
+GNU_DLLNAME_SECTION = b'.idata$7'
+
+# (path, mtime, size) -> DLL name
+_dllnames = {}
+
+
+def ar_members(data):
+    '''
+    Iterates over the members of an ar archive
+
+    @param data: contents of the archive
+    @type data: bytes
+    @return: iterator of (name, contents of the member)
+    @rtype: iterator
+    '''
+    if not data.startswith(AR_MAGIC):
+        raise ValueError('Not an ar archive')
+    longnames = b''
+    offset = len(AR_MAGIC)
+    while offset + AR_HEADER_SIZE <= len(data):
+        header = data[offset:offset + AR_HEADER_SIZE]
+        if header[58:60] != b'`\n':
+            raise ValueError('Invalid ar member header')
+        name = header[:16].rstrip(b' ')
+        size = int(header[48:58])
+        start = offset + AR_HEADER_SIZE
+        content = data[start:start + size]
+        # members are aligned to 2 bytes
+        offset = start + size + (size % 2)
+        if name == b'//':
+            longnames = content
+            continue
+        if name == b'/' or name == b'/SYM64/':
+            # symbol tables
+            continue
+        if name.startswith(b'/') and name[1:].isdigit():
+            start = int(name[1:])
+            end = len(longnames)
+            for sep in (b'/\n', b'\x00'):
+                i = longnames.find(sep, start)
+                if i != -1:
+                    end = min(end, i)
+            name = longnames[start:end]
+        elif name.endswith(b'/'):
+            name = name[:-1]
+        yield name.decode('utf-8', 'replace'), content
+
+
+def _short_import_dllname(content):
+    # The import name and the DLL name follow the header, NUL-terminated
+    strings = content[SHORT_IMPORT_HEADER_SIZE:].split(b'\x00')
+    if len(strings) < 2 or not strings[1]:
+        return None
+    return strings[1].decode('utf-8', 'replace')
+
+
+def _coff_section(content, section_name):
+    # Gets the raw data of a section of a COFF object, or None
+    if len(content) < COFF_HEADER_SIZE:
+        return None
+    nsections = struct.unpack_from('<H', content, 2)[0]
+    optional_size = struct.unpack_from('<H', content, 16)[0]
+    offset = COFF_HEADER_SIZE + optional_size
+    for i in range(nsections):
+        header = content[offset:offset + COFF_SECTION_SIZE]
+        if len(header) < COFF_SECTION_SIZE:
+            return None
+        if header[:8].rstrip(b'\x00') == section_name:
+            size, pointer = struct.unpack_from('<II', header, 16)
+            return content[pointer:pointer + size]
+        offset += COFF_SECTION_SIZE
+    return None
+
+
+def read_dllname(path):
+    '''
+    Reads the name of the DLL of an import library without running dlltool
+    or lib.exe. GNU import libraries (.dll.a) store it in the .idata$7
+    section of one of their objects, while MSVC and LLVM import libraries
+    (.lib) store it in their short import objects or as the name of their
+    members.
+
+    @param path: path of the import library
+    @type path: str
+    @return: the name of the DLL or None if it can't be found
+    @rtype: str
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        members = list(ar_members(data))
+    except ValueError:
+        return None
+    names = []
+    for name, content in members:
+        if content.startswith(SHORT_IMPORT_MAGIC):
+            dllname = _short_import_dllname(content)
+            if dllname:
+                return dllname
+            continue
+        section = _coff_section(content, GNU_DLLNAME_SECTION)
+        if section:
+            # the .idata$7 sections of the other objects only hold
+            # relocations
+            try:
+                dllname = section.split(b'\x00', 1)[0].decode('ascii')
+            except UnicodeDecodeError:
+                continue
+            if dllname and dllname.isprintable():
+                names.append(dllname)
+    if names:
+        return names[-1]
+    # MSVC import libraries with long import objects, like lib.exe -list
+    names = [n for n, c in members if n.lower().endswith('.dll')]
+    if names:
+        return names[-1]
+    return None
+
+
+def get_dllname(path):
+    '''
+    Gets the name of the DLL of an import library, memoized by the path,
+    modification time and size of the library
+
+    @param path: path of the import library
+    @type path: str
+    @return: the name of the DLL or None if it can't be found
+    @rtype: str
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if key not in _dllnames:
+        _dllnames[key] = read_dllname(path)
+    return _dllnames[key]
@@ -20,8 +20,41 @@
 import os
 import asyncio
 import shlex
+import struct
 from cerbero.config import Platform
-from cerbero.utils import shell, run_until_complete, messages as m
+from cerbero.utils import shell, run_until_complete, determine_num_of_cpus
+from cerbero.utils import messages as m
+
+
+ELF_MAGIC = b'\x7fELF'
+MACHO_MAGICS = (b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf',
+                b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe')
+MACHO_FAT_MAGIC = b'\xca\xfe\xba\xbe'
+PE_MAGIC = b'MZ'
+AR_MAGIC = b'!<arch>\n'
+
+
+def is_strippable(path):
+    '''
+    Whether a file is an object that can be stripped (ELF, Mach-O or PE
+    binaries and ar archives), looking at its magic bytes. Symbolic links
+    are never strippable, their targets are stripped instead.
+
+    @param path: path of the file
+    @type path: str
+    @rtype: bool
+    '''
+    if os.path.islink(path) or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+    if magic.startswith((ELF_MAGIC, PE_MAGIC, AR_MAGIC) + MACHO_MAGICS):
+        return True
+    if magic.startswith(MACHO_FAT_MAGIC) and len(magic) == 8:
+        # Java classes use the same magic followed by their version, which
+        # is much bigger than the number of archs of a fat binary
+        return struct.unpack('>I', magic[4:])[0] < 20
+    return False
 
 
 class Strip(object):
@@ -35,38 +68,79 @@ class Strip(object):
         if 'STRIP' in config.env:
             self.strip_cmd = shlex.split(config.env['STRIP'])
 
-    async def _async_strip_file(self, path):
+    def is_excluded(self, path):
+        for f in self.excludes:
+            if f in path:
+                return True
+        return False
+
+    async def _async_strip_file(self, path, output=None):
         if not self.strip_cmd:
             m.warning('Strip command is not defined')
-            return
+            return False
 
-        for f in self.excludes:
-            if f in path:
-                return
+        if self.is_excluded(path):
+            return False
 
         if self.config.target_platform == Platform.DARWIN:
-            cmd = self.strip_cmd + ['-x', path]
+            cmd = self.strip_cmd + ['-x']
         else:
             cmd = self.strip_cmd[:]
             for symbol in self.keep_symbols:
                 cmd += ['-K', symbol]
-            cmd += ['--strip-unneeded', path]
+            cmd += ['--strip-unneeded']
+        if output is not None:
+            cmd += ['-o', output]
+        cmd += [path]
 
         try:
             await shell.async_call(cmd)
         except Exception as e:
             m.warning(e)
+            return False
+        return True
 
     def strip_file(self, path):
         run_until_complete(self._async_strip_file(path))
 
+    def strip_files(self, files, jobs=None):
+        '''
+        Strips several files at the same time, running at most C{jobs} strip
+        processes
+
+        @param files: list of (path, output) tuples, where output is the path
+                      where the stripped file is written, or None to strip it
+                      in place
+        @type files: list
+        @param jobs: maximum number of strip processes
+        @type jobs: int
+        @return: whether each file was stripped
+        @rtype: list
+        '''
+        if not files:
+            return []
+
+        async def strip_all():
+            semaphore = asyncio.Semaphore(jobs or determine_num_of_cpus())
+
+            async def strip(path, output):
+                async with semaphore:
+                    return await self._async_strip_file(path, output)
+
+            return await asyncio.gather(*[strip(path, output)
+                                          for path, output in files])
+
+        return run_until_complete(strip_all())
+
     def strip_dir(self, dir_path):
         if not self.strip_cmd:
             m.warning('Strip command is not defined')
             return
 
-        tasks = []
+        files = []
         for dirpath, dirnames, filenames in os.walk(dir_path):
             for f in filenames:
-                tasks.append(self._async_strip_file(os.path.join(dirpath, f)))
-        run_until_complete(tasks)
+                path = os.path.join(dirpath, f)
+                if is_strippable(path):
+                    files.append((path, None))
+        self.strip_files(files)
@@ -424,11 +424,24 @@ def remove_list_duplicates(seq):
     return [x for x in seq if x not in seen and not seen_add(x)]
 
 
+# (filename, mtime, size) -> code object of the files parsed with parse_file()
+_code_cache = {}
+
+
+def _compile_file(filename):
+    st = os.stat(filename)
+    key = (filename, st.st_mtime_ns, st.st_size)
+    if key not in _code_cache:
+        with open(filename) as f:
+            _code_cache[key] = compile(f.read(), filename, 'exec')
+    return _code_cache[key]
+
+
 def parse_file(filename, dict):
     if '__file__' not in dict:
         dict['__file__'] = filename
     try:
-        exec(compile(open(filename).read(), filename, 'exec'), dict)
+        exec(_compile_file(filename), dict)
     except Exception as ex:
         import traceback
         traceback.print_exc()
@@ -0,0 +1,176 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import atexit
+import pickle
+import hashlib
+
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+DIGESTS_FILE = 'digests.cache'
+DEFAULT_ALGORITHM = 'blake2b'
+BLOCK_SIZE = 1024 * 1024
+# A file modified again in the same timestamp tick, with the same size, would
+# keep its stat data, so files modified this recently are not cached
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+
+def _new_hash(algorithm):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
+
+
+def file_digest(path, algorithm=DEFAULT_ALGORITHM):
+    '''
+    Gets the digest of a file, reading it in blocks
+
+    @param path: path of the file
+    @type path: str
+    @param algorithm: hashlib algorithm
+    @type algorithm: str
+    @return: the digest
+    @rtype: bytes
+    '''
+    h = _new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.digest()
+
+
+class DigestCache (object):
+    '''
+    Persistent cache of the digests of files, keyed by their path and their
+    size, modification time and inode, so that files are only read again when
+    they change
+
+    @ivar filename: path of the cache
+    @type filename: str
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._digests = {}  # (path, algorithm) -> (stat key, digest)
+        self._changed = False
+        self._load()
+
+    def get(self, path, algorithm=DEFAULT_ALGORITHM):
+        '''
+        Gets the digest of a file
+
+        @param path: path of the file
+        @type path: str
+        @param algorithm: hashlib algorithm
+        @type algorithm: str
+        @return: the digest
+        @rtype: bytes
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        entry = self._digests.get((path, algorithm), None)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        digest = file_digest(path, algorithm)
+        if time.time_ns() - st.st_mtime_ns > RACY_INTERVAL_NS:
+            self._digests[(path, algorithm)] = (key, digest)
+            self._changed = True
+        return digest
+
+    def put(self, path, digest, algorithm=DEFAULT_ALGORITHM):
+        '''
+        Stores the digest of a file computed while it was written, such as
+        a downloaded file
+
+        @param path: path of the file
+        @type path: str
+        @param digest: the digest
+        @type digest: bytes
+        @param algorithm: hashlib algorithm
+        @type algorithm: str
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self._digests[(path, algorithm)] = (key, digest)
+        self._changed = True
+
+    def files_checksum(self, paths):
+        '''
+        Gets a checksum of the contents of several files
+
+        @param paths: list of paths
+        @type paths: list
+        @return: the checksum
+        @rtype: bytes
+        '''
+        h = _new_hash(DEFAULT_ALGORITHM)
+        for path in paths:
+            h.update(self.get(path))
+        return h.digest()
+
+    def save(self):
+        if not self._changed:
+            return
+        # Forget the files that no longer exist
+        for k in [k for k in self._digests if not os.path.exists(k[0])]:
+            del self._digests[k]
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(self._digests, f)
+            os.replace(tmp, self.filename)
+            self._changed = False
+        except IOError as ex:
+            m.warning(_("Could not save the digests cache: %s") % ex)
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                self._digests = pickle.load(f)
+        except Exception:
+            m.warning(_("Could not recover the digests cache"))
+
+
+_caches = {}
+
+
+def _save_caches():
+    for cache in _caches.values():
+        cache.save()
+
+
+def get_digest_cache(config):
+    '''
+    Gets the shared L{cerbero.utils.digests.DigestCache} stored in the home
+    dir of a configuration, which is saved when the process exits
+    '''
+    filename = os.path.join(config.home_dir, DIGESTS_FILE)
+    if filename not in _caches:
+        if not _caches:
+            atexit.register(_save_caches)
+        _caches[filename] = DigestCache(filename)
+    return _caches[filename]
@@ -0,0 +1,449 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import ssl
+import json
+import time
+import asyncio
+import hashlib
+import urllib.parse
+import urllib.request
+
+from cerbero.utils import CerberoSemaphore
+
+
+BLOCK_SIZE = 64 * 1024
+# Files are split in chunks of at least this size downloaded in parallel
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_REDIRECTS = 10
+TIMEOUT = 20
+# The progress of the chunks is saved every this many bytes
+SAVE_INTERVAL = 4 * 1024 * 1024
+PARTIAL_EXT = '.partial'
+STATE_EXT = '.partial.json'
+# URL schemes supported by the native downloader
+SCHEMES = ('http', 'https')
+
+
+class HTTPError(Exception):
+
+    def __init__(self, url, status, reason=''):
+        Exception.__init__(self, 'HTTP Error {} {}: {}'.format(status, reason,
+                                                               url))
+        self.url = url
+        self.status = status
+
+
+_host_semaphores = {}
+
+
+def _host_semaphore(host):
+    if host not in _host_semaphores:
+        _host_semaphores[host] = CerberoSemaphore(MAX_CONNECTIONS_PER_HOST)
+    return _host_semaphores[host]
+
+
+def can_download(url):
+    '''
+    Whether the URL can be downloaded by the native downloader, which only
+    supports HTTP and HTTPS without proxies
+    '''
+    o = urllib.parse.urlsplit(url)
+    return o.scheme in SCHEMES and not needs_proxy(url)
+
+
+def needs_proxy(url):
+    '''
+    Whether the URL must be downloaded through a proxy, which the native
+    downloader doesn't support
+    '''
+    o = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    return o.scheme in proxies and not urllib.request.proxy_bypass(o.hostname)
+
+
+class Response (object):
+    '''
+    Response of an HTTP request, with the body still to be read
+
+    @ivar url: URL of the response, after following the redirections
+    @type url: str
+    @ivar status: HTTP status
+    @type status: int
+    @ivar headers: headers with their names in lowercase
+    @type headers: dict
+    '''
+
+    def __init__(self, url, status, reason, headers, reader, writer):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+
+    async def iter_body(self):
+        '''
+        Iterates over the blocks of the body
+        '''
+        if 'chunked' in self.headers.get('transfer-encoding', ''):
+            while True:
+                line = await self._read(self._reader.readline())
+                size = int(line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    break
+                while size > 0:
+                    block = await self._read(
+                        self._reader.read(min(size, BLOCK_SIZE)))
+                    if not block:
+                        raise ConnectionError('Connection closed')
+                    size -= len(block)
+                    yield block
+                await self._read(self._reader.readline())
+            return
+        length = self.headers.get('content-length', None)
+        remaining = int(length) if length is not None else None
+        while remaining is None or remaining > 0:
+            size = BLOCK_SIZE if remaining is None else \
+                min(remaining, BLOCK_SIZE)
+            block = await self._read(self._reader.read(size))
+            if not block:
+                if remaining is not None:
+                    raise ConnectionError('Connection closed')
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+
+    def close(self):
+        self._writer.close()
+
+    @staticmethod
+    async def _read(coro):
+        return await asyncio.wait_for(coro, TIMEOUT)
+
+
+async def _open(url, headers, check_cert, user_agent):
+    o = urllib.parse.urlsplit(url)
+    if o.scheme not in SCHEMES:
+        raise ValueError('Unsupported URL {!r}'.format(url))
+    ctx = None
+    if o.scheme == 'https':
+        ctx = ssl.create_default_context()
+        if not check_cert:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+    port = o.port or (443 if o.scheme == 'https' else 80)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(o.hostname, port, ssl=ctx), TIMEOUT)
+    path = urllib.parse.urlunsplit(('', '', o.path or '/', o.query, ''))
+    host = o.hostname if ':' not in o.hostname else '[%s]' % o.hostname
+    if o.port:
+        host += ':%d' % o.port
+    request = ['GET %s HTTP/1.1' % path, 'Host: %s' % host,
+               'User-Agent: %s' % user_agent, 'Accept-Encoding: identity',
+               'Connection: close']
+    request += ['%s: %s' % (k, v) for k, v in headers.items()]
+    writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+    try:
+        line = await asyncio.wait_for(reader.readline(), TIMEOUT)
+        parts = line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ConnectionError('Invalid response from {}'.format(url))
+        status = int(parts[1])
+        reason = parts[2].strip() if len(parts) > 2 else ''
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), TIMEOUT)
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+    except:
+        writer.close()
+        raise
+    return Response(url, status, reason, response_headers, reader, writer)
+
+
+async def request(url, headers=None, check_cert=True, user_agent=''):
+    '''
+    Sends a GET request following the redirections
+
+    @param url: URL to request
+    @type url: str
+    @param headers: additional headers
+    @type headers: dict
+    @return: the response, which must be closed
+    @rtype: L{cerbero.utils.downloader.Response}
+    '''
+    headers = headers or {}
+    for unused in range(MAX_REDIRECTS):
+        response = await _open(url, headers, check_cert, user_agent)
+        if response.status in (301, 302, 303, 307, 308) and \
+                'location' in response.headers:
+            response.close()
+            url = urllib.parse.urljoin(url, response.headers['location'])
+            continue
+        return response
+    raise HTTPError(url, response.status, 'Too many redirections')
+
+
+async def iter_url(url, check_cert=True, user_agent=''):
+    '''
+    Iterates over the blocks of the contents of a URL as they are downloaded
+
+    @param url: URL to download
+    @type url: str
+    '''
+    response = await request(url, None, check_cert, user_agent)
+    try:
+        if response.status != 200:
+            raise HTTPError(response.url, response.status, response.reason)
+        async for block in response.iter_body():
+            yield block
+    finally:
+        response.close()
+
+
+class Download (object):
+    '''
+    Downloads a URL to a file.
+
+    When the server supports range requests, files are split in chunks
+    downloaded in parallel, with at most L{MAX_CONNECTIONS_PER_HOST}
+    connections to the same host, and are written to a partial file that is
+    kept when the download fails, so that the next download resumes it. The
+    progress of the chunks is stored in a state file next to it, with the
+    validator of the file (ETag or Last-Modified) to restart the download if
+    the file changed in the server.
+
+    The SHA-256 of the file is computed while it's downloaded.
+
+    @ivar url: URL to download
+    @type url: str
+    @ivar destination: path of the downloaded file
+    @type destination: str
+    '''
+
+    def __init__(self, url, destination, check_cert=True, logfile=None,
+                 user_agent=''):
+        self.url = url
+        self.destination = destination
+        self.check_cert = check_cert
+        self.logfile = logfile
+        self.user_agent = user_agent
+        self.partial = destination + PARTIAL_EXT
+        self.state_file = destination + STATE_EXT
+        self._host = urllib.parse.urlsplit(url).hostname
+        self._chunks = []  # [start, end, done], end is exclusive
+        self._validator = None
+        self._sha256 = None
+        self._hashed = 0
+        self._fd = None
+
+    async def run(self):
+        '''
+        Downloads the file
+
+        @return: the SHA-256 digest of the file
+        @rtype: bytes
+        '''
+        start_time = time.monotonic()
+        self._sha256 = hashlib.sha256()
+        self._hashed = 0
+        async with _host_semaphore(self._host):
+            # Probe whether the server supports range requests, the response
+            # is used as the download otherwise
+            response = await self._request({'Range': 'bytes=0-0'})
+            try:
+                length = self._content_range_length(response)
+                if response.status == 200 or length is None:
+                    self._remove_state()
+                    await self._download_whole(response)
+                    return self._finish(start_time)
+                validator = response.headers.get('etag', None) or \
+                    response.headers.get('last-modified', None)
+            finally:
+                response.close()
+        self._resume_or_start(length, validator)
+        self._fd = os.open(self.partial, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._update_hash()
+            # Wait for all the chunks before closing the file, even if one
+            # of them fails
+            results = await asyncio.gather(
+                *[self._download_chunk(c) for c in self._chunks],
+                return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._save_state()
+        return self._finish(start_time)
+
+    async def _request(self, headers):
+        response = await request(self.url, headers, self.check_cert,
+                                 self.user_agent)
+        if response.status not in (200, 206):
+            response.close()
+            raise HTTPError(response.url, response.status, response.reason)
+        return response
+
+    def _content_range_length(self, response):
+        # 'bytes 0-0/1234' -> 1234
+        if response.status != 206:
+            return None
+        content_range = response.headers.get('content-range', '')
+        try:
+            length = int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return None
+        return length if length > 0 else None
+
+    def _resume_or_start(self, length, validator):
+        state = None
+        if validator is not None and os.path.isfile(self.partial) and \
+                os.path.isfile(self.state_file):
+            try:
+                with open(self.state_file, 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        if state is not None and state.get('url') == self.url and \
+                state.get('length') == length and \
+                state.get('validator') == validator:
+            self._chunks = state['chunks']
+            resumed = sum(c[2] for c in self._chunks)
+            print('Resuming download of {} at {} bytes'.format(
+                self.url, resumed), file=self.logfile, flush=True)
+        else:
+            n = max(1, min(MAX_CONNECTIONS_PER_HOST, length // CHUNK_SIZE))
+            bounds = [length * i // n for i in range(n + 1)]
+            self._chunks = [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+            with open(self.partial, 'wb'):
+                pass
+        self._validator = validator
+        self._length = length
+        self._save_state()
+
+    async def _download_chunk(self, chunk):
+        start, end, done = chunk
+        if start + done >= end:
+            return
+        headers = {'Range': 'bytes=%d-%d' % (start + done, end - 1)}
+        if self._validator is not None:
+            headers['If-Range'] = self._validator
+        async with _host_semaphore(self._host):
+            response = await self._request(headers)
+            try:
+                if response.status != 206 or \
+                        not response.headers.get('content-range', '').startswith(
+                            'bytes %d-' % (start + done)):
+                    raise HTTPError(response.url, response.status,
+                                    'The file changed in the server')
+                unsaved = 0
+                async for block in response.iter_body():
+                    block = block[:end - start - chunk[2]]
+                    os.pwrite(self._fd, block, start + chunk[2])
+                    chunk[2] += len(block)
+                    self._update_hash(start + chunk[2] - len(block), block)
+                    unsaved += len(block)
+                    if unsaved >= SAVE_INTERVAL:
+                        self._save_state()
+                        unsaved = 0
+                    if start + chunk[2] >= end:
+                        break
+            finally:
+                response.close()
+        if start + chunk[2] < end:
+            raise ConnectionError('Incomplete download of {}'.format(self.url))
+
+    def _update_hash(self, offset=None, block=None):
+        # Hash the data downloaded contiguously from the start of the file,
+        # using the block just downloaded when it follows the hashed data and
+        # reading back the data downloaded by the other chunks otherwise
+        if block is not None and offset == self._hashed:
+            self._sha256.update(block)
+            self._hashed += len(block)
+        prefix = 0
+        for start, end, done in self._chunks:
+            prefix = start + done
+            if prefix < end:
+                break
+        while self._hashed < prefix:
+            data = os.pread(self._fd, min(BLOCK_SIZE, prefix - self._hashed),
+                            self._hashed)
+            self._sha256.update(data)
+            self._hashed += len(data)
+
+    async def _download_whole(self, response):
+        with open(self.partial, 'wb') as f:
+            async for block in response.iter_body():
+                f.write(block)
+                self._sha256.update(block)
+
+    def _finish(self, start_time):
+        os.replace(self.partial, self.destination)
+        self._remove_state()
+        total_time = max(time.monotonic() - start_time, 0.001)
+        size = os.path.getsize(self.destination) / 1024
+        print('Downloaded {:2,.2f} KiB in {:2,.2f} seconds at {:2,.2f} KiB/s'
+              .format(size, total_time, size / total_time),
+              file=self.logfile, flush=True)
+        return self._sha256.digest()
+
+    def _save_state(self):
+        if not self._chunks:
+            return
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'url': self.url, 'length': self._length,
+                       'validator': self._validator,
+                       'chunks': self._chunks}, f)
+        os.replace(tmp, self.state_file)
+
+    def _remove_state(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+
+async def download(url, destination, check_cert=True, overwrite=False,
+                   logfile=None, user_agent='', digests=None):
+    '''
+    Downloads a file with the native downloader
+
+    @param url: url to download
+    @type: str
+    @param destination: destination where the file will be saved
+    @type destination: str
+    @param digests: cache where the SHA-256 of the file is stored, so that
+                    it doesn't need to be read again to verify it
+    @type digests: L{cerbero.utils.digests.DigestCache}
+    @return: the SHA-256 digest of the file
+    @rtype: bytes
+    '''
+    digest = await Download(url, destination, check_cert, logfile,
+                            user_agent).run()
+    if digests is not None:
+        digests.put(destination, digest, 'sha256')
+    return digest
@@ -17,8 +17,13 @@
 # Boston, MA 02111-1307, USA.
 
 import os
+import re
 import time
+import asyncio
+import hashlib
 import shutil
+import subprocess
+from collections import defaultdict
 
 from cerbero.config import Platform
 from cerbero.utils import shell, run_until_complete
@@ -26,6 +31,13 @@ from cerbero.errors import FatalError
 
 
 GIT = 'git'
+SHA_RE = re.compile(r'^[0-9a-f]{7,40}$')
+
+# bare repository of the shared object store -> task fetching it
+_store_fetches = {}
+# (git_dir, commit) -> hash, resolved with resolve_hashes() and forgotten
+# when the repository is modified
+_hashes = {}
 
 
 def ensure_user_is_set(git_dir, logfile=None):
@@ -53,6 +65,7 @@ def init(git_dir, logfile=None):
     os.makedirs(git_dir, exist_ok=True)
     shell.new_call([GIT, 'init'], git_dir, logfile=logfile)
     ensure_user_is_set(git_dir, logfile=logfile)
+    forget_hashes(git_dir)
 
 
 def clean(git_dir, logfile=None):
@@ -129,15 +142,19 @@ async def fetch(git_dir, fail=True, logfile=None):
     # centOS 7 ships with git 1.8.3.1, hence for old git versions, we need to
     # run two separate commands.
     cmd = [GIT, 'fetch', '--all']
-    ret = await shell.async_call(cmd, cmd_dir=git_dir, fail=fail, logfile=logfile, cpu_bound=False)
-    if ret != 0:
-        return ret
-    cmd.append('--tags')
-    # To avoid "would clobber existing tag" error
-    cmd.append('-f')
-    return await shell.async_call(cmd, cmd_dir=git_dir, fail=fail, logfile=logfile, cpu_bound=False)
-
-async def submodules_update(git_dir, src_dir=None, fail=True, offline=False, logfile=None):
+    try:
+        ret = await shell.async_call(cmd, cmd_dir=git_dir, fail=fail, logfile=logfile, cpu_bound=False)
+        if ret != 0:
+            return ret
+        cmd.append('--tags')
+        # To avoid "would clobber existing tag" error
+        cmd.append('-f')
+        return await shell.async_call(cmd, cmd_dir=git_dir, fail=fail, logfile=logfile, cpu_bound=False)
+    finally:
+        forget_hashes(git_dir)
+
+async def submodules_update(git_dir, src_dir=None, fail=True, offline=False, logfile=None,
+                            fetch_mode=None):
     '''
     Update submodules asynchronously from local directory
 
@@ -149,6 +166,9 @@ async def submodules_update(git_dir, src_dir=None, fail=True, offline=False, log
     @type fail: false
     @param offline: don't use the network
     @type offline: false
+    @param fetch_mode: 'shallow' or 'partial' to fetch only what is needed to
+                       check out the submodules, see L{fetch_commit}
+    @type fetch_mode: str
     '''
     if src_dir:
         config = shell.check_output([GIT, 'config', '--file=.gitmodules', '--list'],
@@ -163,8 +183,8 @@ async def submodules_update(git_dir, src_dir=None, fail=True, offline=False, log
     if src_dir or not offline:
         await shell.async_call([GIT, 'submodule', 'sync'], cmd_dir=git_dir, logfile=logfile,
                                cpu_bound=False)
-        await shell.async_call([GIT, 'submodule', 'update'], cmd_dir=git_dir, fail=fail,
-                               logfile=logfile, cpu_bound=False)
+        await shell.async_call([GIT, 'submodule', 'update'] + _fetch_mode_args(fetch_mode),
+                               cmd_dir=git_dir, fail=fail, logfile=logfile, cpu_bound=False)
     else:
         await shell.async_call([GIT, 'submodule', 'update', '--no-fetch'], cmd_dir=git_dir,
                                fail=fail, logfile=logfile, cpu_bound=False)
@@ -186,7 +206,10 @@ async def checkout(git_dir, commit, logfile=None):
     @type commit: str
     '''
     cmd = [GIT, 'reset', '--hard', commit]
-    return await shell.async_call(cmd, git_dir, logfile=logfile, cpu_bound=False)
+    try:
+        return await shell.async_call(cmd, git_dir, logfile=logfile, cpu_bound=False)
+    finally:
+        forget_hashes(git_dir)
 
 
 def get_hash(git_dir, commit, logfile=None):
@@ -207,6 +230,81 @@ def get_hash(git_dir, commit, logfile=None):
     return shell.check_output([GIT, 'rev-parse', commit], cmd_dir=git_dir,
                               fail=False, quiet=True, logfile=logfile).rstrip()
 
+def get_cached_hash(git_dir, commit, logfile=None):
+    '''
+    Same as L{get_hash}, but using the hashes already resolved with
+    L{resolve_hashes}
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    @param commit: the commit to resolve
+    @type commit: str
+    '''
+    key = (git_dir, commit)
+    if key not in _hashes:
+        resolve_hashes([key])
+    if key in _hashes:
+        return _hashes[key]
+    return get_hash(git_dir, commit, logfile=logfile)
+
+def resolve_hashes(commits):
+    '''
+    Resolves the hashes of commits of several repositories, using a single
+    'git cat-file --batch-check' process per repository, all of them running
+    at the same time. The hashes are cached until the repository is modified
+    with L{init}, L{fetch}, L{checkout} or L{local_checkout}.
+
+    Commits that can't be resolved are skipped, L{get_cached_hash} falls back
+    to L{get_hash} for them.
+
+    @param commits: list of (git_dir, commit) tuples
+    @type commits: list
+    '''
+    repos = defaultdict(set)
+    for git_dir, commit in commits:
+        if (git_dir, commit) in _hashes:
+            continue
+        # See get_hash()
+        if not os.path.isdir(os.path.join(git_dir, '.git')):
+            continue
+        repos[git_dir].add(commit)
+    procs = []
+    for git_dir, revs in repos.items():
+        revs = sorted(revs)
+        try:
+            p = subprocess.Popen([GIT, 'cat-file', '--batch-check'],
+                                 cwd=git_dir, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 universal_newlines=True)
+            # The output of each revision is a single short line, so writing
+            # all the input before reading it can't fill the pipes
+            p.stdin.write(''.join([rev + '\n' for rev in revs]))
+            p.stdin.close()
+        except OSError:
+            continue
+        procs.append((git_dir, revs, p))
+    for git_dir, revs, p in procs:
+        lines = p.stdout.read().splitlines()
+        p.stdout.close()
+        if p.wait() != 0 or len(lines) != len(revs):
+            continue
+        for rev, line in zip(revs, lines):
+            # '<hash> <type> <size>' or '<rev> missing'
+            fields = line.split()
+            if len(fields) == 3 and fields[2].isdigit():
+                _hashes[(git_dir, rev)] = fields[0]
+
+def forget_hashes(git_dir):
+    '''
+    Removes the cached hashes of a repository
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    '''
+    for key in [k for k in _hashes if k[0] == git_dir]:
+        del _hashes[key]
+
 def get_hash_is_ancestor(git_dir, commit, logfile=None):
     if not os.path.isdir(os.path.join(git_dir, '.git')):
         return False
@@ -228,12 +326,182 @@ async def local_checkout(git_dir, local_git_dir, commit, logfile=None, use_submo
     '''
     branch_name = 'cerbero_build'
     await shell.async_call([GIT, 'checkout', commit, '-B', branch_name], local_git_dir, logfile=logfile)
+    forget_hashes(local_git_dir)
     await shell.async_call([GIT, 'clone', local_git_dir, '-s', '-b', branch_name, '.'],
                git_dir, logfile=logfile)
     ensure_user_is_set(git_dir, logfile=logfile)
     if use_submodules:
         await submodules_update(git_dir, local_git_dir, logfile=logfile)
 
+def _fetch_mode_args(mode):
+    if mode == 'shallow':
+        return ['--depth=1']
+    if mode == 'partial':
+        return ['--filter=blob:none']
+    return []
+
+def _commit_refspec(commit, remotes):
+    # Refspec fetching a commit of a recipe: a hash, a remote branch such as
+    # 'origin/main' or a tag
+    if SHA_RE.match(commit):
+        return commit
+    remote, sep, branch = commit.partition('/')
+    if branch and remote in remotes:
+        return '+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote, branch)
+    return '+refs/tags/%s:refs/tags/%s' % (commit, commit)
+
+async def fetch_commit(git_dir, commit, remotes, mode, logfile=None):
+    '''
+    Fetches only what is needed to check out a commit: without history with
+    the 'shallow' mode (--depth=1), or with the history but without the
+    contents of the files, which are fetched when they are checked out, with
+    the 'partial' mode (--filter=blob:none)
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    @param commit: the commit to fetch, a hash, a remote branch or a tag
+    @type commit: str
+    @param remotes: names of the remotes to try, in order
+    @type remotes: list
+    @param mode: 'shallow' or 'partial'
+    @type mode: str
+    @return: whether the commit was fetched
+    @rtype: bool
+    '''
+    refspec = _commit_refspec(commit, remotes)
+    remote = commit.split('/', 1)[0]
+    if refspec.startswith('+refs/heads/'):
+        remotes = [remote]
+    try:
+        for remote in remotes:
+            if mode == 'partial':
+                # Fetch the missing contents from this remote when needed
+                shell.new_call([GIT, 'config', 'remote.%s.promisor' % remote, 'true'],
+                               git_dir, logfile=logfile)
+                shell.new_call([GIT, 'config', 'remote.%s.partialclonefilter' % remote,
+                                'blob:none'], git_dir, logfile=logfile)
+            cmd = [GIT, 'fetch', '--force'] + _fetch_mode_args(mode) + [remote, refspec]
+            ret = await shell.async_call(cmd, git_dir, fail=False, logfile=logfile,
+                                         cpu_bound=False)
+            if ret == 0:
+                return True
+        return False
+    finally:
+        forget_hashes(git_dir)
+
+def objects_size(git_dir):
+    '''
+    Gets the size of the objects stored in a repository and its submodules,
+    without the ones borrowed from other repositories
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    @return: size in bytes
+    @rtype: int
+    '''
+    size = 0
+    dot_git = os.path.join(git_dir, '.git')
+    for root, dirs, files in os.walk(dot_git):
+        if 'objects' not in os.path.relpath(root, dot_git).split(os.sep):
+            continue
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+def object_store_path(store_dir, url):
+    '''
+    Gets the path of the bare repository of the shared object store with the
+    objects of a remote
+
+    @param store_dir: directory of the shared object store
+    @type store_dir: str
+    @param url: url of the remote
+    @type url: str
+    '''
+    name = os.path.basename(url.rstrip('/'))
+    if not name.endswith('.git'):
+        name += '.git'
+    return os.path.join(store_dir, '%s-%s' % (
+        hashlib.sha256(url.encode()).hexdigest()[:12], name))
+
+async def fetch_object_store(store_dir, url, logfile=None):
+    '''
+    Fetches a remote into its bare repository of the shared object store.
+    Each remote is only fetched once per process, however many recipes use
+    it, and different remotes are fetched at the same time.
+
+    @param store_dir: directory of the shared object store
+    @type store_dir: str
+    @param url: url of the remote
+    @type url: str
+    @return: the path of the bare repository
+    @rtype: str
+    '''
+    path = object_store_path(store_dir, url)
+    if path not in _store_fetches:
+        _store_fetches[path] = asyncio.ensure_future(
+            _fetch_object_store(path, url, logfile))
+    return await _store_fetches[path]
+
+async def _fetch_object_store(path, url, logfile):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        shell.new_call([GIT, 'init', '--bare'], path, logfile=logfile)
+        # The recipe repositories borrow the objects of the store, so they
+        # must never be pruned, even if the branches using them are removed
+        shell.new_call([GIT, 'config', 'gc.pruneExpire', 'never'], path,
+                       logfile=logfile)
+    await shell.async_call([GIT, 'fetch', '--force', url,
+                            '+refs/heads/*:refs/heads/*',
+                            '+refs/tags/*:refs/tags/*'],
+                           path, fail=False, logfile=logfile, cpu_bound=False)
+    return path
+
+def use_object_stores(git_dir, store_paths):
+    '''
+    Makes a repository borrow the objects of bare repositories of the shared
+    object store through alternates
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    @param store_paths: paths of the bare repositories
+    @type store_paths: list
+    '''
+    alternates = os.path.join(git_dir, '.git', 'objects', 'info', 'alternates')
+    lines = []
+    if os.path.exists(alternates):
+        with open(alternates, 'r') as f:
+            lines = f.read().splitlines()
+    missing = [os.path.join(os.path.abspath(p), 'objects') for p in store_paths]
+    missing = [p for p in missing if p not in lines]
+    if not missing:
+        return
+    os.makedirs(os.path.dirname(alternates), exist_ok=True)
+    with open(alternates, 'w') as f:
+        f.write(''.join(l + '\n' for l in lines + missing))
+
+async def fetch_from_object_store(git_dir, remote, store_path, logfile=None):
+    '''
+    Updates the branches of a remote and the tags of a repository from the
+    bare repository of the shared object store with the objects of the
+    remote. No objects are copied as they are borrowed with
+    L{use_object_stores}.
+
+    @param git_dir: path of the git repository
+    @type git_dir: str
+    @param remote: name of the remote
+    @type remote: str
+    @param store_path: path of the bare repository
+    @type store_path: str
+    '''
+    cmd = [GIT, 'fetch', '--force', store_path,
+           '+refs/heads/*:refs/remotes/%s/*' % remote, '+refs/tags/*:refs/tags/*']
+    try:
+        return await shell.async_call(cmd, git_dir, fail=False, logfile=logfile,
+                                      cpu_bound=False)
+    finally:
+        forget_hashes(git_dir)
+
 def add_remote(git_dir, name, url, logfile=None):
     '''
     Add a remote to a git repository
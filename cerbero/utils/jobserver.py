@@ -0,0 +1,167 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import re
+import shutil
+import fcntl
+import asyncio
+import tempfile
+import subprocess
+
+
+JOBS_ARG_RE = re.compile(r'^(-j\d*|--jobs(=\d+)?)$')
+# First ninja release with jobserver client support
+NINJA_JOBSERVER_VERSION = (1, 13)
+
+
+class JobServer (object):
+    '''
+    GNU make jobserver shared by all the recipes compiling at the same time,
+    which keeps the number of processes running at the number of jobs.
+
+    Each recipe holds one token while it's being compiled, which accounts for
+    the job that make/ninja run without taking a token. The build systems get
+    the remaining tokens from the pipe shared through MAKEFLAGS.
+
+    The pipe is a FIFO so that make can use it through inherited file
+    descriptors (--jobserver-auth=R,W) and ninja through its path
+    (--jobserver-auth=fifo:PATH), while the oven reads from its own
+    non-blocking file descriptor.
+
+    @ivar jobs: number of tokens
+    @type jobs: int
+    @ivar path: path of the FIFO
+    @type path: str
+    '''
+
+    TOKEN = b'+'
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._tmpdir = tempfile.mkdtemp(prefix='cerbero-jobserver-')
+        self.path = os.path.join(self._tmpdir, 'fifo')
+        os.mkfifo(self.path, 0o600)
+        # Opening a FIFO for reading blocks until there is a writer unless
+        # it's non-blocking
+        self._reader = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self._writer = os.open(self.path, os.O_WRONLY)
+        # Blocking descriptors for the children, as older make versions
+        # expect them
+        self._client_reader = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        flags = fcntl.fcntl(self._client_reader, fcntl.F_GETFL)
+        fcntl.fcntl(self._client_reader, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        self._client_writer = os.open(self.path, os.O_WRONLY)
+        for fd in self.fds:
+            os.set_inheritable(fd, True)
+        os.write(self._writer, self.TOKEN * jobs)
+        self._lock = asyncio.Lock()
+        self._ninja_versions = {}
+
+    @property
+    def fds(self):
+        '''
+        File descriptors that must be passed to the children
+        '''
+        return (self._client_reader, self._client_writer)
+
+    async def acquire(self):
+        '''
+        Takes a token, waiting until one is available
+        '''
+        loop = asyncio.get_event_loop()
+        # Only one waiter can be registered on the file descriptor
+        async with self._lock:
+            while True:
+                try:
+                    if os.read(self._reader, 1):
+                        return
+                except BlockingIOError:
+                    pass
+                readable = loop.create_future()
+                loop.add_reader(self._reader, lambda: readable.done() or
+                                readable.set_result(None))
+                try:
+                    await readable
+                finally:
+                    loop.remove_reader(self._reader)
+
+    def release(self):
+        '''
+        Returns a token taken with L{acquire}
+        '''
+        os.write(self._writer, self.TOKEN)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def client_env(self, cmd, env):
+        '''
+        Gets the environment variables that make the build tool run by the
+        command use this jobserver
+
+        @param cmd: command that will be run
+        @type cmd: list
+        @param env: environment of the command
+        @type env: dict
+        @return: the variables to set, or None if the tool can't use it
+        @rtype: dict
+        '''
+        tool = os.path.basename(cmd[0])
+        if tool.startswith('ninja'):
+            if not self._ninja_supports_jobserver(cmd[0], env):
+                return None
+            return {'MAKEFLAGS': '-j --jobserver-auth=fifo:%s' % self.path}
+        if tool in ('make', 'gmake', 'mingw32-make'):
+            # --jobserver-fds for make < 4.2 and --jobserver-auth for newer
+            # versions
+            fds = '%d,%d' % self.fds
+            return {'MAKEFLAGS': '-j --jobserver-fds=%s --jobserver-auth=%s' %
+                    (fds, fds)}
+        return None
+
+    @staticmethod
+    def strip_jobs_args(cmd):
+        '''
+        Removes the -jN arguments of a command, which would make the build tool
+        ignore the jobserver
+        '''
+        return [arg for arg in cmd if not JOBS_ARG_RE.match(arg)]
+
+    def close(self):
+        for fd in (self._reader, self._writer) + self.fds:
+            os.close(fd)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _ninja_supports_jobserver(self, ninja, env):
+        ninja = shutil.which(ninja, path=env.get('PATH', None))
+        if ninja is None:
+            return False
+        if ninja not in self._ninja_versions:
+            try:
+                out = subprocess.check_output([ninja, '--version'],
+                                              universal_newlines=True)
+                version = tuple(int(v) for v in
+                                re.findall(r'\d+', out)[:2])
+            except (OSError, subprocess.CalledProcessError):
+                version = ()
+            self._ninja_versions[ninja] = version
+        return self._ninja_versions[ninja] >= NINJA_JOBSERVER_VERSION
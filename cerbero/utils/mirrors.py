@@ -0,0 +1,245 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import ssl
+import json
+import time
+import atexit
+import asyncio
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from cerbero.utils import _
+from cerbero.utils import messages as m
+
+
+MIRRORS_FILE = 'mirrors.json'
+# Scores are probed again after this many seconds
+SCORES_TTL = 24 * 60 * 60
+PROBE_TIMEOUT = 5
+# Throughput assumed for the hosts without downloads recorded, in bytes/s
+DEFAULT_THROUGHPUT = 1024 * 1024
+# Size assumed for the files of unknown size
+DEFAULT_SIZE = 1024 * 1024
+# Downloads smaller than this are dominated by the latency and don't give a
+# meaningful throughput
+MIN_THROUGHPUT_SIZE = 256 * 1024
+# Files up to this size are downloaded from the two best candidates at the
+# same time, keeping the first one that finishes
+RACE_MAX_SIZE = 4 * 1024 * 1024
+
+
+def host_of(url):
+    o = urllib.parse.urlsplit(url)
+    return '%s://%s' % (o.scheme, o.netloc)
+
+
+class MirrorSelector (object):
+    '''
+    Ranks the URLs a file can be downloaded from, the upstream one and its
+    mirrors, by the time it's expected to take to download it from each
+    host.
+
+    The latency of the hosts is measured with HEAD requests and their
+    throughput with the downloads done. The scores are stored per host and
+    the hosts are probed again when their scores are older than the TTL.
+    Hosts that could not be reached are ranked last until they are probed
+    again.
+
+    @ivar filename: path of the scores file
+    @type filename: str
+    @ivar ttl: seconds after which the hosts are probed again
+    @type ttl: int
+    '''
+
+    def __init__(self, filename, ttl=SCORES_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        # host -> {'latency', 'throughput', 'failed', 'time'}
+        self._scores = {}
+        self._changed = False
+        self._load()
+
+    async def rank(self, urls, check_cert=True, user_agent=''):
+        '''
+        Ranks the URLs a file can be downloaded from, probing the hosts
+        without a valid score. When the size of the file is still unknown,
+        the best URL is probed to get it.
+
+        @param urls: URLs of the file, in the order of preference
+        @type urls: list
+        @return: (ranked URLs, size of the file or None if it's unknown)
+        @rtype: tuple
+        '''
+        size = None
+        missing = set()
+        stale = [u for u in urls if self._is_stale(host_of(u))]
+        if stale:
+            results = await asyncio.gather(
+                *[self.probe(u, check_cert, user_agent) for u in stale])
+            for url, (found, url_size) in zip(stale, results):
+                if not found:
+                    missing.add(url)
+                elif size is None:
+                    size = url_size
+        estimate = size if size is not None else DEFAULT_SIZE
+        ranked = sorted(urls, key=lambda u: (u in missing,
+                                             self.expected_time(u, estimate)))
+        if size is None and len(ranked) > 1 and ranked[0] not in missing:
+            # The size decides whether the file is raced between mirrors
+            found, size = await self.probe(ranked[0], check_cert, user_agent)
+            if not found:
+                ranked.append(ranked.pop(0))
+        return ranked, size
+
+    def expected_time(self, url, size):
+        '''
+        Gets the time it's expected to take to download a file from a URL
+
+        @param url: URL of the file
+        @type url: str
+        @param size: size of the file
+        @type size: int
+        @return: seconds, inf if the host could not be reached
+        @rtype: float
+        '''
+        score = self._scores.get(host_of(url), None)
+        if score is None:
+            return PROBE_TIMEOUT
+        if score['failed']:
+            return float('inf')
+        throughput = score['throughput'] or DEFAULT_THROUGHPUT
+        return (score['latency'] or 0) + size / throughput
+
+    async def probe(self, url, check_cert=True, user_agent=''):
+        '''
+        Measures the latency of the host of a URL with a HEAD request
+
+        @return: (whether the file was found, its size or None)
+        @rtype: tuple
+        '''
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        try:
+            size = await loop.run_in_executor(None, self._head, url,
+                                              check_cert, user_agent)
+        except urllib.error.HTTPError:
+            # The host is reachable but it doesn't have the file
+            self._update(url, latency=time.monotonic() - start)
+            return False, None
+        except Exception:
+            self._update(url, failed=True)
+            return False, None
+        self._update(url, latency=time.monotonic() - start)
+        return True, size
+
+    def record(self, url, size, seconds):
+        '''
+        Records a download to update the throughput of its host
+
+        @param url: URL downloaded
+        @type url: str
+        @param size: size of the file
+        @type size: int
+        @param seconds: time the download took
+        @type seconds: float
+        '''
+        if size < MIN_THROUGHPUT_SIZE or seconds <= 0:
+            return
+        score = self._scores.get(host_of(url), None)
+        if score is None:
+            return
+        throughput = size / seconds
+        if score['throughput'] is not None:
+            # Moving average, so that a single slow download doesn't
+            # discard a host
+            throughput = (score['throughput'] + throughput) / 2
+        score['throughput'] = throughput
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._scores, f, indent=1)
+            os.replace(tmp, self.filename)
+            self._changed = False
+        except IOError as ex:
+            m.warning(_("Could not save the mirrors scores: %s") % ex)
+
+    def _is_stale(self, host):
+        score = self._scores.get(host, None)
+        return score is None or time.time() - score['time'] > self.ttl
+
+    def _update(self, url, latency=None, failed=False):
+        host = host_of(url)
+        score = self._scores.setdefault(host, {'latency': None,
+                                               'throughput': None})
+        score['latency'] = latency
+        score['failed'] = failed
+        score['time'] = time.time()
+        self._changed = True
+
+    @staticmethod
+    def _head(url, check_cert, user_agent):
+        ctx = None
+        if url.startswith('https') and not check_cert:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        req = urllib.request.Request(url, method='HEAD')
+        req.add_header('User-Agent', user_agent)
+        with urllib.request.urlopen(req, timeout=PROBE_TIMEOUT,
+                                    context=ctx) as f:
+            length = f.headers.get('Content-Length', None)
+            return int(length) if length is not None else None
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                self._scores = json.load(f)
+        except Exception:
+            m.warning(_("Could not recover the mirrors scores"))
+
+
+_selectors = {}
+
+
+def _save_selectors():
+    for selector in _selectors.values():
+        selector.save()
+
+
+def get_mirror_selector(config):
+    '''
+    Gets the shared L{cerbero.utils.mirrors.MirrorSelector} stored in the home
+    dir of a configuration, which is saved when the process exits
+    '''
+    filename = os.path.join(config.home_dir, MIRRORS_FILE)
+    if filename not in _selectors:
+        if not _selectors:
+            atexit.register(_save_selectors)
+        _selectors[filename] = MirrorSelector(filename)
+    return _selectors[filename]
@@ -38,6 +38,8 @@ from distutils.version import StrictVersion
 from cerbero.enums import CERBERO_VERSION, Platform, Distro
 from cerbero.utils import _, system_info, to_unixpath, determine_num_of_cpus, CerberoSemaphore
 from cerbero.utils import messages as m
+from cerbero.utils import downloader
+from cerbero.utils import mirrors as mirrors_mod
 from cerbero.errors import CommandError, FatalError
 
 
@@ -45,6 +47,8 @@ USER_AGENT = 'GStreamer Cerbero/' + CERBERO_VERSION
 PATCH = 'patch'
 TAR = 'tar'
 TARBALL_SUFFIXES = ('tar.gz', 'tgz', 'tar.bz2', 'tbz2', 'tar.xz')
+TAR_COMPRESSION_FLAGS = {'tar.gz': '-z', 'tgz': '-z', 'tar.bz2': '-j', 'tbz2': '-j',
+                         'tar.xz': '-J'}
 SUBPROCESS_EXCEPTIONS = (FileNotFoundError, PermissionError, subprocess.CalledProcessError)
 
 info = system_info()
@@ -53,6 +57,8 @@ DISTRO = info[2]
 CPU_BOUND_SEMAPHORE = CerberoSemaphore(info[4])
 NON_CPU_BOUND_SEMAPHORE = CerberoSemaphore(2)
 DRY_RUN = False
+# L{cerbero.utils.jobserver.JobServer} shared by the recipes being compiled
+JOBSERVER = None
 
 def _fix_mingw_cmd(path):
     reserved = ['/', ' ', '\\', ')', '(', '"']
@@ -213,7 +219,7 @@ def new_call(cmd, cmd_dir=None, fail=True, logfile=None, env=None, verbose=False
     return 0
 
 
-async def async_call(cmd, cmd_dir='.', fail=True, logfile=None, cpu_bound=True, env=None):
+async def async_call(cmd, cmd_dir='.', fail=True, logfile=None, cpu_bound=True, env=None, pass_fds=()):
     '''
     Run a shell command
 
@@ -221,6 +227,8 @@ async def async_call(cmd, cmd_dir='.', fail=True, logfile=None, cpu_bound=True,
     @type cmd: str
     @param cmd_dir: directory where the command will be run
     @param cmd_dir: str
+    @param pass_fds: file descriptors inherited by the command
+    @type pass_fds: tuple
     '''
     global CPU_BOUND_SEMAPHORE, NON_CPU_BOUND_SEMAPHORE
     semaphore = CPU_BOUND_SEMAPHORE if cpu_bound else NON_CPU_BOUND_SEMAPHORE
@@ -246,8 +254,16 @@ async def async_call(cmd, cmd_dir='.', fail=True, logfile=None, cpu_bound=True,
         env['PYTHONUNBUFFERED'] = '1'
         proc = await asyncio.create_subprocess_exec(*cmd, cwd=cmd_dir,
                             stderr=subprocess.STDOUT, stdout=stream,
-                            stdin=subprocess.DEVNULL, env=env)
-        await proc.wait()
+                            stdin=subprocess.DEVNULL, env=env,
+                            pass_fds=pass_fds)
+        try:
+            await proc.wait()
+        except asyncio.CancelledError:
+            # Don't leave the command running, such as a download that lost
+            # a race
+            proc.terminate()
+            await proc.wait()
+            raise
         if proc.returncode != 0 and fail:
             msg = ''
             if stream:
@@ -355,6 +371,129 @@ async def unpack(filepath, output_dir, logfile=None, force_tarfile=False):
     else:
         raise FatalError("Unknown tarball format %s" % filepath)
 
+def can_stream_unpack(filepath, force_tarfile=False):
+    '''
+    Whether a tarball can be extracted with L{download_and_unpack} while it's
+    downloaded
+    '''
+    return not force_tarfile and DISTRO != Distro.MSYS and \
+        filepath.endswith(TARBALL_SUFFIXES)
+
+async def _stream_unpack(url, destination, output_dir, compression, check_cert, logfile):
+    # Pipes the download to the file, the hasher and tar at the same time
+    cmd = [get_tar_cmd(), '-C', output_dir, compression, '-xf', '-']
+    if logfile is not None:
+        logfile.write("Running command '%s'\n" % ' '.join([shlex.quote(c) for c in cmd]))
+        logfile.flush()
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE,
+        stdout=logfile, stderr=subprocess.STDOUT)
+    sha256 = hashlib.sha256()
+    try:
+        with open(destination, 'wb') as f:
+            async for block in downloader.iter_url(url, check_cert, USER_AGENT):
+                sha256.update(block)
+                f.write(block)
+                proc.stdin.write(block)
+                await proc.stdin.drain()
+        proc.stdin.close()
+        await proc.wait()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise CommandError('', cmd, proc.returncode)
+    return sha256.hexdigest()
+
+async def download_and_unpack(url, destination, output_dir, checksum, check_cert=True, logfile=None,
+                              mirrors=None, digests=None, selector=None):
+    '''
+    Downloads a tarball and extracts it at the same time, computing its
+    SHA-256 while it's downloaded, so that it's not read again to verify it
+    and to extract it.
+
+    The tarball is extracted in a temporary directory that only replaces the
+    output directory when the checksum matches, so that a tarball that
+    fails the verification never leaves an extracted tree behind.
+
+    @param url: url to download
+    @type: str
+    @param destination: destination where the tarball will be saved
+    @type destination: str
+    @param output_dir: directory with the contents of the tarball
+    @type output_dir: str
+    @param checksum: expected SHA-256 of the tarball
+    @type checksum: str
+    @param mirrors: list of mirrors to use as fallback
+    @type mirrors: list
+    @param digests: cache where the SHA-256 of the tarball is stored
+    @type digests: L{cerbero.utils.digests.DigestCache}
+    @param selector: ranks the URL and the mirrors to try the fastest ones first
+    @type selector: L{cerbero.utils.mirrors.MirrorSelector}
+    '''
+    m.log("Downloading and unpacking {} in {}".format(url, output_dir), logfile)
+    urls = _mirror_urls(url, mirrors)
+    if selector is not None:
+        urls, size = await selector.rank(urls, check_cert, USER_AGENT)
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    os.makedirs(parent, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    partial = destination + downloader.PARTIAL_EXT
+    suffix = [s for s in TARBALL_SUFFIXES if destination.endswith(s)][0]
+    errors = []
+    for murl in urls:
+        tmpdir = tempfile.mkdtemp(prefix='.unpack-', dir=parent)
+        verified = False
+        try:
+            digest = await _stream_unpack(murl, partial, tmpdir, TAR_COMPRESSION_FLAGS[suffix],
+                                          check_cert, logfile)
+            if digest != checksum:
+                raise FatalError('Checksum mismatch for {}: expected {}, got {}'
+                                 .format(murl, checksum, digest))
+            verified = True
+        except Exception as ex:
+            errors.append((murl, ex))
+        finally:
+            if not verified:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                if os.path.exists(partial):
+                    os.remove(partial)
+        if not verified:
+            continue
+        os.replace(partial, destination)
+        if digests is not None:
+            digests.put(destination, bytes.fromhex(digest), 'sha256')
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(tmpdir, output_dir)
+        return
+    if len(errors) == 1:
+        errors = errors[0]
+    raise FatalError('Failed to download {!r}: {!r}'.format(url, errors))
+
+def can_download_natively(url, mirrors=None):
+    '''
+    Whether a URL and all its mirrors can be downloaded with the native
+    downloader
+
+    @param url: url to download
+    @type: str
+    @param mirrors: list of mirrors to use as fallback
+    @type mirrors: list
+    @rtype: bool
+    '''
+    return all(downloader.can_download(u) for u in _mirror_urls(url, mirrors))
+
+def _mirror_urls(url, mirrors):
+    urls = [url]
+    if mirrors is not None:
+        filename = os.path.basename(url)
+        # Add a traling '/' the url so that urljoin joins correctly urls
+        # in case users provided it without the trailing '/'
+        urls += [urllib.parse.urljoin(u + '/', filename) for u in mirrors]
+    return urls
+
 async def download_wget(url, destination=None, check_cert=True, overwrite=False, logfile=None):
     '''
     Downloads a file with wget
@@ -450,7 +589,50 @@ async def download_curl(url, destination=None, check_cert=True, overwrite=False,
             os.remove(destination)
         raise e
 
-async def download(url, destination=None, check_cert=True, overwrite=False, logfile=None, mirrors=None):
+async def _timed_download(download_func, url, destination, check_cert, overwrite, logfile, selector):
+    start = time.monotonic()
+    ret = await download_func(url, destination, check_cert, overwrite, logfile)
+    if selector is not None:
+        selector.record(url, os.path.getsize(destination), time.monotonic() - start)
+    return ret
+
+async def _race_download(download_func, urls, destination, check_cert, logfile, selector, errors):
+    '''
+    Downloads a file from several URLs at the same time into temporary files,
+    keeping the first one that finishes and cancelling the others
+
+    @return: whether any of the downloads succeeded
+    @rtype: bool
+    '''
+    tmps = ['{}.mirror{}'.format(destination, i) for i in range(len(urls))]
+    tasks = {}
+    for murl, tmp in zip(urls, tmps):
+        task = asyncio.ensure_future(_timed_download(download_func, murl, tmp,
+            check_cert, True, logfile, selector))
+        tasks[task] = (murl, tmp)
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                murl, tmp = tasks[task]
+                if task.exception() is None:
+                    os.replace(tmp, destination)
+                    return True
+                errors.append((murl, task.exception()))
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for tmp in tmps:
+            for path in (tmp, tmp + downloader.PARTIAL_EXT, tmp + downloader.STATE_EXT):
+                if os.path.exists(path):
+                    os.remove(path)
+    return False
+
+async def download(url, destination=None, check_cert=True, overwrite=False, logfile=None, mirrors=None,
+                   native=False, digests=None, selector=None):
     '''
     Downloads a file
 
@@ -466,6 +648,15 @@ async def download(url, destination=None, check_cert=True, overwrite=False, logf
     @type logfile: str
     @param mirrors: list of mirrors to use as fallback
     @type logfile: list
+    @param native: whether to use the native downloader, which downloads in
+                   parallel chunks and resumes interrupted downloads
+    @type native: bool
+    @param digests: cache where the native downloader stores the SHA-256 of
+                    the file
+    @type digests: L{cerbero.utils.digests.DigestCache}
+    @param selector: ranks the URL and the mirrors to try the fastest ones
+                     first, and races the two best ones for small files
+    @type selector: L{cerbero.utils.mirrors.MirrorSelector}
     '''
     if not overwrite and os.path.exists(destination):
         if logfile is None:
@@ -476,31 +667,42 @@ async def download(url, destination=None, check_cert=True, overwrite=False, logf
             os.makedirs(os.path.dirname(destination))
         m.log("Downloading {}".format(url), logfile)
 
-    urls = [url]
-    if mirrors is not None:
-        filename = os.path.basename(url)
-        # Add a traling '/' the url so that urljoin joins correctly urls
-        # in case users provided it without the trailing '/'
-        urls += [urllib.parse.urljoin(u + '/', filename) for u in mirrors]
+    urls = _mirror_urls(url, mirrors)
 
     # wget shipped with msys fails with an SSL error on github URLs
     # https://githubengineering.com/crypto-removal-notice/
     # curl on Windows (if provided externally) is often badly-configured and fails
     # to download over https, so just always use urllib2 on Windows.
     if sys.platform.startswith('win'):
-        download_func = download_urllib2
+        tool_download_func = download_urllib2
     elif which('wget'):
-        download_func = download_wget
+        tool_download_func = download_wget
     elif which('curl'):
-        download_func = download_curl
+        tool_download_func = download_curl
     else:
         # Fallback. TODO: make this the default and remove curl/wget dependency
-        download_func = download_urllib2
+        tool_download_func = download_urllib2
+
+    async def download_func(murl, *args):
+        # The native downloader only handles HTTP and HTTPS URLs without a
+        # proxy, each mirror is checked on its own
+        if native and downloader.can_download(murl):
+            return await downloader.download(murl, *args,
+                user_agent=USER_AGENT, digests=digests)
+        return await tool_download_func(murl, *args)
 
     errors = []
+    if selector is not None:
+        urls, size = await selector.rank(urls, check_cert, USER_AGENT)
+        if size is not None and size <= mirrors_mod.RACE_MAX_SIZE and len(urls) > 1:
+            if await _race_download(download_func, urls[:2], destination,
+                                    check_cert, logfile, selector, errors):
+                return
+            urls = urls[2:]
     for murl in urls:
         try:
-            return await download_func(murl, destination, check_cert, overwrite, logfile)
+            return await _timed_download(download_func, murl, destination, check_cert,
+                                         overwrite, logfile, selector)
         except Exception as ex:
             errors.append((murl, ex))
     if len(errors) == 1:
@@ -789,6 +991,8 @@ class BuildStatusPrinter:
         self.recipe_to_step = {}
         self.total = 0
         self.count = 0
+        # callable returning the estimated seconds left to finish the build
+        self.remaining_time = None
         self.interactive = interactive
         # FIXME: Default MSYS shell doesn't handle ANSI escape sequences correctly
         if os.environ.get('TERM') == 'cygwin':
@@ -815,6 +1019,14 @@ class BuildStatusPrinter:
             m.build_recipe_done(count, self.total, recipe_name, _("already built"))
         self.output_status_line()
 
+    def restored(self, count, recipe_name):
+        self.count += 1
+        if self.interactive:
+            m.build_recipe_done(self.count, self.total, recipe_name, _("restored from cache"))
+        else:
+            m.build_recipe_done(count, self.total, recipe_name, _("restored from cache"))
+        self.output_status_line()
+
     def _get_completion_percent (self):
         one_recipe = 100. / float (self.total)
         one_step = one_recipe / len (self.steps)
@@ -837,9 +1049,20 @@ class BuildStatusPrinter:
         for step in self.steps:
             if self.step_to_recipe[step]:
                 s += " " + str(step).upper() + ": " + ", ".join(self.step_to_recipe[step])
+        eta = self._get_eta()
+        if eta:
+            s += " ETA: " + eta
         s += "]"
         return s
 
+    def _get_eta(self):
+        if self.remaining_time is None:
+            return None
+        seconds = int(self.remaining_time())
+        if seconds >= 3600:
+            return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+
     def output_status_line(self):
         if self.interactive:
             m.output_status(self.generate_status_line())
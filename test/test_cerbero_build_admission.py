@@ -0,0 +1,92 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import tempfile
+import unittest
+
+from cerbero.build.admission import AdmissionController, get_mem_available, \
+    get_mem_total, MiB
+from cerbero.utils import run_until_complete
+
+
+class FakeRecipe(object):
+
+    def __init__(self, name, memory_hint=None):
+        self.name = name
+        self.memory_hint = memory_hint
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.load = 0
+        self.mem = 4096 * MiB
+        self.controller = AdmissionController(4, lambda: self.load,
+                                              lambda: self.mem,
+                                              lambda: 4096 * MiB)
+        self.controller.POLL_INTERVAL = 0
+
+    def testMemoryHint(self):
+        self.assertEqual(self.controller.memory_hint(FakeRecipe('big', 100)),
+                         100 * MiB)
+        self.assertIsNone(self.controller.memory_hint(FakeRecipe('small')))
+
+    def testAlwaysAdmitFirst(self):
+        self.load = 100
+        self.assertIsNone(self.controller.check(FakeRecipe('a'), 'compile'))
+
+    def testLoad(self):
+        run_until_complete(self.controller.admit(FakeRecipe('a'), 'compile'))
+        self.assertIsNone(self.controller.check(FakeRecipe('b'), 'compile'))
+        self.load = 6
+        self.assertIsNotNone(self.controller.check(FakeRecipe('b'), 'compile'))
+        # other steps are not delayed
+        self.assertIsNone(self.controller.check(FakeRecipe('b'), 'configure'))
+        self.controller.done(FakeRecipe('a'), 'compile')
+        self.assertIsNone(self.controller.check(FakeRecipe('b'), 'compile'))
+
+    def testMemory(self):
+        big = FakeRecipe('big', 3000)
+        run_until_complete(self.controller.admit(big, 'compile'))
+        # the memory of the running step is reserved
+        self.assertIsNotNone(self.controller.check(FakeRecipe('a', 2000),
+                                                   'compile'))
+        self.assertIsNone(self.controller.check(FakeRecipe('a', 1000),
+                                                'compile'))
+        self.assertIsNone(self.controller.check(FakeRecipe('a'), 'compile'))
+        # the memory used by the running step is not reserved again
+        self.mem = 1500 * MiB
+        self.assertIsNone(self.controller.check(FakeRecipe('a', 1000),
+                                                'compile'))
+        self.mem = 500 * MiB
+        self.assertIsNotNone(self.controller.check(FakeRecipe('a', 1000),
+                                                   'compile'))
+        self.controller.done(big, 'compile')
+        self.assertIsNone(self.controller.check(FakeRecipe('a', 1000),
+                                                'compile'))
+
+    def testMemAvailable(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('MemTotal:       16316412 kB\n'
+                    'MemFree:         1097324 kB\n'
+                    'MemAvailable:    8048204 kB\n')
+            f.flush()
+            self.assertEqual(get_mem_available(f.name), 8048204 * 1024)
+            self.assertEqual(get_mem_total(f.name), 16316412 * 1024)
+        self.assertIsNone(get_mem_available('/nonexistent'))
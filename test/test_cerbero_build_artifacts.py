@@ -0,0 +1,153 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build.artifacts import ArtifactCache, LocalArtifactCache
+from cerbero.build.staging import InstallManifests, get_install_manifests
+from cerbero.config import Variants
+from test.test_common import DummyConfig
+
+
+class FakeRecipe(object):
+
+    def __init__(self, name, config, deps, checksum=b'1'):
+        self.name = name
+        self.config = config
+        self.deps = deps
+        self.checksum = checksum
+
+    def get_checksum(self):
+        return self.checksum
+
+    def built_version(self):
+        return '1.0'
+
+
+class FakeCookBook(object):
+
+    def __init__(self, recipes):
+        self.recipes = dict(((r.name, r) for r in recipes))
+
+    def get_recipe(self, name):
+        return self.recipes[name]
+
+    def list_recipe_direct_deps(self, name):
+        return self.recipes[name].deps
+
+
+class LocalArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = LocalArtifactCache(os.path.join(self.tmp, 'cache'), 25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _put(self, key, size):
+        path = os.path.join(self.tmp, key)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        self.cache.put(key, path)
+
+    def testGetPut(self):
+        out = os.path.join(self.tmp, 'out')
+        self.assertFalse(self.cache.get('aaaa', out))
+        self._put('aaaa', 10)
+        self.assertTrue(self.cache.get('aaaa', out))
+        self.assertEqual(os.path.getsize(out), 10)
+
+    def testEviction(self):
+        out = os.path.join(self.tmp, 'out')
+        self._put('aaaa', 10)
+        self._put('bbbb', 10)
+        past = time.time() - 100
+        os.utime(self.cache._artifact_path('aaaa'), (past, past))
+        os.utime(self.cache._artifact_path('bbbb'), (past + 1, past + 1))
+        # 'aaaa' is now the most recently used
+        self.assertTrue(self.cache.get('aaaa', out))
+        self._put('cccc', 10)
+        self.assertTrue(self.cache.get('aaaa', out))
+        self.assertFalse(self.cache.get('bbbb', out))
+        self.assertTrue(self.cache.get('cccc', out))
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = DummyConfig()
+        self.config.prefix = os.path.join(self.tmp, 'prefix')
+        self.config.libdir = os.path.join(self.config.prefix, 'lib')
+        self.config.variants = Variants([])
+        self.a = FakeRecipe('a', self.config, [])
+        self.b = FakeRecipe('b', self.config, ['a'])
+        self.c = FakeRecipe('c', self.config, [])
+        self.cookbook = FakeCookBook([self.a, self.b, self.c])
+        self.backend = LocalArtifactCache(os.path.join(self.tmp, 'cache'),
+                                          1024 * 1024)
+        self.cache = ArtifactCache(self.cookbook, self.backend)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testKeys(self):
+        key_b = self.cache.get_key('b')
+        key_c = self.cache.get_key('c')
+        self.assertNotEqual(self.cache.get_key('a'), key_c)
+        # changing a dependency changes the key
+        self.a.checksum = b'2'
+        cache = ArtifactCache(self.cookbook, self.backend)
+        self.assertNotEqual(cache.get_key('b'), key_b)
+        self.assertEqual(cache.get_key('c'), key_c)
+
+    def testStoreRestore(self):
+        os.makedirs(os.path.join(self.config.prefix, 'lib'))
+        with open(os.path.join(self.config.prefix, 'lib', 'liba.so'), 'w') as f:
+            f.write('liba')
+        os.symlink('liba.so',
+                   os.path.join(self.config.prefix, 'lib', 'liba.so.1'))
+        self.assertFalse(self.cache.restore(self.a))
+        # without an install manifest the artifact is not stored
+        self.assertFalse(self.cache.store(self.a))
+        self.assertFalse(self.cache.restore(self.a))
+        # nor when the manifest doesn't list all the installed files
+        get_install_manifests(self.config.prefix).save(
+            'a', ['lib/liba.so'], complete=False)
+        self.assertFalse(self.cache.store(self.a))
+        get_install_manifests(self.config.prefix).save('a', [])
+        self.assertFalse(self.cache.store(self.a))
+        self.assertFalse(self.cache.restore(self.a))
+        get_install_manifests(self.config.prefix).save(
+            'a', ['lib/liba.so', 'lib/liba.so.1', 'lib/missing.so'])
+        self.assertTrue(self.cache.store(self.a))
+
+        shutil.rmtree(self.config.prefix)
+        self.assertTrue(self.cache.restore(self.a))
+        with open(os.path.join(self.config.prefix, 'lib', 'liba.so')) as f:
+            self.assertEqual(f.read(), 'liba')
+        self.assertEqual(os.readlink(
+            os.path.join(self.config.prefix, 'lib', 'liba.so.1')), 'liba.so')
+        manifests = InstallManifests(self.config.prefix)
+        self.assertEqual(manifests.get_files('a'),
+                         ['lib/liba.so', 'lib/liba.so.1'])
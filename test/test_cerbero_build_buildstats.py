@@ -0,0 +1,75 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build.buildstats import BuildStats, StepTimer
+
+
+class BuildStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'linux_x86_64.stats')
+        self.stats = BuildStats(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testRecord(self):
+        self.assertIsNone(self.stats.get('a', 'compile'))
+        self.stats.record('a', 'compile', 10, 20)
+        self.stats.record('a', 'compile', 20, None)
+        stats = self.stats.get('a', 'compile')
+        self.assertEqual(stats.samples, 2)
+        self.assertEqual(stats.wall, 15)
+        self.assertEqual(stats.cpu, 20)
+
+    def testDurations(self):
+        self.stats.record('a', 'configure', 5)
+        self.stats.record('a', 'compile', 10)
+        self.stats.record('a', 'install', 1)
+        self.assertEqual(self.stats.step_duration('a', 'compile'), 10)
+        self.assertIsNone(self.stats.step_duration('b', 'compile'))
+        self.assertEqual(self.stats.recipe_duration('a',
+            ['configure', 'compile', 'fetch']), 15)
+        self.assertIsNone(self.stats.recipe_duration('b', ['compile']))
+
+    def testSave(self):
+        # nothing is written until a step is recorded
+        self.stats.save()
+        self.assertFalse(os.path.exists(self.filename))
+        self.stats.record('a', 'compile', 10, 20)
+        self.stats.save()
+        stats = BuildStats(self.filename)
+        self.assertEqual(stats.step_duration('a', 'compile'), 10)
+
+    def testCorrupted(self):
+        with open(self.filename, 'w') as f:
+            f.write('garbage')
+        stats = BuildStats(self.filename)
+        self.assertEqual(stats.stats, {})
+
+    def testTimer(self):
+        timer = StepTimer()
+        timer.start()
+        timer.stop()
+        self.assertGreaterEqual(timer.wall, 0)
@@ -20,7 +20,8 @@ import unittest
 import tempfile
 import pickle
 
-from cerbero.build.cookbook import CookBook
+from cerbero.build import recipe
+from cerbero.build.cookbook import CookBook, _copy_recipe_class
 from cerbero.errors import RecipeNotFoundError
 from test.test_common import DummyConfig as Config
 from test.test_build_common import Recipe1
@@ -121,3 +122,34 @@ class PackageTest(unittest.TestCase):
         status = self.cookbook._recipe_status(recipe.name)
         self.assertEqual(status.steps, [])
         self.assertTrue(self.cookbook.status[recipe.name].needs_build)
+
+
+class CopyRecipeClassTest(unittest.TestCase):
+
+    def testCopy(self):
+        d = {'recipe': recipe}
+        exec('''
+class Base(recipe.Recipe):
+    files_libs = ['libbase']
+
+class Recipe(Base):
+    name = 'test'
+    deps = ['a']
+    platform_deps = {'linux': ['b']}
+
+    def prepare(self):
+        super().prepare()
+''', d)
+        cls = d['Recipe']
+        copy = _copy_recipe_class(cls)
+        self.assertEqual(copy.__name__, 'Recipe')
+        self.assertTrue(issubclass(copy, cls))
+        self.assertEqual(copy.__mro__[1:], cls.__mro__)
+        copy.deps.append('c')
+        copy.platform_deps['linux'].append('d')
+        copy.files_libs.append('libcopy')
+        self.assertEqual(cls.deps, ['a'])
+        self.assertEqual(cls.platform_deps, {'linux': ['b']})
+        self.assertEqual(cls.files_libs, ['libbase'])
+        # super() in methods of the original class
+        copy.prepare(copy.__new__(copy))
@@ -0,0 +1,73 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import unittest
+
+from cerbero.build.cookbook import DepsGraph
+from cerbero.errors import FatalError
+
+
+class FakeCookBook(object):
+
+    def __init__(self, deps):
+        self.recipes = dict(((name, None) for name in deps))
+        self.deps = deps
+
+    def list_recipe_direct_deps(self, name):
+        return self.deps[name]
+
+
+class DepsGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = DepsGraph(FakeCookBook({
+            'a': [],
+            'b': ['a'],
+            'c': ['a', 'b', 'b'],
+            'd': ['c'],
+            'e': ['a'],
+        }))
+
+    def testListDeps(self):
+        self.assertEqual(self.graph.list_deps('a'), [])
+        self.assertEqual(self.graph.list_deps('b'), ['a'])
+        self.assertEqual(self.graph.list_deps('d'), ['a', 'b', 'c'])
+
+    def testListRdeps(self):
+        self.assertEqual(self.graph.list_rdeps('a'), ['b', 'c', 'e'])
+        self.assertEqual(self.graph.list_rdeps('b'), ['c'])
+        self.assertEqual(self.graph.list_rdeps('b', True), ['c', 'd'])
+        self.assertEqual(self.graph.list_rdeps('d', True), [])
+
+    def testOrder(self):
+        for name, i in self.graph.index.items():
+            for dep in self.graph.deps[i]:
+                self.assertLess(self.graph.position[dep],
+                                self.graph.position[i])
+
+    def testCycle(self):
+        graph = DepsGraph(FakeCookBook({
+            'a': ['c'], 'b': ['a'], 'c': ['b'], 'd': [], 'e': ['d']}))
+        self.assertRaises(FatalError, graph.list_deps, 'a')
+        # recipes outside of the cycle still work
+        self.assertEqual(graph.list_deps('e'), ['d'])
+
+    def testUnknownDep(self):
+        graph = DepsGraph(FakeCookBook({'a': ['z'], 'b': ['a'], 'c': []}))
+        self.assertRaises(FatalError, graph.list_deps, 'b')
+        self.assertEqual(graph.list_deps('c'), [])
@@ -16,13 +16,16 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
+import os
 import shutil
 import unittest
 import tempfile
 
 from cerbero.build import filesprovider
-from cerbero.config import Platform, License
+from cerbero.build.staging import get_install_manifests
+from cerbero.config import Platform, License, LibraryType, Variants
 from test.test_build_common import add_files
+from test.test_cerbero_tools_implib import ar_archive, short_import
 from test.test_common import DummyConfig
 
 
@@ -31,15 +34,23 @@ class Config(DummyConfig):
     def __init__(self, tmp, platform):
         self.prefix = tmp
         self.target_platform = platform
+        self.variants = Variants([])
+        self.lib_suffix = ''
+        self.msvc_env_for_toolchain = None
 
 
 class FilesProvider(filesprovider.FilesProvider):
 
+    name = 'gstreamer'
+    btype = None
+    library_type = LibraryType.BOTH
+    licenses = []
+    runtime_dep = False
     files_misc = ['README', 'libexec/gstreamer-0.10/pluginsloader%(bext)s']
     files_libs = ['libgstreamer-0.10']
     files_bins = ['gst-launch']
     files_devel = ['include/gstreamer.h']
-    licenses_devel = [License.LGPL]
+    licenses_devel = [License.LGPLv2Plus]
     platform_files_bins = {
             Platform.WINDOWS: ['windows'],
             Platform.LINUX: ['linux']}
@@ -47,6 +58,9 @@ class FilesProvider(filesprovider.FilesProvider):
             Platform.WINDOWS: ['libgstreamer-win32'],
             Platform.LINUX: ['libgstreamer-x11']}
 
+    def using_msvc(self):
+        return False
+
 
 class PackageTest(unittest.TestCase):
 
@@ -78,6 +92,15 @@ class PackageTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmp)
 
+    def _add_files(self):
+        add_files(self.tmp)
+        # the DLLs of the libraries are found reading their import libraries
+        for name in ['libgstreamer-0.10', 'libgstreamer-win32']:
+            dllname = (name + '.dll').encode()
+            path = os.path.join(self.tmp, 'lib', name + '.dll.a')
+            with open(path, 'wb') as f:
+                f.write(ar_archive([(dllname, short_import(b'gst', dllname))]))
+
     def testFilesCategories(self):
         self.assertEqual(sorted(['bins', 'libs', 'misc', 'devel']),
                 self.win32recipe._files_categories())
@@ -89,14 +112,14 @@ class PackageTest(unittest.TestCase):
                 sorted(self.linuxbin))
 
     def testListLibraries(self):
-        add_files(self.tmp)
+        self._add_files()
         self.assertEqual(self.win32recipe.files_list_by_category('libs'),
                 sorted(self.winlib))
         self.assertEqual(self.linuxrecipe.files_list_by_category('libs'),
                 sorted(self.linuxlib))
 
     def testDevelFiles(self):
-        add_files(self.tmp)
+        self._add_files()
         self.assertEqual(self.win32recipe.devel_files_list(),
                 sorted(self.windevfiles))
         self.assertEqual(self.linuxrecipe.devel_files_list(),
@@ -105,13 +128,147 @@ class PackageTest(unittest.TestCase):
     def testDistFiles(self):
         win32files = self.winlib + self.winbin + self.winmisc
         linuxfiles = self.linuxlib + self.linuxbin + self.linuxmisc
-        add_files(self.tmp)
+        self._add_files()
         self.assertEqual(self.win32recipe.dist_files_list(), sorted(win32files))
         self.assertEqual(self.linuxrecipe.dist_files_list(), sorted(linuxfiles))
 
     def testGetAllFiles(self):
         win32files = self.winlib + self.winbin + self.winmisc + self.windevfiles
         linuxfiles = self.linuxlib + self.linuxbin + self.linuxmisc + self.lindevfiles
-        add_files(self.tmp)
+        self._add_files()
         self.assertEqual(self.win32recipe.files_list(), sorted(win32files))
         self.assertEqual(self.linuxrecipe.files_list(), sorted(linuxfiles))
+
+
+class PackageManifestTest(PackageTest):
+    '''
+    Same as L{PackageTest}, looking up the files in the install manifest
+    '''
+
+    def _add_files(self):
+        PackageTest._add_files(self)
+        files = []
+        for root, dirnames, filenames in os.walk(self.tmp):
+            files += [os.path.relpath(os.path.join(root, f), self.tmp)
+                      for f in filenames]
+        get_install_manifests(self.tmp).save('gstreamer', files)
+        self.assertIsNotNone(self.linuxrecipe._install_index())
+
+
+class CachedFilesProvider(filesprovider.FilesProvider):
+
+    name = 'cached'
+    btype = None
+    licenses = []
+    runtime_dep = True
+    files_misc = ['README', 'share/cached']
+
+    def using_msvc(self):
+        return False
+
+
+class FilesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.recipe = CachedFilesProvider(Config(self.tmp, Platform.LINUX))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _add_file(self, f):
+        path = os.path.join(self.tmp, f)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    def testInvalidate(self):
+        self._add_file('README')
+        self.assertEqual(self.recipe.files_list_by_category('misc'),
+                         ['README', 'share/cached'])
+        self._add_file('share/cached/a')
+        # cached until the recipe installs its files
+        self.assertEqual(self.recipe.files_list_by_category('misc'),
+                         ['README', 'share/cached'])
+        self.recipe.invalidate_files_cache()
+        self.assertEqual(self.recipe.files_list_by_category('misc'),
+                         ['README', 'share/cached/a'])
+
+    def testCopies(self):
+        self._add_file('README')
+        self.recipe.files_list_by_category('misc').append('foo')
+        self.recipe._list_files_by_category('misc').append('foo')
+        self.assertEqual(self.recipe.files_list_by_category('misc'),
+                         ['README', 'share/cached'])
+
+    def testInvalidateUniversal(self):
+        self._add_file('README')
+        self.recipe.files_list_by_category('misc')
+        universal = filesprovider.UniversalFilesProvider.__new__(
+            filesprovider.UniversalFilesProvider)
+        universal._recipes = {'x86_64': self.recipe}
+        universal.__dict__['_files_cache'] = {}
+        universal.invalidate_files_cache()
+        self.assertNotIn('_files_cache', universal.__dict__)
+        self.assertNotIn('_files_cache', self.recipe.__dict__)
+
+
+class InstallIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = Config(self.tmp, Platform.LINUX)
+        self.recipe = CachedFilesProvider(self.config)
+        for f in ['README', 'share/cached/a', 'lib/libcached.so.1']:
+            path = os.path.join(self.tmp, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        get_install_manifests(self.tmp).save('cached',
+            ['README', 'share/cached/a', 'lib/libcached.so.1'])
+        # the files are looked up in the install manifest, not in the prefix
+        shutil.rmtree(os.path.join(self.tmp, 'share'))
+        shutil.rmtree(os.path.join(self.tmp, 'lib'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testLsFiles(self):
+        self.assertEqual(sorted(self.recipe._ls_files(['share/cached/*',
+                                                       'README'])),
+                         ['README', 'share/cached/a'])
+        # patterns not found in the manifest are searched in the prefix
+        open(os.path.join(self.tmp, 'NEWS'), 'w').close()
+        self.assertEqual(sorted(self.recipe._ls_files(['README NEWS'])),
+                         ['NEWS', 'README'])
+
+    def testIsDir(self):
+        self.assertTrue(self.recipe._is_dir('share/cached'))
+        self.assertFalse(self.recipe._is_dir('share/cached/a'))
+        self.assertFalse(self.recipe._is_dir('share/other'))
+
+    def testFindShlibRegex(self):
+        index = self.recipe._install_index()
+        regex = filesprovider.FilesProvider._LINUX_SO_REGEX
+        self.assertEqual(filesprovider.find_shlib_regex(self.config,
+            'cached', self.tmp, 'lib', '.so', regex, index),
+            ['lib/libcached.so.1'])
+        self.assertEqual(filesprovider.find_shlib_regex(self.config,
+            'cached', self.tmp, 'lib', '.so', regex), [])
+
+    def testIncompleteManifest(self):
+        # reinstalled directly in the prefix, only the files that changed
+        # were recorded
+        for f in ['include/cached/a.h', 'include/cached/b.h',
+                  'lib/libcached.so.1']:
+            path = os.path.join(self.tmp, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        get_install_manifests(self.tmp).save('cached',
+            ['include/cached/a.h'], complete=False)
+        self.assertIsNone(self.recipe._install_index())
+        self.assertEqual(sorted(self.recipe._ls_installed_dir('include/cached')),
+                         ['include/cached/a.h', 'include/cached/b.h'])
+        self.assertTrue(self.recipe._is_dir('lib'))
+        regex = filesprovider.FilesProvider._LINUX_SO_REGEX
+        self.assertEqual(filesprovider.find_shlib_regex(self.config,
+            'cached', self.tmp, 'lib', '.so', regex,
+            self.recipe._install_index()), ['lib/libcached.so.1'])
@@ -0,0 +1,70 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import unittest
+
+from cerbero.build.oven import BuildGraph
+from cerbero.errors import FatalError
+
+
+class BuildGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        # a -> b -> d
+        #   -> c -> d -> e
+        self.graph = BuildGraph({
+            'a': [],
+            'b': ['a'],
+            'c': ['a', 'a'],
+            'd': ['b', 'c'],
+            'e': ['d'],
+            'f': [],
+        })
+
+    def testOrder(self):
+        order = self.graph.order
+        self.assertEqual(sorted(order), ['a', 'b', 'c', 'd', 'e', 'f'])
+        for name, deps in self.graph.deps.items():
+            for dep in deps:
+                self.assertLess(order.index(dep), order.index(name))
+
+    def testDeduplicatedDeps(self):
+        self.assertEqual(self.graph.deps['c'], ['a'])
+        self.assertEqual(sorted(self.graph.rdeps['a']), ['b', 'c'])
+
+    def testLevels(self):
+        self.assertEqual(self.graph.levels,
+            {'a': 0, 'b': 1, 'c': 1, 'd': 2, 'e': 3, 'f': 0})
+
+    def testRdepsCount(self):
+        self.assertEqual(self.graph.rdeps_count,
+            {'a': 4, 'b': 2, 'c': 2, 'd': 1, 'e': 0, 'f': 0})
+
+    def testRemainingPath(self):
+        self.assertEqual(self.graph.remaining_path,
+            {'a': 4, 'b': 3, 'c': 3, 'd': 2, 'e': 1, 'f': 1})
+
+    def testCycle(self):
+        self.assertRaises(FatalError, BuildGraph,
+                          {'a': ['c'], 'b': ['a'], 'c': ['b'], 'd': []})
+
+    def testWeightedRemainingPath(self):
+        graph = BuildGraph(self.graph.deps,
+            {'a': 1, 'b': 10, 'c': 2, 'd': 1, 'e': 5, 'f': 30})
+        self.assertEqual(graph.remaining_path,
+            {'a': 17, 'b': 16, 'c': 8, 'd': 6, 'e': 5, 'f': 30})
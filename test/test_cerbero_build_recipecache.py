@@ -0,0 +1,198 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build import recipe as crecipe
+from cerbero.build.build import BuildType, Meson
+from cerbero.build.recipecache import RecipesCache, LazyRecipe, \
+    invalid_recipe_error
+from cerbero.build.source import SourceType, Source, Tarball, Git
+from cerbero.errors import InvalidRecipeError
+
+
+class FakeConfig(object):
+
+    _properties = ['prefix', 'variants', 'num_of_cpus']
+
+    def __init__(self, prefix='/test', num_of_cpus=1):
+        self.prefix = prefix
+        self.variants = set(['debug'])
+        self.num_of_cpus = num_of_cpus
+
+
+class FakeRecipe(object):
+
+    name = 'recipe'
+    version = '1.0'
+    deps = ['dep1']
+    platform_deps = {}
+    stype = SourceType.TARBALL
+    btype = BuildType.MESON
+    files_libs = ['libfoo']
+
+    def list_deps(self):
+        return self.deps
+
+    def built_version(self):
+        return self.version
+
+
+class TarballRecipe(FakeRecipe, Tarball):
+
+    def __init__(self):
+        pass
+
+
+def real_recipe_class():
+    # Recipe classes are defined in the recipe files like this one, and get
+    # their source and build classes from MetaRecipe
+
+    class Recipe(crecipe.Recipe):
+        name = 'recipe'
+        version = '1.0'
+        stype = SourceType.TARBALL
+        btype = BuildType.MESON
+
+        def __init__(self):
+            pass
+
+        def list_deps(self):
+            return []
+
+    return Recipe
+
+
+class LazyRecipeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.loaded = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _cache(self, config=None):
+        return RecipesCache(os.path.join(self.cache_dir, 'test.recipes'),
+                            config or FakeConfig())
+
+    def _lazy_recipe(self, recipe_class=FakeRecipe):
+        cache = self._cache()
+        cache.set(__file__, b'', [recipe_class()], {})
+        meta, invalid = cache.get(__file__, b'')
+
+        def loader():
+            self.loaded.append(True)
+            return recipe_class()
+        return LazyRecipe(meta[0], loader)
+
+    def testCachedAttributes(self):
+        recipe = self._lazy_recipe()
+        self.assertEqual(recipe.name, 'recipe')
+        self.assertEqual(recipe.version, '1.0')
+        self.assertEqual(recipe.list_deps(), ['dep1'])
+        self.assertEqual(recipe.files_libs, ['libfoo'])
+        self.assertEqual(recipe.stype, SourceType.TARBALL)
+        self.assertEqual(recipe.btype, BuildType.MESON)
+        recipe.offline = True
+        self.assertTrue(recipe.offline)
+        self.assertFalse(recipe.is_loaded())
+        self.assertEqual(self.loaded, [])
+
+    def testLoad(self):
+        recipe = self._lazy_recipe()
+        recipe.offline = True
+        self.assertEqual(recipe.built_version(), '1.0')
+        self.assertTrue(recipe.is_loaded())
+        self.assertTrue(isinstance(recipe, FakeRecipe))
+        self.assertTrue(recipe.load().offline)
+        recipe.name = 'renamed'
+        self.assertEqual(recipe.load().name, 'renamed')
+        self.assertEqual(len(self.loaded), 1)
+
+    def testIsInstance(self):
+        recipe = self._lazy_recipe(TarballRecipe)
+        self.assertTrue(isinstance(recipe, Tarball))
+        self.assertTrue(isinstance(recipe, Source))
+        self.assertFalse(isinstance(recipe, Git))
+        self.assertTrue(isinstance(recipe, LazyRecipe))
+        self.assertFalse(recipe.is_loaded())
+        recipe = self._lazy_recipe(real_recipe_class())
+        self.assertTrue(isinstance(recipe, crecipe.Recipe))
+        self.assertTrue(isinstance(recipe, Meson))
+        self.assertTrue(isinstance(recipe, Tarball))
+        self.assertFalse(isinstance(recipe, Git))
+        self.assertFalse(recipe.is_loaded())
+        # without classes in the cache the recipe is loaded
+        recipe = self._lazy_recipe()
+        self.assertTrue(isinstance(recipe, FakeRecipe))
+        self.assertTrue(recipe.is_loaded())
+
+
+class RecipesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'cache', 'test.recipes')
+        self.recipe_file = os.path.join(self.tmp, 'recipe.recipe')
+        with open(self.recipe_file, 'w') as f:
+            f.write('class Recipe: pass')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _set(self, config):
+        cache = RecipesCache(self.filename, config)
+        e = InvalidRecipeError('invalid', 'wrong platform')
+        cache.set(self.recipe_file, b'custom', [FakeRecipe()],
+                  {'invalid': e})
+        cache.save()
+
+    def testPersist(self):
+        self._set(FakeConfig())
+        cache = RecipesCache(self.filename, FakeConfig())
+        meta, invalid = cache.get(self.recipe_file, b'custom')
+        self.assertEqual(meta[0]['attrs']['name'], 'recipe')
+        self.assertEqual(meta[0]['list_deps'], ['dep1'])
+        self.assertEqual(list(invalid.keys()), ['invalid'])
+        e = invalid_recipe_error('invalid', invalid['invalid'])
+        self.assertTrue(isinstance(e, InvalidRecipeError))
+        self.assertEqual(str(e), str(InvalidRecipeError('invalid',
+                                                        'wrong platform')))
+
+    def testIgnoredProperties(self):
+        self._set(FakeConfig())
+        cache = RecipesCache(self.filename, FakeConfig(num_of_cpus=8))
+        self.assertIsNotNone(cache.get(self.recipe_file, b'custom'))
+
+    def testInvalidation(self):
+        self._set(FakeConfig())
+        # custom.py changed
+        cache = RecipesCache(self.filename, FakeConfig())
+        self.assertIsNone(cache.get(self.recipe_file, b'other'))
+        # config changed
+        cache = RecipesCache(self.filename, FakeConfig(prefix='/other'))
+        self.assertIsNone(cache.get(self.recipe_file, b'custom'))
+        # recipe changed
+        with open(self.recipe_file, 'a') as f:
+            f.write('\n')
+        cache = RecipesCache(self.filename, FakeConfig())
+        self.assertIsNone(cache.get(self.recipe_file, b'custom'))
@@ -0,0 +1,109 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+from cerbero.build import sourcestore
+from cerbero.build.sourcestore import SourceStore
+
+
+CONTENT = b'tarball contents'
+CHECKSUM = hashlib.sha256(CONTENT).hexdigest()
+
+
+class SourceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = SourceStore(os.path.join(self.tmp, 'store'))
+        self.linux = self._write('linux', CONTENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name, 'pkg', 'pkg-1.0.tar.xz')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testAddAndLink(self):
+        self.assertFalse(self.store.link(CHECKSUM, self.linux))
+        self.store.add(self.linux, CHECKSUM)
+        self.assertTrue(self.store.has(CHECKSUM))
+        android = os.path.join(self.tmp, 'android', 'pkg', 'pkg-1.0.tar.xz')
+        self.assertTrue(self.store.link(CHECKSUM, android))
+        blob = self.store.blob_path(CHECKSUM)
+        self.assertTrue(os.path.samefile(self.linux, blob))
+        self.assertTrue(os.path.samefile(android, blob))
+        self.assertEqual(self.store.refs(CHECKSUM), [self.linux, android])
+        # Linking again doesn't duplicate the reference
+        self.store.link(CHECKSUM, android)
+        self.assertEqual(len(self.store.refs(CHECKSUM)), 2)
+
+    def testAddExistingBlob(self):
+        self.store.add(self.linux, CHECKSUM)
+        windows = self._write('windows', CONTENT)
+        self.store.add(windows, CHECKSUM)
+        self.assertTrue(os.path.samefile(windows, self.linux))
+
+    def testCopyFallback(self):
+        with mock.patch('os.link', side_effect=OSError), \
+                mock.patch.object(sourcestore, 'reflink',
+                                  side_effect=OSError):
+            self.store.add(self.linux, CHECKSUM)
+            android = os.path.join(self.tmp, 'android', 'pkg-1.0.tar.xz')
+            self.store.link(CHECKSUM, android)
+        self.assertFalse(os.path.samefile(android, self.linux))
+        with open(android, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        # Copies are references too
+        os.remove(self.linux)
+        self.assertEqual(self.store.gc(), [])
+
+    def testGC(self):
+        self.store.add(self.linux, CHECKSUM)
+        other = self._write('other', b'other')
+        other_checksum = hashlib.sha256(b'other').hexdigest()
+        self.store.add(other, other_checksum)
+        os.remove(other)
+        # A new file in the path of a reference doesn't keep the blob
+        os.remove(self.linux)
+        self._write('linux', b'changed')
+        self.assertEqual(len(self.store.gc(dry_run=True)), 2)
+        self.assertTrue(self.store.has(CHECKSUM))
+        removed = self.store.gc()
+        self.assertEqual(sorted(removed),
+                         sorted([(CHECKSUM, len(CONTENT)),
+                                 (other_checksum, len(b'other'))]))
+        self.assertFalse(self.store.has(CHECKSUM))
+        self.assertFalse(os.path.exists(self.store.refs_path(CHECKSUM)))
+
+    def testGCKeepsReferenced(self):
+        self.store.add(self.linux, CHECKSUM)
+        android = os.path.join(self.tmp, 'android', 'pkg-1.0.tar.xz')
+        self.store.link(CHECKSUM, android)
+        os.remove(self.linux)
+        self.assertEqual(self.store.gc(), [])
+        self.assertEqual(self.store.refs(CHECKSUM), [android])
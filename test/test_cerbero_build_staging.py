@@ -0,0 +1,208 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import stat
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build.filesprovider import glob_index
+from cerbero.build.staging import StagedInstall, InstallManifests, \
+    PrefixSnapshot, get_install_manifests
+from cerbero.errors import FatalError
+from test.test_common import DummyConfig
+
+
+class StagedInstallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = DummyConfig()
+        self.config.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.config.prefix)
+
+    def _stage(self, recipe_name, files):
+        staging = StagedInstall(self.config, recipe_name)
+        staging.prepare()
+        for f in files:
+            path = staging.destdir + os.path.join(self.config.prefix, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fd:
+                fd.write(recipe_name)
+        return staging
+
+    def testCommit(self):
+        staging = self._stage('a', ['lib/liba.so', 'include/a.h'])
+        os.symlink('liba.so', staging.destdir +
+                   os.path.join(self.config.prefix, 'lib', 'liba.so.0'))
+        staging.commit()
+        self.assertFalse(os.path.exists(staging.destdir))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.config.prefix, 'include', 'a.h')))
+        self.assertEqual(os.readlink(
+            os.path.join(self.config.prefix, 'lib', 'liba.so.0')), 'liba.so')
+        manifests = InstallManifests(self.config.prefix)
+        self.assertEqual(manifests.get_files('a'),
+            ['include/a.h', 'lib/liba.so', 'lib/liba.so.0'])
+        self.assertEqual(manifests.get_owner('lib/liba.so'), 'a')
+        self.assertIsNone(manifests.get_files('b'))
+
+    def testReinstall(self):
+        self._stage('a', ['lib/liba.so']).commit()
+        self._stage('a', ['lib/liba.so']).commit()
+
+    def testNothingStaged(self):
+        self._stage('a', ['lib/liba.so']).commit()
+        # installed in the prefix ignoring DESTDIR
+        staging = self._stage('a', [])
+        self.assertRaises(FatalError, staging.commit)
+        self.assertFalse(os.path.exists(staging.destdir))
+        self.assertIsNone(InstallManifests(self.config.prefix).get_files('a'))
+
+    def testCollision(self):
+        self._stage('a', ['lib/liba.so', 'include/common.h']).commit()
+        staging = self._stage('b', ['lib/libb.so', 'include/common.h'])
+        self.assertRaises(FatalError, staging.commit)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.config.prefix, 'lib', 'libb.so')))
+        with open(os.path.join(self.config.prefix, 'include', 'common.h')) as f:
+            self.assertEqual(f.read(), 'a')
+
+
+class InstallManifestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def _write(self, f, content):
+        path = os.path.join(self.prefix, f)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    def testEntries(self):
+        self._write('lib/liba.so', 'a')
+        os.symlink('liba.so', os.path.join(self.prefix, 'lib', 'liba.so.0'))
+        manifests = InstallManifests(self.prefix)
+        manifests.save('a', ['lib/liba.so', 'lib/liba.so.0', 'lib/missing'])
+        entries = InstallManifests(self.prefix).get_entries('a')
+        self.assertEqual(sorted(entries), ['lib/liba.so', 'lib/liba.so.0'])
+        self.assertEqual(entries['lib/liba.so']['size'], 1)
+        self.assertTrue(stat.S_ISREG(entries['lib/liba.so']['mode']))
+        self.assertTrue(stat.S_ISLNK(entries['lib/liba.so.0']['mode']))
+        self.assertNotEqual(entries['lib/liba.so']['hash'],
+                            entries['lib/liba.so.0']['hash'])
+        self.assertEqual(manifests.get_index('a'),
+            frozenset(['lib', 'lib/liba.so', 'lib/liba.so.0']))
+        self.assertTrue(InstallManifests(self.prefix).is_complete('a'))
+        self.assertFalse(manifests.is_complete('b'))
+
+    def testUpdate(self):
+        self._write('lib/liba.so', 'a')
+        self._write('lib/a.pc', 'a')
+        manifests = InstallManifests(self.prefix)
+        manifests.save('a', ['lib/liba.so', 'lib/a.pc'])
+        old = manifests.get_entries('a')
+        self._write('lib/a.pc', 'fixed')
+        self._write('share/licenses/a/COPYING', 'a')
+        os.remove(os.path.join(self.prefix, 'lib', 'liba.so'))
+        manifests.update('a', ['share/licenses/a/COPYING'])
+        entries = InstallManifests(self.prefix).get_entries('a')
+        self.assertEqual(sorted(entries),
+                         ['lib/a.pc', 'share/licenses/a/COPYING'])
+        self.assertNotEqual(entries['lib/a.pc']['hash'],
+                            old['lib/a.pc']['hash'])
+        self.assertTrue(manifests.is_complete('a'))
+        manifests.save('a', ['lib/a.pc'], complete=False)
+        manifests.update('a')
+        self.assertFalse(InstallManifests(self.prefix).is_complete('a'))
+        # recipes without manifest are not updated
+        manifests.update('b', ['lib/a.pc'])
+        self.assertIsNone(manifests.get_entries('b'))
+
+    def testOldFormat(self):
+        manifests = InstallManifests(self.prefix)
+        path = manifests.manifest_path('a')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump({'files': ['lib/liba.so']}, f)
+        self.assertEqual(manifests.get_files('a'), ['lib/liba.so'])
+        self.assertEqual(manifests.get_entries('a'), {'lib/liba.so': None})
+        self.assertEqual(manifests.get_owner('lib/liba.so'), 'a')
+        # not known to list all the files
+        self.assertFalse(manifests.is_complete('a'))
+        manifests.remove('a')
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(manifests.get_files('a'))
+        self.assertIsNone(manifests.get_owner('lib/liba.so'))
+
+    def testGlobIndex(self):
+        index = frozenset(['lib', 'lib/liba.so', 'lib/liba.so.0',
+                           'lib/pkgconfig', 'lib/pkgconfig/a.pc'])
+        self.assertEqual(sorted(glob_index(index, 'lib/liba.so*')),
+                         ['lib/liba.so', 'lib/liba.so.0'])
+        self.assertEqual(glob_index(index, 'lib/*/a.pc'),
+                         ['lib/pkgconfig/a.pc'])
+        self.assertEqual(sorted(glob_index(index, 'lib/*')),
+                         ['lib/liba.so', 'lib/liba.so.0', 'lib/pkgconfig'])
+        self.assertEqual(glob_index(index, 'lib/liba.so'), ['lib/liba.so'])
+        self.assertEqual(glob_index(index, 'lib/libb.so'), [])
+
+
+class PrefixSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def _write(self, f, content):
+        path = os.path.join(self.prefix, f)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    def testSaveManifest(self):
+        self._write('lib/libold.so', 'old')
+        self._write('lib/libb.so', 'b')
+        get_install_manifests(self.prefix).save('b', ['lib/libb.so'])
+        snapshot = PrefixSnapshot(self.prefix)
+        self._write('lib/liba.so', 'a')
+        os.symlink('liba.so', os.path.join(self.prefix, 'lib', 'liba.so.0'))
+        self._write('include/a.h', 'a')
+        # rewritten with the same contents and modification time
+        path = os.path.join(self.prefix, 'lib', 'libold.so')
+        st = os.stat(path)
+        os.remove(path)
+        self._write('lib/libold.so', 'old')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        # installed by another recipe in the meantime
+        self._write('lib/libb.so', 'b2')
+        self.assertEqual(snapshot.changed_files(), ['include/a.h',
+            'lib/liba.so', 'lib/liba.so.0', 'lib/libb.so', 'lib/libold.so'])
+        snapshot.save_manifest('a')
+        self.assertEqual(InstallManifests(self.prefix).get_files('a'),
+            ['include/a.h', 'lib/liba.so', 'lib/liba.so.0', 'lib/libold.so'])
+        self.assertFalse(InstallManifests(self.prefix).is_complete('a'))
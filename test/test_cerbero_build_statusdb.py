@@ -0,0 +1,127 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build.cookbook import CookBook, RecipeStatus
+from cerbero.build.statusdb import StatusDB
+from test.test_common import DummyConfig
+
+
+class StatusDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'test.sqlite')
+        self.db = StatusDB(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def testPutDelete(self):
+        self.db.put('a', RecipeStatus('a.recipe', steps=['fetch'],
+                                      file_hash=b'1234'))
+        self.db.put('b', RecipeStatus('b.recipe', steps=[],
+                                      built_version='1.0'))
+        self.db.put('a', RecipeStatus('a.recipe', steps=['fetch', 'build'],
+                                      needs_build=False, file_hash=b'1234'))
+        self.db.delete('b')
+        status = self.db.load()
+        self.assertEqual(list(status.keys()), ['a'])
+        self.assertEqual(status['a']['steps'], ['fetch', 'build'])
+        self.assertFalse(status['a']['needs_build'])
+        self.assertEqual(status['a']['file_hash'], b'1234')
+        self.assertEqual(status['a']['filepath'], 'a.recipe')
+
+    def testConcurrentReader(self):
+        self.db.put('a', RecipeStatus('a.recipe', steps=['fetch']))
+        reader = StatusDB(self.filename)
+        self.db.put('a', RecipeStatus('a.recipe', steps=['fetch', 'build']))
+        self.assertEqual(reader.load()['a']['steps'], ['fetch', 'build'])
+        reader.close()
+
+    def testImportPickle(self):
+        cache = os.path.join(self.tmp, 'test.cache')
+        with open(cache, 'wb') as f:
+            pickle.dump({'a': RecipeStatus('a.recipe', steps=['fetch'])}, f)
+        self.assertTrue(self.db.import_pickle(cache))
+        self.assertEqual(self.db.load()['a']['steps'], ['fetch'])
+        # only imported once
+        self.db.delete('a')
+        self.assertFalse(self.db.import_pickle(cache))
+        self.assertEqual(self.db.load(), {})
+
+
+class FakeRecipe(object):
+
+    name = 'recipe1'
+    __file__ = 'recipe1.recipe'
+
+    def get_checksum(self):
+        return b'1234'
+
+
+class CookBookStatusDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = DummyConfig()
+        self.config.home_dir = self.tmp
+        self.config.cache_file = 'test.cache'
+        self.config.status_db = True
+        self.config.arch_config = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _cookbook(self):
+        cookbook = CookBook(self.config, False)
+        cookbook.add_recipe(FakeRecipe())
+        cookbook._restore_cache()
+        return cookbook
+
+    def testUpdateStatus(self):
+        cookbook = self._cookbook()
+        cookbook.update_step_status('recipe1', 'fetch')
+        cookbook.update_build_status('recipe1', '1.0')
+        cookbook = self._cookbook()
+        self.assertTrue(cookbook.step_done('recipe1', 'fetch'))
+        self.assertEqual(cookbook.recipe_built_version('recipe1'), '1.0')
+        cookbook.reset_recipe_status('recipe1')
+        cookbook = self._cookbook()
+        self.assertEqual(cookbook.status, {})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'test.cache')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'test.sqlite')))
+
+    def testSaveOnlyChanged(self):
+        cookbook = self._cookbook()
+        cookbook.update_step_status('recipe1', 'fetch')
+        other = self._cookbook()
+        cookbook = self._cookbook()
+        other.update_step_status('recipe1', 'extract')
+        # the record updated by the other process is not overwritten
+        cookbook.save()
+        self.assertTrue(self._cookbook().step_done('recipe1', 'extract'))
+        cookbook.status['recipe1'].steps.append('configure')
+        cookbook.save()
+        self.assertTrue(self._cookbook().step_done('recipe1', 'configure'))
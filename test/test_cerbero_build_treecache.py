@@ -0,0 +1,97 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cerbero.build.treecache import SourceTreeCache, copy_tree
+
+
+class SourceTreeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = SourceTreeCache(os.path.join(self.tmp, 'cache'))
+        self.src = os.path.join(self.tmp, 'src')
+        self._write(os.path.join(self.src, 'configure'), 'configure', 1000)
+        self._write(os.path.join(self.src, 'sub', 'Makefile.in'), 'in', 2000)
+        self._write(os.path.join(self.src, '.git', 'objects', 'ab', 'cdef'),
+                    'object', 3000)
+        os.symlink('sub', os.path.join(self.src, 'link'))
+        self.patches = [os.path.join(self.tmp, '0001.patch'),
+                        os.path.join(self.tmp, '0002.patch')]
+        self._write(self.patches[0], 'patch 1', 0)
+        self._write(self.patches[1], 'patch 2', 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, path, content, mtime):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def _read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def testKey(self):
+        key = self.cache.key('abc', self.patches, 1)
+        self.assertEqual(key, self.cache.key('abc', self.patches, 1))
+        self.assertNotEqual(key, self.cache.key('abd', self.patches, 1))
+        self.assertNotEqual(key, self.cache.key('abc', self.patches, 0))
+        self.assertNotEqual(key, self.cache.key('abc', self.patches[::-1], 1))
+        self._write(self.patches[1], 'patch 2 changed', 0)
+        self.assertNotEqual(key, self.cache.key('abc', self.patches, 1))
+
+    def testPutAndGet(self):
+        key = self.cache.key('abc', self.patches, 1)
+        dest = os.path.join(self.tmp, 'dest')
+        self.assertFalse(self.cache.get(key, dest))
+        self.cache.put(key, self.src)
+        self.assertTrue(self.cache.get(key, dest))
+        self.assertEqual(self._read(os.path.join(dest, 'sub', 'Makefile.in')),
+                         'in')
+        self.assertEqual(os.stat(os.path.join(dest, 'configure')).st_mtime,
+                         1000)
+        self.assertEqual(os.readlink(os.path.join(dest, 'link')), 'sub')
+        tree = self.cache.tree_path(key)
+        # Git objects are shared, the work tree is not
+        self.assertTrue(os.path.samefile(
+            os.path.join(dest, '.git', 'objects', 'ab', 'cdef'),
+            os.path.join(tree, '.git', 'objects', 'ab', 'cdef')))
+        self.assertFalse(os.path.samefile(os.path.join(dest, 'configure'),
+                                          os.path.join(tree, 'configure')))
+        # Builds in the source tree don't change the cache
+        self._write(os.path.join(dest, 'configure'), 'changed', 0)
+        dest2 = os.path.join(self.tmp, 'dest2')
+        self.assertTrue(self.cache.get(key, dest2))
+        self.assertEqual(self._read(os.path.join(dest2, 'configure')),
+                         'configure')
+
+    def testCopyTree(self):
+        dest = os.path.join(self.tmp, 'copy')
+        copy_tree(self.src, dest)
+        self.assertEqual(sorted(os.listdir(dest)),
+                         ['.git', 'configure', 'link', 'sub'])
+        self.assertTrue(os.path.islink(os.path.join(dest, 'link')))
+        self.assertEqual(os.stat(os.path.join(dest, 'sub',
+                                              'Makefile.in')).st_mtime, 2000)
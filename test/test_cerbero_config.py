@@ -20,6 +20,7 @@ import os
 import sys
 import tempfile
 import unittest
+from unittest import mock
 
 from cerbero import config as cconfig
 from cerbero.enums import Platform
@@ -85,6 +86,20 @@ class LinuxPackagesTest(unittest.TestCase):
                                                    sys.version_info[1]),
                  'allow_parallel_build': cconfig.DEFAULT_ALLOW_PARALLEL_BUILD,
                  'use_configure_cache': False,
+                 'staged_install': False,
+                 'snapshot_installs': False,
+                 'admission_control': False,
+                 'artifact_cache': None,
+                 'artifact_cache_max_size': 20,
+                 'recipes_cache': False,
+                 'status_db': False,
+                 'native_downloads': False,
+                 'mirror_ranking': False,
+                 'source_store': None,
+                 'stream_extract': False,
+                 'source_tree_cache': None,
+                 'git_object_store': None,
+                 'git_fetch_mode': None,
                  'allow_system_libs': True,
                  'external_packages': {},
                  'external_recipes': {},
@@ -203,3 +218,22 @@ class LinuxPackagesTest(unittest.TestCase):
                     'test1': ('/path/to/repo', 1),
                     'test2': ('/path/to/other/repo', 2)}
         self.assertEqual(config.get_packages_repos(), expected)
+
+    def testCopy(self):
+        config = Config()
+        config.load_defaults()
+        config.config_env = {'CFLAGS': '-O2'}
+        config.extra_mirrors = ['https://mirror']
+        c = config._copy(cconfig.Architecture.ARM64)
+        self.assertEqual(c.target_arch, cconfig.Architecture.ARM64)
+        self.assertEqual(c.arch_config, {cconfig.Architecture.ARM64: c})
+        self.assertEqual(c.prefix, config.prefix)
+        c.config_env['CFLAGS'] += ' -g'
+        c.extra_mirrors.append('https://other')
+        self.assertEqual(config.config_env, {'CFLAGS': '-O2'})
+        self.assertEqual(config.extra_mirrors, ['https://mirror'])
+        # the references to other configs are not deep copied
+        with mock.patch.object(Config, '__deepcopy__', create=True,
+                               side_effect=AssertionError('deepcopy')):
+            c = config._copy(cconfig.Architecture.X86)
+        self.assertIs(c._pre_environ, config._pre_environ)
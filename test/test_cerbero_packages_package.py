@@ -17,11 +17,15 @@
 # Boston, MA 02111-1307, USA.
 
 import shutil
+import threading
 import unittest
 import tempfile
 
 from cerbero.config import Platform, Distro, DistroVersion
+from cerbero.errors import FatalError
 from cerbero.packages import PackageType
+from cerbero.packages import package
+from cerbero.packages.package import resolve_files_queries, list_files_or_queries
 from test.test_packages_common import Package1, Package4, MetaPackage, App
 from test.test_build_common import create_cookbook, add_files
 from test.test_packages_common import create_store
@@ -201,3 +205,77 @@ class AppPackageTest(unittest.TestCase):
 
     def testAllFilesList(self):
         self.assertEqual(self.app.files_list(), self.app.all_files_list())
+
+
+class FakeRecipe(object):
+
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.calls = []
+
+    def dist_files_list(self):
+        self.calls.append(threading.current_thread())
+        return self.files[:]
+
+    def files_list_by_categories(self, categories):
+        self.calls.append(threading.current_thread())
+        if 'missing' in categories:
+            raise FatalError('missing files in %s' % self.name)
+        return ['%s/%s' % (self.name, c) for c in categories]
+
+
+class FakeCookBook(object):
+
+    def __init__(self, recipes):
+        self.recipes = dict(((r.name, r) for r in recipes))
+
+    def get_recipe(self, name):
+        return self.recipes[name]
+
+
+class ResolveFilesQueriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeRecipe('a', ['lib/a.so', 'common'])
+        self.b = FakeRecipe('b', ['lib/b.so', 'common'])
+        self.cookbook = FakeCookBook([self.a, self.b])
+
+    def testMerge(self):
+        queries = [('b', 'dist_files_list', ()),
+                   ('a', 'dist_files_list', ()),
+                   ('a', 'files_list_by_categories', (('bins',),)),
+                   ('a', 'dist_files_list', ())]
+        self.assertEqual(resolve_files_queries(self.cookbook, queries, 2),
+            ['a/bins', 'common', 'lib/a.so', 'lib/b.so'])
+        # duplicated queries run once and the queries of a recipe run in the
+        # same thread
+        self.assertEqual(len(self.a.calls), 2)
+        self.assertEqual(self.a.calls[0], self.a.calls[1])
+        self.assertEqual(resolve_files_queries(self.cookbook, []), [])
+
+    def testError(self):
+        queries = [('a', 'dist_files_list', ()),
+                   ('b', 'files_list_by_categories', (('missing',),))]
+        self.assertRaises(FatalError, resolve_files_queries, self.cookbook,
+                          queries, 2)
+
+    def testListFilesOrQueries(self):
+
+        class DevelTemplatePackage(package.Package):
+
+            def devel_files_list(self):
+                return ['template']
+
+        p1 = package.Package.__new__(package.Package)
+        p2 = DevelTemplatePackage.__new__(DevelTemplatePackage)
+        for p in [p1, p2]:
+            p._recipes_files = {'a': []}
+            p._recipes_files_devel = {}
+        files, queries = list_files_or_queries(
+            [p1, p2], ['files_list', 'devel_files_list'])
+        # the overridden method is called, the others give their queries
+        self.assertEqual(files, ['template'])
+        self.assertEqual(queries, [('a', 'dist_files_list', ()),
+                                   ('a', 'devel_files_list', ()),
+                                   ('a', 'dist_files_list', ())])
@@ -0,0 +1,145 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+from cerbero.tools import implib
+
+
+def coff_object(sections):
+    '''
+    Creates a COFF object with sections of (name, data)
+    '''
+    header = struct.pack('<HHIIIHH', 0x8664, len(sections), 0, 0, 0, 0, 0)
+    offset = len(header) + 40 * len(sections)
+    headers = b''
+    contents = b''
+    for name, data in sections:
+        headers += struct.pack('<8sIIIIIIHHI', name, 0, 0, len(data),
+                               offset + len(contents), 0, 0, 0, 0, 0)
+        contents += data
+    return header + headers + contents
+
+
+def short_import(symbol, dllname):
+    data = symbol + b'\x00' + dllname + b'\x00'
+    return struct.pack('<HHHHIIHH', 0, 0xffff, 0, 0x8664, 0, len(data), 0,
+                       0) + data
+
+
+def ar_archive(members):
+    '''
+    Creates an archive with members of (name, data), using the GNU table
+    for the long names
+    '''
+    longnames = b''
+    content = b''
+    for name, data in members:
+        if len(name) > 15:
+            ar_name = b'/%d' % len(longnames)
+            longnames += name + b'/\n'
+        else:
+            ar_name = name + b'/'
+        content += ar_header(ar_name, len(data)) + data
+        if len(data) % 2:
+            content += b'\n'
+    symtab = ar_header(b'/', 4) + b'\x00' * 4
+    if longnames:
+        symtab += ar_header(b'//', len(longnames)) + longnames
+        if len(longnames) % 2:
+            symtab += b'\n'
+    return implib.AR_MAGIC + symtab + content
+
+
+def ar_header(name, size):
+    return b'%-16s%-12d%-6d%-6d%-8d%-10d`\n' % (name, 0, 0, 0, 644, size)
+
+
+class ImplibTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        implib._dllnames.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testGnuImportLibrary(self):
+        # dlltool puts a relocation to the name in the .idata$7 section of
+        # the objects of the symbols and the name in the tail object
+        path = self._write('libfoo.dll.a', ar_archive([
+            (b'd000000.o', coff_object([(b'.idata$2', b'\x00' * 20)])),
+            (b'd000001.o', coff_object([(b'.idata$7', b'\x00' * 4),
+                                        (b'.idata$6', b'\x00\x00foo\x00')])),
+            (b'libfoo_dll_iname_tail.o',
+             coff_object([(b'.text', b''),
+                          (b'.idata$7', b'libfoo-1.dll\x00\x00')]))]))
+        self.assertEqual(implib.read_dllname(path), 'libfoo-1.dll')
+
+    def testShortImportLibrary(self):
+        path = self._write('foo.lib', ar_archive([
+            (b'foo.dll', coff_object([(b'.idata$2', b'\x00' * 20)])),
+            (b'foo.dll', short_import(b'foo', b'foo-1.dll'))]))
+        self.assertEqual(implib.read_dllname(path), 'foo-1.dll')
+
+    def testMemberNames(self):
+        path = self._write('foo.lib', ar_archive([
+            (b'foo-1.dll', coff_object([(b'.idata$2', b'\x00' * 20)])),
+            (b'foo-1.dll', coff_object([(b'.idata$6', b'foo-1.dll\x00')]))]))
+        self.assertEqual(implib.read_dllname(path), 'foo-1.dll')
+
+    def testNotImportLibrary(self):
+        self.assertIsNone(implib.read_dllname(
+            self._write('foo.a', ar_archive([(b'foo.o', coff_object([]))]))))
+        self.assertIsNone(implib.read_dllname(
+            self._write('foo.lib', b'garbage')))
+
+    def testMemoized(self):
+        data = ar_archive([(b'foo.dll', short_import(b'foo', b'foo.dll'))])
+        path = self._write('foo.lib', data)
+        with mock.patch.object(implib, 'read_dllname',
+                               wraps=implib.read_dllname) as read:
+            self.assertEqual(implib.get_dllname(path), 'foo.dll')
+            self.assertEqual(implib.get_dllname(path), 'foo.dll')
+            self.assertEqual(read.call_count, 1)
+            self._write('foo.lib', ar_archive(
+                [(b'bar.dll', short_import(b'bar', b'bar-1.dll'))]))
+            self.assertEqual(implib.get_dllname(path), 'bar-1.dll')
+            self.assertEqual(read.call_count, 2)
+
+    @unittest.skipUnless(shutil.which('llvm-dlltool'), 'needs llvm-dlltool')
+    def testDlltool(self):
+        deffile = self._write('foo.def',
+                              b'LIBRARY libfoo-1.dll\nEXPORTS\nfoo\nbar\n')
+        path = os.path.join(self.tmp, 'libfoo.dll.a')
+        subprocess.check_call(['llvm-dlltool', '-m', 'i386:x86-64', '-d',
+                               deffile, '-l', path])
+        self.assertEqual(implib.read_dllname(path), 'libfoo-1.dll')
@@ -0,0 +1,96 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from cerbero.config import Platform
+from cerbero.tools import strip
+from test.test_common import DummyConfig
+
+
+class Config(DummyConfig):
+
+    def __init__(self):
+        self.target_platform = Platform.LINUX
+        self.env = {'STRIP': 'strip'}
+
+
+class StripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testIsStrippable(self):
+        for name, data in (('lib.so', b'\x7fELF\x02\x01\x01'),
+                           ('lib.dylib', b'\xcf\xfa\xed\xfe\x07\x00'),
+                           ('fat', b'\xca\xfe\xba\xbe\x00\x00\x00\x02'),
+                           ('lib.dll', b'MZ\x90\x00'),
+                           ('lib.a', b'!<arch>\n/')):
+            self.assertTrue(strip.is_strippable(self._write(name, data)),
+                            name)
+        for name, data in (('a.h', b'#include <stdio.h>\n'),
+                           ('a.pc', b'prefix=/usr\n'),
+                           ('A.class', b'\xca\xfe\xba\xbe\x00\x00\x00\x34'),
+                           ('empty', b'')):
+            self.assertFalse(strip.is_strippable(self._write(name, data)),
+                             name)
+        os.symlink('lib.so', os.path.join(self.tmp, 'lib.so.1'))
+        self.assertFalse(strip.is_strippable(
+            os.path.join(self.tmp, 'lib.so.1')))
+        self.assertFalse(strip.is_strippable(self.tmp))
+
+    def testStripFiles(self):
+        running = []
+        peak = []
+        cmds = []
+
+        async def async_call(cmd, *args, **kwargs):
+            cmds.append(cmd)
+            running.append(cmd)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(cmd)
+            if 'fail' in cmd[-1]:
+                raise Exception('strip failed')
+
+        s = strip.Strip(Config(), excludes=['excluded'])
+        files = [('a%d' % i, 'out/a%d' % i) for i in range(6)]
+        files += [('fail', 'out/fail'), ('excluded', None)]
+        with mock.patch.object(strip.shell, 'async_call', async_call):
+            ret = s.strip_files(files, jobs=2)
+        self.assertEqual(ret, [True] * 6 + [False, False])
+        self.assertEqual(max(peak), 2)
+        self.assertIn(['strip', '--strip-unneeded', '-o', 'out/a0', 'a0'],
+                      cmds)
+        self.assertEqual(len(cmds), 7)
+        self.assertEqual(s.strip_files([]), [])
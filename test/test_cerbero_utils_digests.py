@@ -0,0 +1,86 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+from cerbero.utils import digests
+from cerbero.utils.digests import DigestCache
+
+
+class DigestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'digests.cache')
+        self.path = os.path.join(self.tmp, 'file')
+        self._write(b'content', 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, content, mtime):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def _get(self, cache, algorithm=digests.DEFAULT_ALGORITHM):
+        with mock.patch.object(digests, 'file_digest',
+                               wraps=digests.file_digest) as file_digest:
+            digest = cache.get(self.path, algorithm)
+        return digest, file_digest.call_count
+
+    def testCached(self):
+        cache = DigestCache(self.filename)
+        digest, reads = self._get(cache)
+        self.assertEqual(reads, 1)
+        self.assertEqual(self._get(cache), (digest, 0))
+        cache.save()
+        # persisted
+        self.assertEqual(self._get(DigestCache(self.filename)), (digest, 0))
+        # sha256 is cached separately
+        self.assertEqual(self._get(cache, 'sha256'),
+                         (hashlib.sha256(b'content').digest(), 1))
+
+    def testChanged(self):
+        cache = DigestCache(self.filename)
+        digest, reads = self._get(cache)
+        # same size, different mtime
+        self._write(b'CONTENT', 2000)
+        new_digest, reads = self._get(cache)
+        self.assertEqual(reads, 1)
+        self.assertNotEqual(digest, new_digest)
+
+    def testRecentlyModified(self):
+        cache = DigestCache(self.filename)
+        os.utime(self.path)
+        self.assertEqual(self._get(cache)[1], 1)
+        self.assertEqual(self._get(cache)[1], 1)
+
+    def testFilesChecksum(self):
+        cache = DigestCache(self.filename)
+        other = os.path.join(self.tmp, 'other')
+        with open(other, 'wb') as f:
+            f.write(b'other')
+        checksum = cache.files_checksum([self.path, other])
+        self.assertEqual(checksum, cache.files_checksum([self.path, other]))
+        self.assertNotEqual(checksum, cache.files_checksum([self.path]))
@@ -0,0 +1,260 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import re
+import shutil
+import io
+import hashlib
+import tarfile
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cerbero.errors import FatalError
+from cerbero.utils import downloader, shell, run_until_complete
+from cerbero.utils.digests import DigestCache
+
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    ETAG = '"v1"'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            self._send_file()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send_file(self):
+        server = self.server
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match is None or not server.ranges:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(server.content)))
+            self.end_headers()
+            self.wfile.write(server.content)
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        data = server.content[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                         (start, end, len(server.content)))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', self.ETAG)
+        self.end_headers()
+        server.served += len(data)
+        self.wfile.write(data)
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, 'file.tar.xz')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.content = CONTENT
+        self.server.ranges = True
+        self.server.served = 0
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        patcher = mock.patch.object(downloader, 'CHUNK_SIZE', 10000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def _download(self, path='/file', **kwargs):
+        return run_until_complete(downloader.download(self.url + path,
+                                                      self.dest, **kwargs))
+
+    def testChunkedDownload(self):
+        digests = DigestCache(os.path.join(self.tmp, 'digests.cache'))
+        digest = self._download(digests=digests)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(digest, hashlib.sha256(CONTENT).digest())
+        # The file is not read again to verify it
+        with mock.patch('cerbero.utils.digests.file_digest') as file_digest:
+            self.assertEqual(digests.get(self.dest, 'sha256'), digest)
+            file_digest.assert_not_called()
+        ranges = [r for p, r in self.server.requests]
+        self.assertEqual(len(ranges), downloader.MAX_CONNECTIONS_PER_HOST + 1)
+        self.assertLessEqual(self.server.max_active,
+                             downloader.MAX_CONNECTIONS_PER_HOST)
+        self.assertFalse(os.path.exists(self.dest + downloader.PARTIAL_EXT))
+        self.assertFalse(os.path.exists(self.dest + downloader.STATE_EXT))
+
+    def testNoRanges(self):
+        self.server.ranges = False
+        digest = self._download()
+        self.assertEqual(digest, hashlib.sha256(CONTENT).digest())
+        self.assertEqual(len(self.server.requests), 1)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def testRedirect(self):
+        digest = self._download('/redirect')
+        self.assertEqual(digest, hashlib.sha256(CONTENT).digest())
+
+    def testResume(self):
+        n = downloader.MAX_CONNECTIONS_PER_HOST
+        length = len(CONTENT)
+        bounds = [length * i // n for i in range(n + 1)]
+        # The first chunk was downloaded completely and the second one half
+        chunks = [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+        chunks[0][2] = bounds[1]
+        chunks[1][2] = (bounds[2] - bounds[1]) // 2
+        partial = self.dest + downloader.PARTIAL_EXT
+        with open(partial, 'wb') as f:
+            f.write(CONTENT[:bounds[1] + chunks[1][2]])
+        d = downloader.Download(self.url + '/file', self.dest)
+        d._chunks = chunks
+        d._length = length
+        d._validator = Handler.ETAG
+        d._save_state()
+        digest = self._download()
+        self.assertEqual(digest, hashlib.sha256(CONTENT).digest())
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        # Only the probe and the missing data are downloaded
+        self.assertEqual(self.server.served,
+                         1 + length - bounds[1] - chunks[1][2])
+
+    def testResumeChangedFile(self):
+        partial = self.dest + downloader.PARTIAL_EXT
+        with open(partial, 'wb') as f:
+            f.write(b'x' * 100)
+        d = downloader.Download(self.url + '/file', self.dest)
+        d._chunks = [[0, len(CONTENT), 100]]
+        d._length = len(CONTENT)
+        d._validator = '"v0"'
+        d._save_state()
+        self._download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def testNotFound(self):
+        with self.assertRaises(downloader.HTTPError):
+            self._download('/missing')
+        self.assertFalse(os.path.exists(self.dest))
+
+    def testMirrorFallback(self):
+        run_until_complete(shell.download(self.url + '/missing/file',
+                                          self.dest, mirrors=[self.url],
+                                          native=True))
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertRaises(FatalError, run_until_complete,
+            shell.download(self.url + '/missing', self.dest + '2',
+                           native=True))
+
+    def testSchemeFallback(self):
+        with open(os.path.join(self.tmp, 'src'), 'wb') as f:
+            f.write(CONTENT)
+        mirror = 'file://' + self.tmp
+        self.assertFalse(downloader.can_download(mirror + '/src'))
+        self.assertFalse(shell.can_download_natively(self.url + '/src',
+                                                     [mirror]))
+        # the mirror is downloaded with urllib
+        with mock.patch.object(shell, 'which', return_value=None):
+            run_until_complete(shell.download(self.url + '/missing/src',
+                                              self.dest, mirrors=[mirror],
+                                              native=True))
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def testProxy(self):
+        env = {'http_proxy': 'http://proxy:3128', 'no_proxy': '127.0.0.1'}
+        with mock.patch.dict(os.environ, env):
+            self.assertTrue(downloader.can_download(self.url + '/file'))
+            self.assertFalse(downloader.can_download('http://mirror/file'))
+            # every mirror is checked
+            self.assertTrue(shell.can_download_natively(self.url + '/file'))
+            self.assertFalse(shell.can_download_natively(self.url + '/file',
+                                                         ['http://mirror']))
+
+    def _serve_tarball(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:xz') as tar:
+            info = tarfile.TarInfo('pkg-1.0/README')
+            info.size = len(CONTENT)
+            tar.addfile(info, io.BytesIO(CONTENT))
+        self.server.content = data.getvalue()
+        return hashlib.sha256(self.server.content).hexdigest()
+
+    def testDownloadAndUnpack(self):
+        checksum = self._serve_tarball()
+        dest = self.dest[:-len('file.tar.xz')] + 'pkg-1.0.tar.xz'
+        output_dir = os.path.join(self.tmp, 'sources', 'streamed')
+        digests = DigestCache(os.path.join(self.tmp, 'digests.cache'))
+        run_until_complete(shell.download_and_unpack(
+            self.url + '/missing/pkg-1.0.tar.xz', dest, output_dir, checksum,
+            mirrors=[self.url + '/mirror'], digests=digests))
+        with open(os.path.join(output_dir, 'pkg-1.0', 'README'), 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.server.content)
+        with mock.patch('cerbero.utils.digests.file_digest') as file_digest:
+            self.assertEqual(digests.get(dest, 'sha256').hex(), checksum)
+            file_digest.assert_not_called()
+        self.assertEqual(os.listdir(os.path.dirname(output_dir)),
+                         ['streamed'])
+
+    def testDownloadAndUnpackChecksumMismatch(self):
+        self._serve_tarball()
+        dest = self.dest[:-len('file.tar.xz')] + 'pkg-1.0.tar.xz'
+        output_dir = os.path.join(self.tmp, 'sources', 'streamed')
+        with self.assertRaises(FatalError):
+            run_until_complete(shell.download_and_unpack(
+                self.url + '/file', dest, output_dir, '0' * 64))
+        self.assertFalse(os.path.exists(dest))
+        self.assertEqual(os.listdir(os.path.dirname(output_dir)), [])
+        self.assertEqual(os.listdir(self.tmp), ['sources'])
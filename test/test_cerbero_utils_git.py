@@ -0,0 +1,206 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import subprocess
+
+from cerbero.utils import git, run_until_complete
+
+
+class GitHashesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.repos = [os.path.join(self.tmp, name) for name in ('a', 'b')]
+        for repo in self.repos:
+            os.makedirs(repo)
+            self._git(repo, 'init', '-q')
+            self._commit(repo)
+        git._hashes.clear()
+
+    def tearDown(self):
+        git._hashes.clear()
+        shutil.rmtree(self.tmp)
+
+    def _git(self, repo, *args):
+        return subprocess.check_output(['git', '-c', 'user.name=test',
+                                        '-c', 'user.email=test@test'] +
+                                       list(args), cwd=repo,
+                                       universal_newlines=True).strip()
+
+    def _commit(self, repo):
+        self._git(repo, 'commit', '-q', '--allow-empty', '-m', 'commit')
+        return self._git(repo, 'rev-parse', 'HEAD')
+
+    def testResolveHashes(self):
+        git.resolve_hashes([(repo, 'HEAD') for repo in self.repos] +
+                           [(self.repos[0], 'missing-branch'),
+                            (self.tmp, 'HEAD')])
+        self.assertEqual(len(git._hashes), 2)
+        for repo in self.repos:
+            self.assertEqual(git._hashes[(repo, 'HEAD')],
+                             git.get_hash(repo, 'HEAD'))
+
+    def testCachedHash(self):
+        repo = self.repos[0]
+        head = git.get_hash(repo, 'HEAD')
+        self.assertEqual(git.get_cached_hash(repo, 'HEAD'), head)
+        new_head = self._commit(repo)
+        # cached until the repository is modified through git
+        self.assertEqual(git.get_cached_hash(repo, 'HEAD'), head)
+        run_until_complete(git.checkout(repo, new_head))
+        self.assertEqual(git.get_cached_hash(repo, 'HEAD'), new_head)
+        self.assertEqual(git.get_cached_hash(self.repos[1], 'HEAD'),
+                         git.get_hash(self.repos[1], 'HEAD'))
+
+
+class ObjectStoreTest(unittest.TestCase):
+
+    _git = GitHashesTest._git
+    _commit = GitHashesTest._commit
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        os.makedirs(self.upstream)
+        self._git(self.upstream, 'init', '-q')
+        self._commit(self.upstream)
+        self.head = self._git(self.upstream, 'rev-parse', 'HEAD')
+        self.branch = self._git(self.upstream, 'rev-parse', '--abbrev-ref',
+                                'HEAD')
+        self.store_dir = os.path.join(self.tmp, 'store')
+        git._store_fetches.clear()
+
+    def tearDown(self):
+        git._store_fetches.clear()
+        git._hashes.clear()
+        shutil.rmtree(self.tmp)
+
+    def _objects(self, repo):
+        objects = os.path.join(repo, '.git', 'objects')
+        return [f for d in os.listdir(objects) if d not in ('info', 'pack')
+                for f in os.listdir(os.path.join(objects, d))]
+
+    def testFetch(self):
+        recipes = [os.path.join(self.tmp, name) for name in ('r1', 'r2')]
+        for recipe in recipes:
+            git.init(recipe)
+
+        async def fetch(recipe):
+            store = await git.fetch_object_store(self.store_dir,
+                                                 self.upstream)
+            git.use_object_stores(recipe, [store])
+            await git.fetch_from_object_store(recipe, 'origin', store)
+            return store
+
+        with unittest.mock.patch.object(git, '_fetch_object_store',
+                                        wraps=git._fetch_object_store) as f:
+            stores = run_until_complete([fetch(r) for r in recipes])
+            # Fetched once for both recipes
+            self.assertEqual(f.call_count, 1)
+        self.assertEqual(stores[0], stores[1])
+        for recipe in recipes:
+            self.assertEqual(
+                git.get_hash(recipe, 'origin/%s' % self.branch), self.head)
+            # The objects are borrowed from the store
+            self.assertEqual(self._objects(recipe), [])
+        # Adding the store again doesn't duplicate the alternate
+        git.use_object_stores(recipes[0], stores)
+        with open(os.path.join(recipes[0], '.git', 'objects', 'info',
+                               'alternates')) as f:
+            self.assertEqual(len(f.read().splitlines()), 1)
+        # The checkouts borrow the objects through the recipe repository
+        checkout = os.path.join(self.tmp, 'checkout')
+        os.makedirs(checkout)
+        run_until_complete(git.local_checkout(checkout, recipes[0],
+                                              'origin/%s' % self.branch,
+                                              use_submodules=False))
+        self.assertEqual(git.get_hash(checkout, 'HEAD'), self.head)
+
+
+class FetchCommitTest(unittest.TestCase):
+
+    _git = GitHashesTest._git
+    _commit = GitHashesTest._commit
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        os.makedirs(self.upstream)
+        self._git(self.upstream, 'init', '-q')
+        self._git(self.upstream, 'config', 'uploadpack.allowFilter', 'true')
+        self._git(self.upstream, 'config', 'uploadpack.allowAnySHA1InWant',
+                  'true')
+        for i in range(3):
+            with open(os.path.join(self.upstream, 'file'), 'w') as f:
+                f.write('%d' % i * 10000)
+            self._git(self.upstream, 'add', '.')
+            self._commit(self.upstream)
+        self._git(self.upstream, 'tag', '1.0', 'HEAD~1')
+        self.branch = self._git(self.upstream, 'rev-parse', '--abbrev-ref',
+                                'HEAD')
+        self.repo = os.path.join(self.tmp, 'repo')
+        git.init(self.repo)
+        git.add_remote(self.repo, 'origin', 'file://' + self.upstream)
+
+    def tearDown(self):
+        git._hashes.clear()
+        shutil.rmtree(self.tmp)
+
+    def _fetch(self, commit, mode):
+        self.assertTrue(run_until_complete(git.fetch_commit(
+            self.repo, commit, ['origin'], mode)))
+        run_until_complete(git.checkout(self.repo, commit))
+
+    def _count(self, rev):
+        return int(self._git(self.repo, 'rev-list', '--count', rev))
+
+    def testShallowBranch(self):
+        self._fetch('origin/' + self.branch, 'shallow')
+        self.assertEqual(git.get_cached_hash(self.repo, 'origin/' + self.branch),
+                         self._git(self.upstream, 'rev-parse', 'HEAD'))
+        self.assertEqual(self._count('HEAD'), 1)
+
+    def testShallowTag(self):
+        self._fetch('1.0', 'shallow')
+        self.assertEqual(git.get_hash(self.repo, 'HEAD'),
+                         self._git(self.upstream, 'rev-parse', 'HEAD~1'))
+        with open(os.path.join(self.repo, 'file'), 'r') as f:
+            self.assertEqual(f.read(), '1' * 10000)
+
+    def testShallowHash(self):
+        commit = self._git(self.upstream, 'rev-parse', 'HEAD~1')
+        self._fetch(commit, 'shallow')
+        self.assertEqual(git.get_hash(self.repo, 'HEAD'), commit)
+
+    def testPartial(self):
+        self._fetch('1.0', 'partial')
+        # The whole history, but only the contents that were checked out
+        self.assertEqual(self._count('HEAD'), 2)
+        missing = self._git(self.repo, 'rev-list', '--objects',
+                            '--missing=print', 'HEAD')
+        self.assertEqual(len([l for l in missing.splitlines()
+                              if l.startswith('?')]), 1)
+
+    def testMissing(self):
+        self.assertFalse(run_until_complete(git.fetch_commit(
+            self.repo, 'missing-tag', ['origin'], 'shallow')))
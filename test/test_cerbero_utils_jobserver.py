@@ -0,0 +1,145 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from cerbero.utils import shell, run_until_complete
+
+
+@unittest.skipIf(sys.platform == 'win32', 'jobserver not supported on Windows')
+class JobServerTest(unittest.TestCase):
+
+    def setUp(self):
+        from cerbero.utils.jobserver import JobServer
+        self.jobserver = JobServer(2)
+
+    def tearDown(self):
+        self.jobserver.close()
+
+    def testAcquireRelease(self):
+        acquired = []
+
+        async def take(i):
+            async with self.jobserver:
+                acquired.append(i)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await self.jobserver.acquire()
+            await self.jobserver.acquire()
+            waiter = asyncio.ensure_future(take(0))
+            await asyncio.sleep(0.01)
+            # no tokens left
+            self.assertEqual(acquired, [])
+            self.jobserver.release()
+            await waiter
+            self.assertEqual(acquired, [0])
+            self.jobserver.release()
+
+        run_until_complete(run())
+
+    def testClientEnv(self):
+        env = self.jobserver.client_env(['make', 'V=1'], {})
+        fds = '%d,%d' % self.jobserver.fds
+        self.assertEqual(env['MAKEFLAGS'],
+            '-j --jobserver-fds=%s --jobserver-auth=%s' % (fds, fds))
+        self.assertIsNone(self.jobserver.client_env(['nmake'], {}))
+        self.assertIsNone(self.jobserver.client_env(['ninja'],
+                                                    {'PATH': '/nonexistent'}))
+
+    def testStripJobsArgs(self):
+        self.assertEqual(self.jobserver.strip_jobs_args(
+            ['make', '-j8', 'V=1', '--jobs=4', '-j']), ['make', 'V=1'])
+
+    @unittest.skipIf(shutil.which('make') is None, 'make not found')
+    def testMake(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'Makefile'), 'w') as f:
+                f.write('all: a b\na b:\n\t@echo $@\n')
+            env = os.environ.copy()
+            env.update(self.jobserver.client_env(['make'], env))
+            run_until_complete(shell.async_call(['make'], tmpdir, env=env,
+                                                pass_fds=self.jobserver.fds))
+            # all the tokens are back in the pipe
+            run_until_complete(self.jobserver.acquire())
+            run_until_complete(self.jobserver.acquire())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testUsingJobserver(self):
+        from cerbero.build import build
+        from test.test_common import DummyConfig
+
+        class Config(DummyConfig):
+            allow_parallel_build = True
+
+        class Makefile(build.Makefile):
+            def __init__(self, make):
+                self.config = Config()
+                self.make = make
+                self.env = {'PATH': '/nonexistent'}
+
+        class CustomCompile(Makefile):
+            async def compile(self):
+                pass
+
+        self.assertTrue(Makefile(['make', '-j4']).using_jobserver(
+            self.jobserver))
+        # ninja can't be found, so it keeps its own jobs
+        self.assertFalse(Makefile(['ninja']).using_jobserver(self.jobserver))
+        self.assertFalse(CustomCompile(['make']).using_jobserver(
+            self.jobserver))
+        recipe = Makefile(['make'])
+        recipe.allow_parallel_build = False
+        self.assertFalse(recipe.using_jobserver(self.jobserver))
+
+    def testCompileLock(self):
+        from cerbero.build import build
+        from cerbero.build.oven import Oven
+        from test.test_common import DummyConfig
+
+        class Config(DummyConfig):
+            allow_parallel_build = True
+
+        class Makefile(build.Makefile):
+            allow_parallel_build = True
+
+            def __init__(self, make):
+                self.config = Config()
+                self.make = make
+                self.env = {'PATH': '/nonexistent'}
+
+        oven = Oven.__new__(Oven)
+        build_lock = asyncio.Semaphore(2)
+        self.assertIs(oven._compile_lock(Makefile(['make']), build_lock,
+                                         self.jobserver), self.jobserver)
+        # ninja keeps its own jobs, limited by the build lock
+        self.assertIs(oven._compile_lock(Makefile(['ninja']), build_lock,
+                                         self.jobserver), build_lock)
+        # serial recipes hold a token without sharing it with the build tool
+        recipe = Makefile(['make'])
+        recipe.allow_parallel_build = False
+        self.assertIs(oven._compile_lock(recipe, build_lock, self.jobserver),
+                      self.jobserver)
+        self.assertIsNone(oven._compile_lock(recipe, build_lock, None))
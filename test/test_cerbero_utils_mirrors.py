@@ -0,0 +1,146 @@
+# cerbero - a multi-platform build system for Open Source software
+# Copyright (C) 2012 Andoni Morales Alastruey <ylatuya@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cerbero.utils import shell, run_until_complete
+from cerbero.utils.mirrors import MirrorSelector, MIN_THROUGHPUT_SIZE
+
+
+CONTENT = b'0123456789' * 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def _respond(self, body):
+        self.server.requests.append((self.command, self.path))
+        time.sleep(self.server.delay)
+        if not self.path.endswith('/file.tar.xz'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        if body:
+            self.wfile.write(CONTENT)
+
+
+class MirrorSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'mirrors.json')
+        self.servers = []
+        self.fast = self._start_server(0)
+        self.slow = self._start_server(0.3)
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        shutil.rmtree(self.tmp)
+
+    def _start_server(self, delay):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.delay = delay
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.servers.append((server, thread))
+        return server
+
+    def _url(self, server, path='/file.tar.xz'):
+        return 'http://127.0.0.1:%d%s' % (server.server_port, path)
+
+    def testRank(self):
+        selector = MirrorSelector(self.filename)
+        urls = [self._url(self.slow), self._url(self.fast)]
+        ranked, size = run_until_complete(selector.rank(urls))
+        self.assertEqual(ranked, urls[::-1])
+        self.assertEqual(size, len(CONTENT))
+        # The scores are persisted and the hosts are not probed again
+        selector.save()
+        selector = MirrorSelector(self.filename)
+        ranked, size = run_until_complete(selector.rank(urls))
+        self.assertEqual(ranked, urls[::-1])
+        self.assertEqual(len(self.slow.requests), 1)
+        # Only the best one, to get the size
+        self.assertEqual(len(self.fast.requests), 2)
+
+    def testTTL(self):
+        selector = MirrorSelector(self.filename, ttl=0)
+        urls = [self._url(self.slow), self._url(self.fast)]
+        run_until_complete(selector.rank(urls))
+        time.sleep(0.01)
+        run_until_complete(selector.rank(urls))
+        self.assertEqual(len(self.slow.requests), 2)
+
+    def testMissingAndUnreachable(self):
+        selector = MirrorSelector(self.filename)
+        # Nothing listens on the port of a closed server
+        closed = self._start_server(0)
+        unreachable = self._url(closed)
+        closed.shutdown()
+        closed.server_close()
+        urls = [unreachable, self._url(self.fast, '/missing'),
+                self._url(self.slow)]
+        ranked, size = run_until_complete(selector.rank(urls))
+        self.assertEqual(ranked[0], self._url(self.slow))
+        self.assertEqual(ranked[-1], unreachable)
+
+    def testThroughput(self):
+        selector = MirrorSelector(self.filename)
+        urls = [self._url(self.fast), self._url(self.slow)]
+        run_until_complete(selector.rank(urls))
+        size = 100 * MIN_THROUGHPUT_SIZE
+        selector.record(urls[0], size, 100)
+        selector.record(urls[1], size, 1)
+        self.assertLess(selector.expected_time(urls[1], size),
+                        selector.expected_time(urls[0], size))
+
+    def testRace(self):
+        selector = MirrorSelector(self.filename)
+        dest = os.path.join(self.tmp, 'sources', 'file.tar.xz')
+        with mock.patch.object(shell, '_race_download',
+                               wraps=shell._race_download) as race:
+            run_until_complete(shell.download(
+                self._url(self.slow), dest,
+                mirrors=[self._url(self.fast, '/')], native=True,
+                selector=selector))
+        self.assertEqual(race.call_args[0][1],
+                         [self._url(self.fast), self._url(self.slow)])
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(os.listdir(os.path.dirname(dest)), ['file.tar.xz'])
@@ -37,6 +37,7 @@ class DummyConfig(object):
     packages_prefix = ''
     packager = DEFAULT_PACKAGER
     install_dir = ''
+    status_db = False
 
 
 class XMLMixin():